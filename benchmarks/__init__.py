@@ -0,0 +1,19 @@
+import zlib
+
+import peewee
+
+
+def make_database(module_classes):
+    # Full text search is Postgres only; the benchmarks write vectors but never match them.
+    database = peewee.SqliteDatabase(':memory:')
+    database.func('to_tsvector')(lambda config, text: text)
+    database.func('setweight')(lambda vector, weight: vector)
+    database.func('hashtextextended')(lambda text, seed: zlib.crc32(text.encode('utf-8')))
+    models = [model for module_class in module_classes for model in module_class.models]
+    database.bind(models)
+    for model in models:
+        for field in model._meta.fields.values():
+            if field.name == 'search_vector':
+                field.index = False
+    database.create_tables(models)
+    return database
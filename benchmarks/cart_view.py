@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import random
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import make_database  # noqa: E402
+from modules.cart import CartModule, SET  # noqa: E402
+from modules.fulfillment_center import FulfillmentCenterModule  # noqa: E402
+from modules.online_shop import OnlineShopModule  # noqa: E402
+from modules.product import ProductModule, Attribute, AttributeValue, Product, Article, ArticleSupplierSKU  # noqa: E402
+from modules.sales_channel import SalesChannelModule  # noqa: E402
+from modules.supplier import SupplierModule, SupplierSKU, SupplierFulfillmentCenterSKU, Supplier  # noqa: E402
+from modules.warehouse import WarehouseModule, ADD  # noqa: E402
+
+
+MODULE_CLASSES = (
+    SalesChannelModule,
+    ProductModule,
+    SupplierModule,
+    FulfillmentCenterModule,
+    WarehouseModule,
+    CartModule,
+)
+
+
+def make_online_shop(article_count, fulfillment_center_count):
+    random.seed(0)
+    online_shop = OnlineShopModule(sales_channel_id=None)
+    for module_class in MODULE_CLASSES:
+        online_shop.install(module_class, remote=False)
+
+    fulfillment_centers = [
+        online_shop.get('fulfillment_center').create_fulfillment_center(
+            'Fulfillment center {}'.format(i),
+            online_shop.get('warehouse').create_warehouse('Warehouse {}'.format(i)),
+        )
+        for i
+        in range(fulfillment_center_count)
+    ]
+    supplier = online_shop.get('supplier').create_supplier('Supplier', fulfillment_centers)
+    online_shop.claim(online_shop.get('sales_channel').create_sales_channel('Shop', suppliers=[supplier])['uuid'])
+
+    attribute_value = AttributeValue.create(attribute=Attribute.create(name='Brand'), name='Brand')
+    product = Product.create(uuid=str(uuid4()), name='Product', type=attribute_value, brand=attribute_value)
+    article_ids, prices, movements = [], [], []
+    for i in range(article_count):
+        article = Article.create(uuid=str(uuid4()), name='Article {}'.format(i), product=product, recommended_retail_price=10)
+        supplier_sku = SupplierSKU.create(uuid=str(uuid4()), supplier=Supplier.get(uuid=supplier['uuid']), sku='SKU-{}'.format(i))
+        ArticleSupplierSKU.create(article=article, supplier_sku_id=supplier_sku.uuid)
+        for fulfillment_center in fulfillment_centers:
+            SupplierFulfillmentCenterSKU.create(
+                supplier_sku=supplier_sku,
+                fulfillment_center_id=fulfillment_center['uuid'],
+                sku=supplier_sku.sku,
+            )
+            movements.append(dict(
+                warehouse=fulfillment_center['warehouse_id'],
+                sku=supplier_sku.sku,
+                location='A1',
+                quantity=random.randint(0, 20),
+                type=ADD,
+            ))
+        article_ids.append(article.uuid)
+        prices.append(dict(article_id=article.uuid, supplier_sku_id=supplier_sku.uuid, price='{:.2f}'.format(random.uniform(5, 300))))
+    online_shop.get('warehouse').apply_stock_movements(movements)
+    online_shop.get('product').set_prices(online_shop.sales_channel_id, prices)
+
+    return online_shop, article_ids
+
+
+def count_queries(database, function):
+    queries = []
+    execute_sql = database.execute_sql
+
+    def counting_execute_sql(sql, params=None, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, params, *args, **kwargs)
+
+    database.execute_sql = counting_execute_sql
+    try:
+        function()
+    finally:
+        del database.execute_sql
+    return len(queries)
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main(repeat=20):
+    database = make_database(MODULE_CLASSES)
+    online_shop, article_ids = make_online_shop(100, 3)
+
+    print('{:<10} {:>10} {:>10}'.format('lines', 'queries', 'ms'))
+    for line_count in (1, 10, 100):
+        customer_id = 'customer-{}'.format(line_count)
+        online_shop.get('cart').apply_cart_operations(online_shop.sales_channel_id, customer_id, [
+            dict(article_id=article_id, quantity=1, type=SET)
+            for article_id
+            in article_ids[:line_count]
+        ])
+
+        def view():
+            return online_shop.view_customers_cart(customer_id)
+
+        assert len(view()['items']) == line_count
+        print('{:<10} {:>10} {:>10.2f}'.format(
+            line_count,
+            count_queries(database, view),
+            measure(view, repeat) * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import make_database  # noqa: E402
+from modules.commerce_engine import CommerceEngine  # noqa: E402
+from modules.fulfillment_center import FulfillmentCenterModule  # noqa: E402
+from modules.sales_channel import SalesChannelModule  # noqa: E402
+from modules.supplier import SupplierModule  # noqa: E402
+from modules.warehouse import WarehouseModule, ADD  # noqa: E402
+
+
+MODULE_CLASSES = (
+    SalesChannelModule,
+    SupplierModule,
+    FulfillmentCenterModule,
+    WarehouseModule,
+)
+
+
+def make_commerce_engine(sku_count, warehouse_count, supplier_count):
+    random.seed(0)
+    commerce_engine = CommerceEngine()
+    for module_class in MODULE_CLASSES:
+        commerce_engine.install(module_class, remote=False)
+
+    fulfillment_centers = [
+        commerce_engine.get('fulfillment_center').create_fulfillment_center(
+            'Fulfillment center {}'.format(i),
+            commerce_engine.get('warehouse').create_warehouse('Warehouse {}'.format(i)),
+        )
+        for i
+        in range(warehouse_count)
+    ]
+    per_supplier = warehouse_count // supplier_count
+    suppliers = [
+        commerce_engine.get('supplier').create_supplier(
+            'Supplier {}'.format(i),
+            fulfillment_centers[i * per_supplier:(i + 1) * per_supplier],
+        )
+        for i
+        in range(supplier_count)
+    ]
+    sales_channel = commerce_engine.get('sales_channel').create_sales_channel('Shop', suppliers=suppliers)
+
+    # Sparse stock, so that most orders need the set cover and some lines need splitting.
+    skus = ['SKU-{}'.format(i) for i in range(sku_count)]
+    commerce_engine.get('warehouse').apply_stock_movements([
+        dict(
+            warehouse=fulfillment_center['warehouse_id'],
+            sku=sku,
+            location='A1',
+            quantity=random.randint(1, 10),
+            type=ADD,
+        )
+        for fulfillment_center
+        in fulfillment_centers
+        for sku
+        in skus
+        if random.random() < 0.3
+    ])
+
+    return commerce_engine, sales_channel['uuid'], skus
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main(repeat=5):
+    make_database(MODULE_CLASSES)
+    commerce_engine, sales_channel_id, skus = make_commerce_engine(1000, 100, 10)
+
+    started_at = time.perf_counter()
+    commerce_engine.get_routing_graph()
+    print('built the routing graph in {:.2f}ms'.format((time.perf_counter() - started_at) * 1000))
+
+    print('{:<10} {:>10} {:>10} {:>12} {:>10}'.format('lines', 'shipments', 'splits', 'unallocated', 'ms'))
+    for line_count in (10, 100, 1000):
+        lines = [dict(sku=sku, quantity=random.randint(1, 5)) for sku in random.sample(skus, line_count)]
+
+        def route():
+            return commerce_engine.route_order(sales_channel_id, lines)
+
+        plan = route()
+        print('{:<10} {:>10} {:>10} {:>12} {:>10.2f}'.format(
+            line_count,
+            len(plan['shipments']),
+            plan['splits'],
+            len(plan['unallocated']),
+            measure(route, repeat) * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+from aiohttp import web  # noqa: E402
+from flask import Flask  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from modules.base import Module, procedure, get_codec, KeepAliveRequestHandler  # noqa: E402
+
+
+class QuietRequestHandler(KeepAliveRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+class EchoModule(Module):
+    name = 'echo'
+
+    @procedure
+    def echo(self, value):
+        return value
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_flask_server(module, port):
+    flask = Flask(__name__)
+    flask.route('/', methods=['GET', 'POST'])(module.route)
+    server = make_server('127.0.0.1', port, flask, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def start_aiohttp_server(module, port):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(module.make_web_app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+def measure(call, seconds):
+    calls, started_at = 0, time.perf_counter()
+    while time.perf_counter() - started_at < seconds:
+        call()
+        calls += 1
+    return calls / (time.perf_counter() - started_at)
+
+
+def main(seconds):
+    for server_name, start_server in (('flask', start_flask_server), ('aiohttp', start_aiohttp_server)):
+        port = get_free_port()
+        start_server(EchoModule(), port)
+        address = '127.0.0.1:{}'.format(port)
+        client = EchoModule(remote=True, address=address)
+        codec = get_codec(client.codec)
+        body = codec.dumps({'method_name': 'echo', 'args': ['ping'], 'kwargs': {}})
+
+        def unpooled():
+            # What every remote call did before: a bare requests.post, and with it a new connection.
+            response = requests.post(
+                'http://' + address,
+                data=body,
+                headers={'Content-Type': codec.content_type, 'Accept': codec.content_type},
+            )
+            return codec.loads(response.content)['return']
+
+        for client_name, call in (
+            ('unpooled requests.post', unpooled),
+            ('pooled Module transport', lambda: client.echo('ping')),
+        ):
+            print('{:<8} {:<24} {:>8.0f} calls/s'.format(server_name, client_name, measure(call, seconds)))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peewee import PostgresqlDatabase  # noqa: E402
+
+from modules.product import ProductModule, Attribute, AttributeValue, Product, TYPE, BRAND  # noqa: E402
+
+
+TYPES = ['Shoe', 'Jacket', 'Shirt', 'Trousers', 'Bag', 'Hat']
+BRANDS = ['Nike', 'Adidas', 'Puma', 'Reebok', 'New Balance', 'Asics', 'Vans', 'Converse']
+WORDS = ['Runner', 'Classic', 'Trail', 'Pro', 'Lite', 'Winter', 'Summer', 'Edition', 'Air', 'Street']
+QUERIES = [
+    dict(q='run'),
+    dict(q='classic trail'),
+    dict(q='air pro edition'),
+    dict(q='winter', type='Jacket'),
+    dict(q='street', brand='Vans'),
+    dict(q='zzz'),
+]
+
+
+def make_database():
+    # A database of its own, so that the benchmark never touches the application's tables.
+    params = dict(
+        user=os.getenv('POSTGRES_USER', 'postgres'),
+        password=os.getenv('POSTGRES_PASSWORD', 'postgres'),
+        host=os.getenv('POSTGRES_HOST', 'localhost'),
+        port=int(os.getenv('POSTGRES_PORT', '5432')),
+    )
+    server = PostgresqlDatabase('postgres', autocommit=True, **params)
+    if not server.execute_sql("SELECT 1 FROM pg_database WHERE datname = 'search_benchmark'").fetchone():
+        server.execute_sql('CREATE DATABASE search_benchmark')
+    server.close()
+    return PostgresqlDatabase('search_benchmark', **params)
+
+
+def make_products(database, count):
+    attribute_value_ids = {}
+    for attribute_name, names in ((TYPE, TYPES), (BRAND, BRANDS)):
+        attribute, _ = Attribute.get_or_create(name=attribute_name, defaults={'multiple': False})
+        attribute_value_ids[attribute_name] = [
+            AttributeValue.get_or_create(attribute=attribute, name=name)[0].id
+            for name
+            in names
+        ]
+
+    # Generated server side; the search vectors are then filled in by the module's own reindex.
+    database.execute_sql(
+        '''
+        INSERT INTO {product} (uuid, name, created_at, type_id, brand_id)
+        SELECT
+            md5(i::text),
+            (%(words)s::text[])[1 + i %% 10] || ' '
+                || (%(words)s::text[])[1 + (i / 10) %% 10] || ' '
+                || (%(words)s::text[])[1 + (i / 100) %% 10],
+            now(),
+            (%(types)s::int[])[1 + (i / 7) %% %(type_count)s],
+            (%(brands)s::int[])[1 + (i / 11) %% %(brand_count)s]
+        FROM generate_series(1, %(count)s) AS i
+        '''.format(product=Product._meta.table_name),
+        dict(
+            words=WORDS,
+            types=attribute_value_ids[TYPE],
+            type_count=len(TYPES),
+            brands=attribute_value_ids[BRAND],
+            brand_count=len(BRANDS),
+            count=count,
+        ),
+    )
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main(count=1000000, repeat=5):
+    database = make_database()
+    database.bind(ProductModule.models)
+    database.drop_tables(ProductModule.models)
+    database.create_tables(ProductModule.models)
+    product_module = ProductModule()
+
+    started_at = time.perf_counter()
+    with database.atomic():
+        make_products(database, count)
+    print('generated {} products in {:.1f}s'.format(count, time.perf_counter() - started_at))
+
+    started_at = time.perf_counter()
+    product_module.reindex_products()
+    print('indexed them in {:.1f}s'.format(time.perf_counter() - started_at))
+    database.execute_sql('ANALYZE')
+
+    print('{:<40} {:>10} {:>10}'.format('query', 'matches', 'ms'))
+    for query in QUERIES:
+        def search():
+            return product_module.search_products(**query)
+
+        print('{:<40} {:>10} {:>10.2f}'.format(
+            ', '.join('{}={}'.format(key, value) for key, value in query.items()),
+            search()['count'],
+            measure(search, repeat) * 1000,
+        ))
+
+    database.drop_tables(ProductModule.models)
+    database.close()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
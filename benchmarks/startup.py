@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+import requests
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules main.py serves; importing main itself would wire up a process.
+MODULE_NAMES = [
+    'commerce_engine',
+    'warehouse',
+    'fulfillment_center',
+    'supplier',
+    'sales_channel',
+    'customer',
+    'cart',
+    'product',
+]
+PHASES = ('import', 'wiring', 'database', 'warm_up', 'first_request')
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(module_name, port):
+    environment = dict(
+        os.environ,
+        DEBUG='false',
+        MASTER_MODULE_NAME='commerce_engine',
+        MODULE_NAME=module_name,
+        MODULE_SERVER='flask',
+        POSTGRES_HOST=os.getenv('POSTGRES_HOST', 'localhost'),
+    )
+    # Every other module is remote, and never called: the description doesn't touch them.
+    for name in MODULE_NAMES:
+        environment[name.upper() + '_MODULE_ADDRESS'] = '127.0.0.1:1'
+    environment[module_name.upper() + '_MODULE_ADDRESS'] = '127.0.0.1:{}'.format(port)
+    return subprocess.Popen(
+        [sys.executable, 'main.py'],
+        cwd=ROOT,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def measure(module_name, timeout=60):
+    port = get_free_port()
+    started_at = time.perf_counter()
+    process = start(module_name, port)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            if process.poll() is not None:
+                error = process.stderr.read().decode('utf-8', 'replace').strip().splitlines()
+                raise RuntimeError('{} exited before serving: {}'.format(module_name, error[-1] if error else process.returncode))
+            try:
+                response = requests.get('http://127.0.0.1:{}/'.format(port), headers={'Accept': 'application/json'}, timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError('{} not serving after {}s'.format(module_name, timeout))
+                time.sleep(0.01)
+        return time.perf_counter() - started_at, response.json()['startup']
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(repeat=3):
+    print('{:<20} {:>10}'.format('module', 'total') + ''.join(' {:>14}'.format(phase) for phase in PHASES))
+    for module_name in MODULE_NAMES:
+        total, timings = min((measure(module_name) for _ in range(repeat)), key=lambda result: result[0])
+        print('{:<20} {:>10.3f}'.format(module_name, total) + ''.join(
+            ' {:>14.3f}'.format(timings.get(phase, 0))
+            for phase
+            in PHASES
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
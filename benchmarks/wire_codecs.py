@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import random
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.base import CODECS  # noqa: E402
+
+
+TYPES = ['Shoe', 'Jacket', 'Shirt', 'Trousers', 'Bag', 'Hat']
+BRANDS = ['Nike', 'Adidas', 'Puma', 'Reebok', 'New Balance', 'Asics', 'Vans', 'Converse']
+WORDS = ['Runner', 'Classic', 'Trail', 'Pro', 'Lite', 'Winter', 'Summer', 'Edition', 'Air', 'Street']
+
+
+def make_products(count):
+    random.seed(0)
+    return [
+        dict(
+            uuid=str(uuid4()),
+            name=' '.join(random.sample(WORDS, 3)),
+            type=random.choice(TYPES),
+            brand=random.choice(BRANDS),
+        )
+        for _ in range(count)
+    ]
+
+
+def make_articles(count):
+    random.seed(1)
+    return [
+        dict(
+            uuid=str(uuid4()),
+            name=' '.join(random.sample(WORDS, 2)) + ' ' + random.choice(['S', 'M', 'L', 'XL']),
+            product=str(uuid4()),
+            product_name=' '.join(random.sample(WORDS, 3)),
+            recommended_retail_price='{:.2f}'.format(random.uniform(5, 300)),
+            price='{:.2f}'.format(random.uniform(5, 300)),
+        )
+        for _ in range(count)
+    ]
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main(repeat=5):
+    print('{:<20} {:<20} {:>10} {:>10} {:>10}'.format('payload', 'codec', 'bytes', 'encode ms', 'decode ms'))
+    for name, payload in (
+        ('100 products', {'return': make_products(100)}),
+        ('10000 products', {'return': make_products(10000)}),
+        ('10000 articles', {'return': make_articles(10000)}),
+    ):
+        for content_type, codec in CODECS.items():
+            data = codec.dumps(payload)
+            assert codec.loads(data) == payload
+            print('{:<20} {:<20} {:>10} {:>10.2f} {:>10.2f}'.format(
+                name,
+                content_type,
+                len(data),
+                measure(lambda: codec.dumps(payload), repeat) * 1000,
+                measure(lambda: codec.loads(data), repeat) * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
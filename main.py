@@ -1,89 +1,247 @@
 import os
+import sys
+import logging
 
 from distutils.util import strtobool
+from functools import partial
+from importlib import import_module
 
 # Database
 
-from peewee import PostgresqlDatabase, Model
+from peewee import PostgresqlDatabase
+from playhouse.migrate import PostgresqlMigrator, migrate as run_migrations
+
+from modules.base import invalidation_bus, startup_timer
 
 # Modules
 
-from modules.commerce_engine import CommerceEngine
-from modules.warehouse import WarehouseModule
-from modules.fulfillment_center import FulfillmentCenterModule
-from modules.supplier import SupplierModule
-from modules.sales_channel import SalesChannelModule
-from modules.customer import CustomerModule
-from modules.cart import CartModule
-from modules.product import ProductModule
+# Imported on demand, so that a process only loads the code of the modules it talks to.
+MODULES = {
+    'commerce_engine': 'modules.commerce_engine.CommerceEngine',
+    'warehouse': 'modules.warehouse.WarehouseModule',
+    'fulfillment_center': 'modules.fulfillment_center.FulfillmentCenterModule',
+    'supplier': 'modules.supplier.SupplierModule',
+    'sales_channel': 'modules.sales_channel.SalesChannelModule',
+    'customer': 'modules.customer.CustomerModule',
+    'cart': 'modules.cart.CartModule',
+    'product': 'modules.product.ProductModule',
+    'management': 'modules.management.ManagementModule',
+    'infrastructure': 'modules.infrastructure.InfrastructureModule',
+    'online_shop': 'modules.online_shop.OnlineShopModule',
+}
+CORE_MODULE_NAMES = [
+    'commerce_engine',
+    'warehouse',
+    'fulfillment_center',
+    'supplier',
+    'sales_channel',
+    'customer',
+    'cart',
+    'product',
+]
+
 
-from modules.management import ManagementModule
-from modules.infrastructure import InfrastructureModule
+def load_module_class(name):
+    with startup_timer.phase('import'):
+        module_path, class_name = MODULES[name].rsplit('.', 1)
+        return getattr(import_module(module_path), class_name)
 
-from modules.online_shop import OnlineShopModule
 
 db = PostgresqlDatabase(
     'postgres',
     user='postgres',
     password='postgres',
-    host='postgres',
-    port=5432,
+    host=os.getenv('POSTGRES_HOST', 'postgres'),
+    port=int(os.getenv('POSTGRES_PORT', '5432')),
 )
 
 debug = bool(strtobool(os.getenv('DEBUG', 'false')))
+logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
 master_module_name = os.getenv('MASTER_MODULE_NAME')
 module_name = os.getenv('MODULE_NAME')
-is_current_module = lambda module_cls: module_cls.name == module_name  # noqa: #E731
+colocated_module_names = {
+    name.strip()
+    for name
+    in os.getenv('COLOCATED_MODULES', '').split(',')
+    if name.strip()
+}
+local_module_names = colocated_module_names | {module_name}
+module_server = os.getenv('MODULE_SERVER', 'flask')
+module_workers = int(os.getenv('MODULE_WORKERS', '1'))
+module_threads = int(os.getenv('MODULE_THREADS', '10'))
+rpc_options = dict(
+    pool_size=int(os.getenv('RPC_POOL_SIZE', '10')),
+    connect_timeout=float(os.getenv('RPC_CONNECT_TIMEOUT', '3.05')),
+    read_timeout=float(os.getenv('RPC_READ_TIMEOUT', '30')),
+    retries=int(os.getenv('RPC_RETRIES', '3')),
+    backoff_factor=float(os.getenv('RPC_BACKOFF_FACTOR', '0.1')),
+    codec=os.getenv('RPC_CODEC', 'application/msgpack'),
+    cache_size=int(os.getenv('PROCEDURE_CACHE_SIZE', '1024')),
+)
+search_options = dict(
+    search_backend=os.getenv('SEARCH_BACKEND', 'database'),
+    search_index_path=os.getenv('SEARCH_INDEX_PATH'),
+)
+module_options = {
+    'online_shop': dict(
+        sales_channel_id=os.getenv('SALES_CHANNEL_ID'),
+        claim_secret=os.getenv('ONLINE_SHOP_CLAIM_SECRET'),
+    ),
+    'infrastructure': dict(
+        warm_pool_size=int(os.getenv('ONLINE_SHOP_POOL_SIZE', '2')),
+        max_online_shops=int(os.getenv('MAX_ONLINE_SHOPS', '50')),
+        claim_secret=os.getenv('ONLINE_SHOP_CLAIM_SECRET'),
+    ),
+    'warehouse': dict(stock_snapshot_interval=int(os.getenv('STOCK_SNAPSHOT_INTERVAL', '10000'))),
+    'cart': dict(cart_store=os.getenv('CART_STORE', 'database')),
+    'sales_channel': search_options,
+    'product': search_options,
+}
 
 modules = {}
-module_classes = [
-    CommerceEngine,
-    WarehouseModule,
-    FulfillmentCenterModule,
-    SupplierModule,
-    SalesChannelModule,
-    CustomerModule,
-    CartModule,
-    ProductModule,
-]
+module_names = list(CORE_MODULE_NAMES)
 
 if module_name in ('infrastructure', 'management'):
-    module_classes.append(InfrastructureModule)
+    module_names.append('infrastructure')
     if module_name == 'management':
-        module_classes.append(ManagementModule)
+        module_names.append('management')
 elif module_name == 'online_shop':
-    module_classes.append(OnlineShopModule)
-
-for module_cls in module_classes:
-    address = os.getenv(module_cls.name.upper() + '_MODULE_ADDRESS', '')
-    if module_cls.name in (module_name, master_module_name):
-        module = module_cls(
-            debug=debug,
-            remote=module_cls.name != module_name,
-            is_master_module=module_cls.name == master_module_name,
-            address=address,
-            **{
-                'parent_module': modules[master_module_name] if module_cls.name != master_module_name else None,
-                'sales_channel_id': os.getenv('SALES_CHANNEL_ID') if module_cls.name == 'online_shop' else None,
-            }
-        )
-        modules[module.name] = module
-    else:
-        module = modules[master_module_name].install(
-            module_cls,
-            remote=bool(address),
-            address=address,
-            debug=debug,
-        )
+    module_names.append('online_shop')
+
+with startup_timer.phase('wiring'):
+    for name in module_names:
+        address = os.getenv(name.upper() + '_MODULE_ADDRESS', '')
+        if name in (module_name, master_module_name):
+            module = load_module_class(name)(
+                debug=debug,
+                remote=name not in local_module_names,
+                is_master_module=name == master_module_name,
+                address=address,
+                server=module_server,
+                workers=module_workers,
+                threads=module_threads,
+                **rpc_options,
+                **module_options.get(name, {}),
+                **{
+                    'parent_module': modules[master_module_name] if name != master_module_name else None,
+                }
+            )
+        elif address and name not in local_module_names:
+            modules[master_module_name].install_lazy(
+                name,
+                partial(load_module_class, name),
+                remote=True,
+                address=address,
+                debug=debug,
+                **rpc_options,
+                **module_options.get(name, {}),
+            )
+            continue
+        else:
+            module = modules[master_module_name].install(
+                load_module_class(name),
+                remote=False,
+                address=address,
+                debug=debug,
+                **rpc_options,
+                **module_options.get(name, {}),
+            )
         modules[module.name] = module
-    if hasattr(module, '__post_init__'):
-        module.__post_init__(module_name)
+        if hasattr(module, '__post_init__'):
+            module.__post_init__(module_name)
 
 module = modules[module_name]
 
+if module_server == 'gunicorn':
+    for _module in modules.values():
+        if not _module.remote and _module.max_workers is not None and module_workers > _module.max_workers:
+            raise RuntimeError('{!r} keeps state in its process and can run with at most {} worker(s), not MODULE_WORKERS={}'.format(
+                _module.name,
+                _module.max_workers,
+                module_workers,
+            ))
+
+
+def get_models(module_classes):
+    return [model for module_cls in module_classes for model in module_cls.models]
+
+
+# Procedures that fill in the search vectors of existing rows once their columns are added.
+REINDEX_PROCEDURES = {
+    'product': 'reindex_products',
+    'supplier': 'reindex_suppliers',
+    'sales_channel': 'reindex_sales_channels',
+}
+# Procedures that record the rows already there as the opening balance of a ledger without entries.
+OPENING_PROCEDURES = {
+    'warehouse': 'open_stock_ledger',
+}
+
+
+def migrate():
+    module_classes = {name: load_module_class(name) for name in CORE_MODULE_NAMES}
+    models = get_models(module_classes.values())
+    db.connect(reuse_if_open=True)
+    db.bind(models)
+    migrator = PostgresqlMigrator(db)
+    reindex = set()
+    with db.atomic():
+        # create_tables leaves existing tables alone, so columns added to a model since are added here.
+        for name, module_class in module_classes.items():
+            for model in module_class.models:
+                table_name = model._meta.table_name
+                if not db.table_exists(table_name):
+                    continue
+                column_names = {column.name for column in db.get_columns(table_name)}
+                fields = [field for field in model._meta.sorted_fields if field.column_name not in column_names]
+                run_migrations(*(
+                    migrator.add_column(table_name, field.column_name, field)
+                    for field
+                    in fields
+                ))
+                if name in REINDEX_PROCEDURES and any(field.name == 'search_vector' for field in fields):
+                    reindex.add(name)
+        db.create_tables(models)
+        for name in sorted(reindex):
+            getattr(module_classes[name](), REINDEX_PROCEDURES[name])()
+        # No-ops once the ledger has entries of its own.
+        for name, procedure_name in OPENING_PROCEDURES.items():
+            getattr(module_classes[name](), procedure_name)()
+    db.close()
+
+
+def setup_database():
+    local_modules = [_module for _module in modules.values() if not _module.remote]
+    with startup_timer.phase('database'):
+        db.connect()
+        # Only the tables of the modules served here; the schema itself is created by `main.py migrate`.
+        db.bind(get_models(local_modules))
+    with startup_timer.phase('warm_up'):
+        for _module in local_modules:
+            if hasattr(_module, 'warm_up'):
+                _module.warm_up()
+    # Workers must open their own connections instead of sharing the master's socket.
+    db.close()
+    invalidation_bus.connect(db)
+    invalidation_bus.listen()
+
+
+def post_fork(server, worker):
+    db.connect(reuse_if_open=True)
+    invalidation_bus.listen()
+
+
+def worker_exit(server, worker):
+    # gunicorn workers install their own SIGTERM handler, so modules flush their state here.
+    for _module in modules.values():
+        if not _module.remote and hasattr(_module, 'shutdown'):
+            _module.shutdown()
+    db.close()
+
+
 if __name__ == '__main__':
-    db.connect()
-    for cls in Model.__subclasses__():
-        cls.bind(db)
-    db.create_tables(Model.__subclasses__())
-    module.start()
+    if sys.argv[1:] == ['migrate']:
+        migrate()
+        sys.exit()
+    setup_database()
+    module.start(post_fork=post_fork, worker_exit=worker_exit)
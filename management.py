@@ -2,18 +2,24 @@ import sys
 
 from flask import Flask, jsonify, render_template, request, redirect, url_for, flash
 
-from modules.base import validate, enhance_schema_with_data
-from main import module
+from modules.base import validate, enhance_schema_with_data, serve, ProcedureCache
+from main import module, setup_database, post_fork, worker_exit
 
-host, port = module.address.split(':')
-port = int(port)
 
 app = Flask(__name__)
 app.secret_key = 'SUPERSECRETKEY'
 
+PAGE_SIZE = 50
+METRICS_TTL = 30
+
+metrics_cache = ProcedureCache(maxsize=1)
+
+
+def get_metrics():
+    found, metrics = metrics_cache.get('metrics')
+    if found:
+        return metrics
 
-@app.route('/')
-def dashboard():
     metrics = [
         {
             'name': 'Supply Chain',
@@ -22,28 +28,55 @@ def dashboard():
                 {
                     'name': 'Suppliers',
                     'type': 'statistic',
-                    'value': len(module.get('supplier').get_suppliers()),
+                    'value': module.get('supplier').aggregate_suppliers()['count'],
                 },
                 {
                     'name': 'Fulfillment Centers',
                     'type': 'statistic',
-                    'value': len(module.get('fulfillment_center').get_fulfillment_centers()),
+                    'value': module.get('fulfillment_center').aggregate_fulfillment_centers()['count'],
                 },
                 {
                     'name': 'Warehouses',
                     'type': 'statistic',
-                    'value': len(module.get('warehouse').get_warehouses()),
+                    'value': module.get('warehouse').aggregate_warehouses()['count'],
                 },
                 {
                     'name': 'Sales Channels',
                     'type': 'statistic',
-                    'value': len(module.get('sales_channel').get_sales_channels())
+                    'value': module.get('sales_channel').aggregate_sales_channels()['count'],
                 }
             ],
         },
+        {
+            'name': 'Catalogue',
+            'type': 'nested',
+            'value': [
+                {
+                    'name': 'Products',
+                    'type': 'statistic',
+                    'value': module.get('product').aggregate_products()['count'],
+                },
+                {
+                    'name': 'Last Product Created',
+                    'type': 'statistic',
+                    'value': module.get('product').aggregate_products(max='created_at')['max']['created_at'],
+                },
+            ],
+        },
     ]
+    metrics_cache.set('metrics', metrics, METRICS_TTL)
 
-    return render_template('management/dashboard.html', metrics=metrics)
+    return metrics
+
+
+@app.route('/')
+def dashboard():
+    return render_template('management/dashboard.html', metrics=get_metrics())
+
+
+@app.route('/metrics')
+def metrics():
+    return jsonify(get_metrics())
 
 
 def merge(a, b):
@@ -52,11 +85,32 @@ def merge(a, b):
     return a
 
 
+def next_page_url(endpoint, objects):
+    if len(objects) < PAGE_SIZE:
+        return None
+    return url_for(endpoint, after=objects[-1]['uuid'])
+
+
 @app.route('/search')
 def search():
     q = str(request.args.get('q', default='', type=str))
     types = {
-        'sales channel': lambda q: module.get('sales_channel').search_for_sales_channels(q),
+        'sales channel': (
+            lambda q: module.get('sales_channel').search_for_sales_channels(q, limit=PAGE_SIZE),
+            lambda object: url_for('edit_sales_channel', uuid=object['uuid']),
+        ),
+        'product': (
+            lambda q: module.get('product').search_products(q, limit=PAGE_SIZE)['results'],
+            lambda object: url_for('edit_product', uuid=object['uuid']),
+        ),
+        'article': (
+            lambda q: module.get('product').search_articles(q, limit=PAGE_SIZE)['results'],
+            lambda object: url_for('edit_product', uuid=object['product']),
+        ),
+        'supplier': (
+            lambda q: module.get('supplier').search_suppliers(q, limit=PAGE_SIZE)['results'],
+            lambda object: url_for('supply_chain'),
+        ),
     }
 
     searches = {}
@@ -71,16 +125,17 @@ def search():
 
     result = []
     for key in tuple(searches.keys()):
+        search_for, make_href = types[key]
         result.extend((
             merge(
                 object,
                 {
                     'doc_type': key,
-                    'href': url_for('edit_sales_channel', uuid=object['uuid'])
+                    'href': make_href(object),
                 },
             )
             for object
-            in types[key](q)
+            in search_for(q)
         ))
 
     return render_template('management/search.html', q=q, result=result, title=repr(q))
@@ -90,13 +145,20 @@ def search():
 
 @app.route('/sales-channels')
 def sales_channels():
-    objects = module.get('sales_channel').get_sales_channels()
+    objects = module.get('sales_channel').get_sales_channels(
+        limit=PAGE_SIZE,
+        after=request.args.get('after', default=None, type=str),
+    )
     objects = [
         merge(object, {'href': url_for('edit_sales_channel', uuid=object['uuid'])})
         for object
         in objects
     ]
-    return render_template('management/sales_channels/index.html', objects=objects)
+    return render_template(
+        'management/sales_channels/index.html',
+        objects=objects,
+        next_url=next_page_url('sales_channels', objects),
+    )
 
 
 @app.route('/sales-channels/create', methods=['GET', 'POST'])
@@ -121,8 +183,11 @@ def create_sales_channel():
 
 @app.route('/sales-channels/<string:uuid>', methods=['GET', 'POST'])
 def edit_sales_channel(uuid):
-    schema = module.get('sales_channel').get_sales_channel_schema('update')
-    object, messages = module.get('sales_channel').get_sales_channel(uuid)
+    sales_channel = module.get('sales_channel')
+    with sales_channel.batch():
+        schema = sales_channel.get_sales_channel_schema('update')
+        response = sales_channel.get_sales_channel(uuid)
+    schema, (object, messages) = schema.result(), response.result()
     schema = enhance_schema_with_data(object, schema)
 
     flash_many(messages)
@@ -161,14 +226,25 @@ def delete_sales_channel(uuid):
 
 @app.route('/products')
 def products():
-    schema = module.get('product').get_product_schema('create')
-    objects = module.get('product').get_products()
+    product = module.get('product')
+    with product.batch():
+        schema = product.get_product_schema('create')
+        objects = product.get_products(
+            limit=PAGE_SIZE,
+            after=request.args.get('after', default=None, type=str),
+        )
+    schema, objects = schema.result(), objects.result()
     objects = [
         merge(object, {'href': url_for('edit_product', uuid=object['uuid'])})
         for object
         in objects
     ]
-    return render_template('management/products/index.html', objects=objects, schema=schema)
+    return render_template(
+        'management/products/index.html',
+        objects=objects,
+        schema=schema,
+        next_url=next_page_url('products', objects),
+    )
 
 
 def flash_many(messages):
@@ -179,6 +255,16 @@ def flash_many(messages):
             flash(message)
 
 
+@app.route('/products/attribute-values/<string:attribute_name>')
+def attribute_values(attribute_name):
+    return jsonify(module.get('product').search_attribute_values(
+        attribute_name,
+        prefix=request.args.get('q', default='', type=str),
+        offset=request.args.get('offset', default=0, type=int),
+        limit=request.args.get('limit', default=20, type=int),
+    ))
+
+
 @app.route('/products/create', methods=['GET', 'POST'])
 def create_product():
     if request.method == 'POST':
@@ -193,8 +279,11 @@ def create_product():
 
 @app.route('/products/<string:uuid>', methods=['GET', 'POST'])
 def edit_product(uuid):
-    schema = module.get('product').get_product_schema('update')
-    object, messages = module.get('product').get_product(uuid)
+    product = module.get('product')
+    with product.batch():
+        schema = product.get_product_schema('update')
+        response = product.get_product(uuid)
+    schema, (object, messages) = schema.result(), response.result()
 
     flash_many(messages)
 
@@ -230,7 +319,20 @@ def delete_product(uuid):
 
 @app.route('/supply-chain')
 def supply_chain():
-    return render_template('management/supply_chain/index.html')
+    topology, version = module.get('commerce_engine').sync_topology()
+    return render_template('management/supply_chain/index.html', topology=topology)
+
+
+@app.route('/supply-chain/topology')
+def supply_chain_topology():
+    # Deltas only ever answer ?since=, so a cached full topology is never replaced by one.
+    reply = module.get('commerce_engine').get_topology(request.args.get('since'))
+    if request.if_none_match.contains(reply['version']):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(reply)
+    response.set_etag(reply['version'])
+    return response
 
 
 @app.route('/_health')
@@ -239,8 +341,14 @@ def health():
 
 
 if __name__ == '__main__':
-    app.run(
-        host=host,
-        port=port,
+    setup_database()
+    serve(
+        app,
+        module.address,
         debug=module.debug,
+        server=module.server,
+        workers=module.workers,
+        threads=module.threads,
+        post_fork=post_fork,
+        worker_exit=worker_exit,
     )
@@ -1,12 +1,39 @@
+import os
 import re
 import sys
+import json
+import time
+import atexit
+import logging
+import select
+import asyncio
+import threading
 
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps, partial
 from importlib import import_module
 from urllib.parse import parse_qsl
+from weakref import WeakKeyDictionary
 
+import aiohttp
+import msgpack
+import psycopg2
 import requests
-from flask import Flask, request, jsonify
+from aiohttp import web
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request
+from gunicorn.app.base import BaseApplication
+from peewee import Expression, Field, fn
+from playhouse.postgres_ext import TS_MATCH
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.serving import WSGIRequestHandler
+
+
+logger = logging.getLogger(__name__)
 
 
 def validate(data, schema, name=''):
@@ -27,7 +54,9 @@ def validate(data, schema, name=''):
             errors.extend(validate(data.get(key), subschema, subschema.get('name', key)))
     elif type == 'string':
         sys.stdout.flush()
-        if not schema.get('optional', False) and not data:
+        if data is not None and not isinstance(data, str):
+            errors.append('{!r} must be a string'.format(name))
+        elif not schema.get('optional', False) and not data:
             errors.append('{!r} must be something'.format(name))
 
     return errors
@@ -86,38 +115,520 @@ def parse_advanced_qs(qs):
     return parse_dicts_as_lists(root)
 
 
-def procedure(method):
+def filter_query(query, model, filters):
+    if filters:
+        query = query.where(*(
+            getattr(model, keyword) == argument
+            for keyword, argument
+            in filters.items()
+        ))
+    return query
+
+
+def paginate(query, model, limit=None, after=None):
+    if after is not None:
+        query = query.where(model.id > model.select(model.id).where(model.uuid == after))
+    query = query.order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def aggregate(query, model, count_by=None, min=(), max=()):
+    min, max = [min] if isinstance(min, str) else list(min), [max] if isinstance(max, str) else list(max)
+    for field_name in [count_by] * bool(count_by) + min + max:
+        if not isinstance(getattr(model, field_name, None), Field):
+            raise ValueError('{} has no field {!r}'.format(model.__name__, field_name))
+
+    query = query.order_by()
+    row = query.select(
+        fn.COUNT(model.id),
+        *(fn.MIN(getattr(model, field_name)) for field_name in min),
+        *(fn.MAX(getattr(model, field_name)) for field_name in max),
+    ).tuples().get()
+    values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in row[1:]]
+
+    result = {
+        'count': row[0],
+        'min': dict(zip(min, values[:len(min)])),
+        'max': dict(zip(max, values[len(min):])),
+    }
+    if count_by:
+        field, count = getattr(model, count_by), fn.COUNT(model.id)
+        result['count_by'] = [
+            list(group)
+            for group
+            in query.select(field, count).group_by(field).order_by(count.desc(), field).tuples()
+        ]
+    return result
+
+
+SEARCH_CONFIG = 'english'
+
+
+def make_search_vector(*parts):
+    vector = None
+    for text, weight in parts:
+        part = fn.setweight(fn.to_tsvector(SEARCH_CONFIG, fn.COALESCE(text, '')), weight)
+        vector = part if vector is None else vector.concat(part)
+    return vector
+
+
+def make_search_query(q):
+    terms = re.findall(r'\w+', q or '')
+    if not terms:
+        return None
+    # Every term is matched as a prefix so that results follow the search box as it's typed.
+    return fn.to_tsquery(SEARCH_CONFIG, ' & '.join(term + ':*' for term in terms))
+
+
+def search_query(query, model, q):
+    ts_query = make_search_query(q)
+    if ts_query is None:
+        return query.order_by(model.id)
+    return query.where(
+        Expression(model.search_vector, TS_MATCH, ts_query)
+    ).order_by(
+        fn.ts_rank(model.search_vector, ts_query).desc(),
+        model.id,
+    )
+
+
+def prefetch_related(objects):
+    objects = list(objects)
+    if objects and hasattr(type(objects[0]), 'load_related'):
+        type(objects[0]).load_related(objects)
+    return objects
+
+
+def dump_exception(exception):
+    return {
+        'raise': {
+            'module': type(exception).__module__,
+            'name': type(exception).__name__,
+            'args': list(exception.args),
+        },
+    }
+
+
+def load_response(response):
+    if 'raise' in response:
+        raised = response['raise']
+        exception_module = import_module(raised['module'])
+        exception_class = getattr(exception_module, raised['name'])
+        exception = exception_class(*raised['args'])
+        raise exception
+    return response['return']
+
+
+def make_cache_key(method_name, args, kwargs):
+    return method_name, json.dumps([args, kwargs], sort_keys=True, default=str)
+
+
+class ProcedureCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        # Bumped by invalidations, so that a result computed across one is not stored.
+        self.generations = {}
+        self.clears = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def generation(self, method_name):
+        with self.lock:
+            return self.clears, self.generations.get(method_name, 0)
+
+    def set(self, key, value, ttl, generation=None):
+        with self.lock:
+            if generation is not None and generation != (self.clears, self.generations.get(key[0], 0)):
+                return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, method_names):
+        with self.lock:
+            for method_name in method_names:
+                self.generations[method_name] = self.generations.get(method_name, 0) + 1
+            for key in [key for key in self.entries if key[0] in method_names]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.clears += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def observe(self, version):
+        if version is not None and version > self.version:
+            self.clear()
+            self.version = version
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class InvalidationBus:
+    channel = 'procedure_cache'
+    # Postgres rejects NOTIFY payloads of 8000 bytes or more.
+    max_payload_size = 7900
+
+    def __init__(self):
+        self.modules = []
+        self.watchers = []
+        self.database = None
+        self.pid = None
+
+    def subscribe(self, module):
+        self.modules.append(module)
+
+    def watch(self, callback):
+        self.watchers.append(callback)
+
+    def connect(self, database):
+        self.database = database
+
+    def publish(self, module_name, method_names, version, payload=None):
+        if self.database is None:
+            self.deliver(module_name, method_names, version, payload)
+            return
+        self.listen()
+        # Published inside a transaction, the notification goes out on commit, in commit order.
+        message = json.dumps([module_name, list(method_names), version, payload])
+        if len(message) > self.max_payload_size:
+            # Receivers treat a missing payload as "reload everything".
+            message = json.dumps([module_name, list(method_names), version, None])
+        self.database.execute_sql('SELECT pg_notify(%s, %s)', (self.channel, message))
+
+    def deliver(self, module_name, method_names, version, payload=None):
+        for module in self.modules:
+            if module.name == module_name:
+                module.invalidated(method_names, version, payload)
+        # Watchers run after the modules so that they see refreshed procedure caches.
+        for callback in self.watchers:
+            callback(module_name, method_names, version, payload)
+
+    def listen(self):
+        # The listener thread doesn't survive a fork, so every worker starts its own.
+        if self.database is None or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        connection = psycopg2.connect(dbname=self.database.database, **self.database.connect_params)
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        connection.cursor().execute('LISTEN ' + self.channel)
+        while True:
+            if select.select([connection], [], [], 5) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                self.deliver(*json.loads(connection.notifies.pop(0).payload))
+
+
+invalidation_bus = InvalidationBus()
+
+
+class EventLoopThread:
+    def __init__(self):
+        self.loop = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+        with self.lock:
+            # The loop's thread doesn't survive a fork, so every worker starts its own.
+            if self.loop is None or self.pid != os.getpid():
+                self.loop, self.pid = asyncio.new_event_loop(), os.getpid()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+                atexit.register(self.close)
+            return self.loop
+
+    def close(self):
+        if self.loop is not None and self.pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(close_async_sessions(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coroutine):
+        loop = self.get_loop()
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            coroutine.close()
+            raise RuntimeError('blocking call from the event loop thread, await it through .aio instead')
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def close_async_sessions():
+    for module in invalidation_bus.modules:
+        await module.close_async()
+
+
+# Sync callers run their coroutines here, so that each worker has one loop and one aiohttp session per module.
+event_loop = EventLoopThread()
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - started_at
+
+    def first_request(self, *args):
+        if 'first_request' not in self.timings:
+            self.timings['first_request'] = time.perf_counter() - self.started_at
+            logger.info('startup: %s', ', '.join(
+                '{} {:.3f}s'.format(name, seconds)
+                for name, seconds
+                in self.timings.items()
+            ))
+
+
+startup_timer = StartupTimer()
+
+
+class Call:
+    def __init__(self, body, idempotent=False, response=None, cache_key=None, ttl=None, invalidates=(), generation=None):
+        self.body = body
+        self.idempotent = idempotent
+        self.response = response
+        self.cache_key = cache_key
+        self.ttl = ttl
+        self.invalidates = invalidates
+        self.generation = generation
+
+    def result(self):
+        if self.response is None:
+            raise RuntimeError('{!r} has not been flushed yet'.format(self.body['method_name']))
+        return load_response(self.response)
+
+
+def procedure(method=None, idempotent=False, cache=None, invalidates=()):
+    if method is None:
+        return lambda method: procedure(method, idempotent=idempotent, cache=cache, invalidates=invalidates)
+
+    idempotent = idempotent or cache is not None
+
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            if self.remote:
+                return await self.call_async(method.__name__, *args, **kwargs)
+            return await method(self, *args, **kwargs)
+        async_wrapper.idempotent = idempotent
+        async_wrapper.cache = cache
+        async_wrapper.invalidates = invalidates
+        return async_wrapper
+
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        if self.remote:
-            response = requests.post(
-                'http://' + self.address,
-                json={
-                    'method_name': method.__name__,
-                    'args': list(args),
-                    'kwargs': dict(kwargs),
-                },
-            )
-            response = response.json()
-            if 'raise' in response:
-                raised = response['raise']
-                exception_module = import_module(raised['module'])
-                exception_class = getattr(exception_module, raised['name'])
-                exception = exception_class(*raised['args'])
-                raise exception
-            return response['return']
-        return method(self, *args, **kwargs)
+        batch = getattr(self.local, 'batch', None)
+        cache_key = generation = None
+        if cache is not None:
+            cache_key = make_cache_key(method.__name__, args, kwargs)
+            hit, value = self.cache.get(cache_key)
+            if hit:
+                return Call(None, response={'return': value}) if batch is not None else value
+            generation = self.cache.generation(method.__name__)
+        if not self.remote and batch is None:
+            # In-process calls hand back the callee's objects without copying or
+            # serializing them. Results are shared: treat them as read-only and
+            # copy before mutating.
+            result = method(self, *args, **kwargs)
+            if cache_key is not None or invalidates:
+                self.complete(Call(
+                    None,
+                    response={'return': result},
+                    cache_key=cache_key,
+                    ttl=cache,
+                    invalidates=invalidates,
+                    generation=generation,
+                ))
+            return result
+        call = Call(
+            {
+                'method_name': method.__name__,
+                'args': list(args),
+                'kwargs': dict(kwargs),
+            },
+            idempotent=idempotent,
+            cache_key=cache_key,
+            ttl=cache,
+            invalidates=invalidates,
+            generation=generation,
+        )
+        if batch is not None:
+            if self.remote:
+                batch.append(call)
+            else:
+                # The method runs right away, so the calls it makes on this module must too.
+                self.local.batch = None
+                try:
+                    call.response = {'return': method(self, *args, **kwargs)}
+                except Exception as exception:
+                    call.response = dump_exception(exception)
+                finally:
+                    self.local.batch = batch
+                self.complete(call)
+            return call
+        response = self.post(call.body, retries=self.retries if idempotent else 0)
+        self.cache.observe(response.get('version'))
+        call.response = response
+        self.complete(call)
+        return call.result()
+    wrapper.idempotent = idempotent
+    wrapper.cache = cache
+    wrapper.invalidates = invalidates
     return wrapper
 
 
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+class GunicornApplication(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def serve(app, address, debug=False, server='flask', workers=1, threads=1, graceful_timeout=30, **hooks):
+    host, port = address.split(':')
+    app.before_request(startup_timer.first_request)
+    if server == 'gunicorn':
+        GunicornApplication(app, dict(
+            bind=address,
+            workers=workers,
+            threads=threads,
+            worker_class='gthread',
+            graceful_timeout=graceful_timeout,
+            reload=debug,
+            **hooks,
+        )).run()
+    else:
+        app.run(
+            host=host,
+            port=int(port),
+            debug=debug,
+            request_handler=KeepAliveRequestHandler,
+        )
+
+
+class JSONCodec:
+    content_type = 'application/json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=str).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgPackCodec:
+    content_type = 'application/msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, default=str, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# JSON comes first so browsers and curl, which accept */*, keep getting JSON.
+CODECS = {
+    codec.content_type: codec
+    for codec
+    in (JSONCodec(), MsgPackCodec())
+}
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def get_codec(content_type):
+    content_type = (content_type or '').split(';')[0].strip()
+    return CODECS.get(content_type, CODECS[JSONCodec.content_type])
+
+
+def negotiate_codec(accept):
+    content_type = parse_accept_header(accept, MIMEAccept).best_match(CODECS, default=JSONCodec.content_type)
+    return CODECS[content_type]
+
+
+class AsyncModule:
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        return partial(self.module.call_async, name)
+
+
 class Module:
     parent_module = None
     name = ''
+    models = ()
     remote = False
     address = '127.0.0.1:5000'
     modules = {}
     is_master_module = False
     debug = False
+    pool_size = 10
+    connect_timeout = 3.05
+    read_timeout = 30
+    retries = 3
+    backoff_factor = 0.1
+    codec = MsgPackCodec.content_type
+    server = 'flask'
+    workers = 1
+    # Modules whose state lives in their process alone cap the number of workers serving them.
+    max_workers = None
+    threads = 10
+    cache_size = 1024
 
     def __init__(self, **kwargs):
         self.parent_module = kwargs.get('parent_module', self.parent_module)
@@ -127,6 +638,190 @@ class Module:
         self.modules = kwargs.get('modules', self.modules.copy())
         self.is_master_module = kwargs.get('is_master_module', self.is_master_module)
         self.debug = kwargs.get('debug', self.debug)
+        self.pool_size = kwargs.get('pool_size', self.pool_size)
+        self.connect_timeout = kwargs.get('connect_timeout', self.connect_timeout)
+        self.read_timeout = kwargs.get('read_timeout', self.read_timeout)
+        self.retries = kwargs.get('retries', self.retries)
+        self.backoff_factor = kwargs.get('backoff_factor', self.backoff_factor)
+        self.codec = kwargs.get('codec', self.codec)
+        self.server = kwargs.get('server', self.server)
+        self.workers = kwargs.get('workers', self.workers)
+        self.threads = kwargs.get('threads', self.threads)
+        self.cache_size = kwargs.get('cache_size', self.cache_size)
+        self.session = self.make_session()
+        self.async_sessions = WeakKeyDictionary()
+        self.local = threading.local()
+        self.cache = ProcedureCache(maxsize=self.cache_size)
+        self.lazy_modules = {}
+        self.lazy_lock = threading.Lock()
+        invalidation_bus.subscribe(self)
+
+    def complete(self, call):
+        if 'return' not in call.response:
+            return
+        if call.cache_key is not None:
+            self.cache.set(call.cache_key, call.response['return'], call.ttl, call.generation)
+        if call.invalidates:
+            self.invalidate(call.invalidates)
+
+    def invalidate(self, method_names, payload=None):
+        self.cache.invalidate(method_names)
+        if not self.remote:
+            self.cache.version = max(self.cache.version + 1, time.time())
+            invalidation_bus.publish(self.name, method_names, self.cache.version, payload)
+
+    def invalidated(self, method_names, version, payload=None):
+        self.cache.invalidate(method_names)
+        if not self.remote:
+            self.cache.version = max(self.cache.version, version)
+
+    def make_session(self):
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+        ))
+        return session
+
+    def post(self, body, retries=0):
+        return event_loop.run(self.post_async(body, retries=retries))
+
+    def get_async_session(self):
+        loop = asyncio.get_running_loop()
+        session = self.async_sessions.get(loop)
+        if session is None:
+            session = self.async_sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                ),
+            )
+        return session
+
+    async def close_async(self):
+        session = self.async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def post_async(self, body, retries=0):
+        session = self.get_async_session()
+        codec = get_codec(self.codec)
+        data = codec.dumps(body)
+        for attempt in range(retries + 1):
+            try:
+                async with session.post(
+                    'http://' + self.address,
+                    data=data,
+                    headers={
+                        'Content-Type': codec.content_type,
+                        'Accept': codec.content_type,
+                    },
+                ) as response:
+                    return get_codec(response.content_type).loads(await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def call_async(self, method_name, *args, **kwargs):
+        method = getattr(self, method_name)
+        if not self.remote:
+            if asyncio.iscoroutinefunction(method):
+                return await method(*args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, partial(method, *args, **kwargs))
+
+        ttl = getattr(method, 'cache', None)
+        cache_key = generation = None
+        if ttl is not None:
+            cache_key = make_cache_key(method_name, args, kwargs)
+            hit, value = self.cache.get(cache_key)
+            if hit:
+                return value
+            generation = self.cache.generation(method_name)
+
+        call = Call(
+            {
+                'method_name': method_name,
+                'args': list(args),
+                'kwargs': dict(kwargs),
+            },
+            cache_key=cache_key,
+            ttl=ttl,
+            invalidates=getattr(method, 'invalidates', ()),
+            generation=generation,
+        )
+        call.response = await self.post_async(
+            call.body,
+            retries=self.retries if getattr(method, 'idempotent', False) else 0,
+        )
+        self.cache.observe(call.response.get('version'))
+        self.complete(call)
+        return call.result()
+
+    def pages(self, method_name, *args, page_size=100, **kwargs):
+        after = kwargs.pop('after', None)
+        while True:
+            page = getattr(self, method_name)(*args, limit=page_size, after=after, **kwargs)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = page[-1]['uuid']
+
+    def stream(self, method_name, *args, page_size=100, **kwargs):
+        if not self.remote:
+            for page in self.pages(method_name, *args, page_size=page_size, **kwargs):
+                yield from page
+            return
+
+        codec = get_codec(self.codec)
+        response = self.session.post(
+            'http://' + self.address,
+            data=codec.dumps({
+                'method_name': method_name,
+                'args': list(args),
+                'kwargs': dict(kwargs),
+                'stream': page_size,
+            }),
+            headers={
+                'Content-Type': codec.content_type,
+                'Accept': NDJSON,
+            },
+            timeout=(self.connect_timeout, self.read_timeout),
+            stream=True,
+        )
+        with response:
+            for line in response.iter_lines():
+                if line:
+                    yield from load_response(json.loads(line))
+
+    @property
+    def aio(self):
+        return AsyncModule(self)
+
+    @contextmanager
+    def batch(self):
+        if getattr(self.local, 'batch', None) is not None:
+            yield
+            return
+
+        calls = self.local.batch = []
+        try:
+            yield
+        finally:
+            self.local.batch = None
+
+        if calls:
+            response = self.post(
+                {'batch': [call.body for call in calls]},
+                retries=self.retries if all(call.idempotent for call in calls) else 0,
+            )
+            self.cache.observe(response.get('version'))
+            for call, call_response in zip(calls, response['batch']):
+                call.response = call_response
+                self.complete(call)
 
     def install(self, module, **kwargs):
         if isinstance(module, type):
@@ -134,7 +829,18 @@ class Module:
         self.modules[module.name] = module
         return module
 
+    def install_lazy(self, module_name, load_class, **kwargs):
+        # The module's code is only imported once something asks for it.
+        self.lazy_modules[module_name] = lambda: self.install(load_class(), **kwargs)
+
     def get(self, module_name):
+        if module_name == self.name:
+            return self
+        if module_name in self.lazy_modules:
+            with self.lazy_lock:
+                if module_name in self.lazy_modules:
+                    self.lazy_modules[module_name]()
+                    del self.lazy_modules[module_name]
         module = self.modules.get(module_name, self.parent_module.get(module_name) if self.parent_module is not None else None)
         if module is None:
             raise NotImplementedError('module {!r} not found. Did you remember to install it?'.format(module_name))
@@ -145,11 +851,14 @@ class Module:
             'name': self.name,
             'remote': self.remote,
             'address': self.address,
+            'cache': self.cache.stats(),
+            'startup': dict(startup_timer.timings),
             'modules': {
                 name: module.get_description()
                 for name, module
                 in self.modules.items()
             },
+            'lazy_modules': sorted(self.lazy_modules),
         }
 
         return description
@@ -164,30 +873,119 @@ class Module:
         return module
 
     def route(self, path='/'):
+        codec = negotiate_codec(request.headers.get('Accept'))
         try:
             module = self.get_nested_module(path)
             if request.method == 'GET':
-                return jsonify(module.get_description())
-            body = request.json
-            return jsonify({'return': getattr(self, body['method_name'])(*body['args'], **body['kwargs'])})
+                response, status = module.get_description(), 200
+            else:
+                body = get_codec(request.mimetype).loads(request.get_data())
+                if 'stream' in body:
+                    return Response(self.stream_lines(body), mimetype=NDJSON)
+                if 'batch' in body:
+                    response, status = {'batch': [self.call(call) for call in body['batch']]}, 200
+                else:
+                    response, status = {'return': self.dispatch(body)}, 200
+                response['version'] = self.cache.version
+        except Exception as exception:
+            response, status = dump_exception(exception), 500
+        return Response(codec.dumps(response), status=status, mimetype=codec.content_type)
+
+    def dispatch(self, body):
+        result = getattr(self, body['method_name'])(*body['args'], **body['kwargs'])
+        if asyncio.iscoroutine(result):
+            result = event_loop.run(result)
+        return result
+
+    def call(self, body):
+        try:
+            return {'return': self.dispatch(body)}
+        except Exception as exception:
+            return dump_exception(exception)
+
+    async def handle(self, request):
+        codec = negotiate_codec(request.headers.get('Accept'))
+        try:
+            module = self.get_nested_module(request.match_info.get('path', ''))
+            if request.method == 'GET':
+                response, status = module.get_description(), 200
+            else:
+                body = get_codec(request.content_type).loads(await request.read())
+                if 'stream' in body:
+                    return await self.handle_stream(request, body)
+                if 'batch' in body:
+                    response, status = {'batch': [await self.call_async_body(call) for call in body['batch']]}, 200
+                else:
+                    response, status = {'return': await self.dispatch_async(body)}, 200
+                response['version'] = self.cache.version
+        except Exception as exception:
+            response, status = dump_exception(exception), 500
+        return web.Response(body=codec.dumps(response), status=status, content_type=codec.content_type)
+
+    async def handle_stream(self, request, body):
+        response = web.StreamResponse(headers={'Content-Type': NDJSON})
+        await response.prepare(request)
+        loop, lines = asyncio.get_running_loop(), self.stream_lines(body)
+        while True:
+            line = await loop.run_in_executor(None, next, lines, None)
+            if line is None:
+                break
+            await response.write(line)
+        await response.write_eof()
+        return response
+
+    def stream_lines(self, body):
+        codec = CODECS[JSONCodec.content_type]
+        try:
+            for page in self.pages(body['method_name'], *body['args'], page_size=body['stream'], **body['kwargs']):
+                yield codec.dumps({'return': page}) + b'\n'
         except Exception as exception:
-            return jsonify({
-                'raise': {
-                    'module': type(exception).__module__,
-                    'name': type(exception).__name__,
-                    'args': list(exception.args),
-                },
-            }), 500
-
-    def start(self):
-        host, port = self.address.split(':')
+            yield codec.dumps(dump_exception(exception)) + b'\n'
+
+    async def dispatch_async(self, body):
+        return await self.call_async(body['method_name'], *body['args'], **body['kwargs'])
+
+    async def call_async_body(self, body):
+        try:
+            return {'return': await self.dispatch_async(body)}
+        except Exception as exception:
+            return dump_exception(exception)
+
+    def make_web_app(self):
+        async def set_default_executor(app):
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.threads))
+
+        async def record_first_request(request, response):
+            startup_timer.first_request()
+
+        app = web.Application()
+        app.on_startup.append(set_default_executor)
+        app.on_cleanup.append(lambda app: close_async_sessions())
+        app.on_response_prepare.append(record_first_request)
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        return app
+
+    def start(self, **hooks):
+        if self.server == 'aiohttp':
+            host, port = self.address.split(':')
+            web.run_app(self.make_web_app(), host=host, port=int(port))
+            return
+
         flask = Flask(__name__)
         flask.route('/', methods=['GET', 'POST'])(self.route)
         flask.route(
             '/<path:path>',
             methods=['GET', 'POST']
         )(self.route)
-        flask.run(host=host, port=int(port), debug=self.debug)
+        serve(
+            flask,
+            self.address,
+            debug=self.debug,
+            server=self.server,
+            workers=self.workers,
+            threads=self.threads,
+            **hooks,
+        )
 
     def __repr__(self):
         return '<' + self.__class__.__name__ + ' ' + repr(self.name) + '>'
@@ -1,6 +1,17 @@
+import os
+import sys
+import time
+import atexit
+import signal
+import threading
+import traceback
+
+from array import array
+
 from modules.base import Module, procedure
 
 import peewee
+from peewee import EXCLUDED, Case
 
 
 class CartItem(peewee.Model):
@@ -23,60 +34,363 @@ class CartItem(peewee.Model):
         }
 
 
-class CartModule(Module):
-    name = 'cart'
+ADD = 'add'
+REMOVE = 'remove'
+SET = 'set'
 
-    @procedure
-    def add_item_to_cart(self, sales_channel_id, customer_id, article_id, quantity=1):
-        cart_item, created = CartItem.get_or_create(
-            sales_channel_id=sales_channel_id,
-            customer_id=customer_id,
-            article_id=article_id,
-            defaults={'quantity': quantity},
-        )
+# Largest quantity CartItem.quantity (a SMALLINT) can hold.
+MAX_QUANTITY = 32767
 
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save(only=cart_item.dirty_fields)
 
-        return cart_item.quantity
+def fold_cart_operations(ops):
+    # Each article ends up either assigned a known quantity or mapped to max(quantity + a, b).
+    assignments, increments = {}, {}
 
-    @procedure
-    def remove_item_from_cart(self, sales_channel_id, customer_id, article_id, quantity=1):
-        cart_item, created = CartItem.get_or_create(
+    for op in ops:
+        article_id, type, quantity = op['article_id'], op.get('type', ADD), int(op.get('quantity', 1))
+        if type == SET:
+            increments.pop(article_id, None)
+            assignments[article_id] = max(quantity, 0)
+            continue
+        if type == REMOVE:
+            quantity = -quantity
+        elif type != ADD:
+            raise ValueError('unknown cart operation type {!r}'.format(type))
+        if article_id in assignments:
+            assignments[article_id] = max(assignments[article_id] + quantity, 0)
+        else:
+            a, b = increments.get(article_id, (0, 0))
+            increments[article_id] = (a + quantity, max(b + quantity, 0))
+
+    return assignments, increments
+
+
+def upsert_cart_items(sales_channel_id, customer_id, rows, quantity):
+    CartItem.insert_many([
+        dict(
             sales_channel_id=sales_channel_id,
             customer_id=customer_id,
             article_id=article_id,
-            defaults={'quantity': quantity},
+            quantity=article_quantity,
         )
+        for article_id, article_quantity
+        in rows
+    ]).on_conflict(
+        conflict_target=[CartItem.sales_channel_id, CartItem.customer_id, CartItem.article_id],
+        update={CartItem.quantity: quantity},
+    ).execute()
+
+
+def delete_cart_items(sales_channel_id, customer_id, article_ids, *conditions):
+    CartItem.delete().where(
+        CartItem.sales_channel_id == sales_channel_id,
+        CartItem.customer_id == customer_id,
+        CartItem.article_id.in_(article_ids),
+        *conditions
+    ).execute()
+
+
+class MemoryCartStore:
+    flush_interval = 1.0
+    batch_size = 500
+    max_idle = 3600
+
+    def __init__(self, **kwargs):
+        self.flush_interval = kwargs.get('flush_interval', self.flush_interval)
+        self.batch_size = kwargs.get('batch_size', self.batch_size)
+        self.max_idle = kwargs.get('max_idle', self.max_idle)
+        # Carts are flat arrays of (article index, quantity) pairs; article ids are stored once.
+        self.carts = {}
+        self.accessed = {}
+        self.dirty = {}
+        self.article_ids = []
+        self.article_indexes = {}
+        self.lock = threading.RLock()
+        # Held across a flush's swap and write: a shutdown flush must not return while a timer flush
+        # still writes the carts it took, and an older snapshot must not land after a newer one.
+        # Reentrant, since SIGTERM can arrive while the main thread flushes.
+        self.flush_lock = threading.RLock()
+        self.pid = None
+        self.last_flush_at = None
+        self.last_flush_duration = None
+        self.flushed = 0
+
+    def get_article_index(self, article_id):
+        if article_id not in self.article_indexes:
+            self.article_indexes[article_id] = len(self.article_ids)
+            self.article_ids.append(article_id)
+        return self.article_indexes[article_id]
+
+    def load(self, key):
+        with self.lock:
+            if key in self.carts:
+                self.accessed[key] = time.monotonic()
+                return self.carts[key]
+
+        # Queried without the lock, so a cold cart doesn't stall every other one.
+        rows = list(CartItem.select(CartItem.article_id, CartItem.quantity).where(
+            CartItem.sales_channel_id == key[0],
+            CartItem.customer_id == key[1],
+        ).order_by(CartItem.id).tuples())
+
+        with self.lock:
+            # Another request may have loaded and changed the cart in the meantime.
+            if key not in self.carts:
+                cart = array('l')
+                for article_id, quantity in rows:
+                    cart.extend((self.get_article_index(article_id), quantity))
+                self.carts[key] = cart
+            self.accessed[key] = time.monotonic()
+            return self.carts[key]
+
+    def to_list(self, key, cart):
+        # Articles taken down to zero stay in the array until a flush has deleted their rows.
+        return [
+            {
+                'sales_channel_id': key[0],
+                'customer_id': key[1],
+                'article_id': self.article_ids[cart[i]],
+                'quantity': cart[i + 1],
+            }
+            for i
+            in range(0, len(cart), 2)
+            if cart[i + 1] > 0
+        ]
+
+    def get_removed(self, cart):
+        return {cart[i] for i in range(0, len(cart), 2) if cart[i + 1] <= 0}
+
+    def get(self, sales_channel_id, customer_id):
+        key = (sales_channel_id, customer_id)
+        cart = self.load(key)
+        with self.lock:
+            return self.to_list(key, cart)
+
+    def apply(self, sales_channel_id, customer_id, ops):
+        key = (sales_channel_id, customer_id)
+        assignments, increments = fold_cart_operations(ops)
+        self.start()
+        cart = self.load(key)
+        with self.lock:
+            positions = {cart[i]: i + 1 for i in range(0, len(cart), 2)}
+            quantities = {}
+            for article_id in list(assignments) + list(increments):
+                article_index = self.get_article_index(article_id)
+                if article_id in assignments:
+                    quantity = assignments[article_id]
+                else:
+                    a, b = increments[article_id]
+                    quantity = max((cart[positions[article_index]] if article_index in positions else 0) + a, b)
+                # Checked before anything changes, since the flusher would retry a row it can't write forever.
+                if quantity > MAX_QUANTITY:
+                    raise ValueError('cart item quantity {} exceeds {}'.format(quantity, MAX_QUANTITY))
+                quantities[article_index] = quantity
+            for article_index, quantity in quantities.items():
+                if article_index not in positions:
+                    if quantity <= 0:
+                        continue
+                    positions[article_index] = len(cart) + 1
+                    cart.extend((article_index, 0))
+                cart[positions[article_index]] = quantity
+            self.dirty.setdefault(key, time.monotonic())
+            return self.to_list(key, cart)
+
+    def start(self):
+        # Like the invalidation listener, the flusher thread has to be restarted after a fork.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def install_signal_handler(self):
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            self.flush()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                # Terminate the way the signal would have, now that the carts are written.
+                signal.signal(signum, signal.SIG_DFL if previous is None else previous)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
 
-        if not created:
-            cart_item.quantity = max(cart_item.quantity - quantity, 0)
-            cart_item.save(only=cart_item.dirty_fields)
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
 
-        return cart_item.quantity
+    def flush(self):
+        with self.flush_lock:
+            return self.flush_dirty()
+
+    def flush_dirty(self):
+        started_at = time.monotonic()
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            carts = {key: self.to_list(key, self.carts[key]) for key in dirty}
+            removed = {key: self.get_removed(self.carts[key]) for key in dirty}
+            removed = {key: article_indexes for key, article_indexes in removed.items() if article_indexes}
+            for key, accessed_at in list(self.accessed.items()):
+                if key not in dirty and started_at - accessed_at > self.max_idle:
+                    del self.carts[key], self.accessed[key]
+
+        rows = [row for key in sorted(carts) for row in carts[key]]
+        if not rows and not removed:
+            return 0
+        try:
+            with CartItem._meta.database.atomic():
+                for batch in peewee.chunked(rows, self.batch_size):
+                    CartItem.insert_many(batch).on_conflict(
+                        conflict_target=[CartItem.sales_channel_id, CartItem.customer_id, CartItem.article_id],
+                        update={CartItem.quantity: EXCLUDED.quantity},
+                    ).execute()
+                for key, article_indexes in sorted(removed.items()):
+                    delete_cart_items(key[0], key[1], [self.article_ids[i] for i in article_indexes])
+        except Exception:
+            with self.lock:
+                for key, dirtied_at in dirty.items():
+                    self.dirty[key] = min(dirtied_at, self.dirty.get(key, dirtied_at))
+            raise
+
+        with self.lock:
+            # In place, since requests hold on to the arrays; only the articles whose rows were
+            # deleted above, and only if nothing put them back in the meantime.
+            for key, article_indexes in removed.items():
+                cart = self.carts.get(key)
+                if cart is not None:
+                    cart[:] = array('l', [
+                        value
+                        for i
+                        in range(0, len(cart), 2)
+                        if cart[i] not in article_indexes or cart[i + 1] > 0
+                        for value
+                        in (cart[i], cart[i + 1])
+                    ])
+
+        self.last_flush_at = time.monotonic()
+        self.last_flush_duration = self.last_flush_at - started_at
+        self.flushed += len(rows)
+
+        return len(rows)
+
+    def metrics(self):
+        now = time.monotonic()
+        with self.lock:
+            return dict(
+                carts=len(self.carts),
+                dirty=len(self.dirty),
+                flush_lag=now - min(self.dirty.values()) if self.dirty else 0,
+                last_flush_age=now - self.last_flush_at if self.last_flush_at is not None else None,
+                last_flush_duration=self.last_flush_duration,
+                flushed=self.flushed,
+                articles=len(self.article_ids),
+                memory=(
+                    sum(sys.getsizeof(cart) for cart in self.carts.values())
+                    + sys.getsizeof(self.carts)
+                    + sys.getsizeof(self.article_indexes)
+                    + sum(sys.getsizeof(article_id) for article_id in self.article_ids)
+                ),
+            )
+
+
+class CartModule(Module):
+    name = 'cart'
+    models = (CartItem,)
+    cart_store = 'database'
+
+    def __init__(self, *args, **kwargs):
+        self.cart_store = kwargs.pop('cart_store', None) or self.cart_store
+        super().__init__(*args, **kwargs)
+        self.memory_store = MemoryCartStore() if self.cart_store == 'memory' and not self.remote else None
+        if self.memory_store is not None:
+            # Carts live in the process until flushed, so a second worker would serve other copies.
+            self.max_workers = 1
+
+    def __post_init__(self, module_name):
+        if self.memory_store is not None and threading.current_thread() is threading.main_thread():
+            self.memory_store.install_signal_handler()
+
+    def shutdown(self):
+        if self.memory_store is not None:
+            self.memory_store.flush()
+
+    @procedure
+    def add_item_to_cart(self, sales_channel_id, customer_id, article_id, quantity=1):
+        return self.apply_cart_item_operation(sales_channel_id, customer_id, article_id, quantity, ADD)
 
     @procedure
+    def remove_item_from_cart(self, sales_channel_id, customer_id, article_id, quantity=1):
+        return self.apply_cart_item_operation(sales_channel_id, customer_id, article_id, quantity, REMOVE)
+
+    @procedure(idempotent=True)
     def set_cart_item_quantity(self, sales_channel_id, customer_id, article_id, quantity):
-        cart_item, created = CartItem.get_or_create(
-            sales_channel_id=sales_channel_id,
-            customer_id=customer_id,
-            article_id=article_id,
-            defaults={'quantity': quantity},
-        )
+        return self.apply_cart_item_operation(sales_channel_id, customer_id, article_id, quantity, SET)
 
-        if not created:
-            cart_item.quantity = max(quantity, 0)
-            cart_item.save(only=cart_item.dirty_fields)
+    def apply_cart_item_operation(self, sales_channel_id, customer_id, article_id, quantity, type):
+        cart_items = self.apply_cart_operations(sales_channel_id, customer_id, [
+            dict(article_id=article_id, quantity=quantity, type=type),
+        ])
 
-        return cart_item.quantity
+        for cart_item in cart_items:
+            if cart_item['article_id'] == article_id:
+                return cart_item['quantity']
+        return 0
 
     @procedure
+    def apply_cart_operations(self, sales_channel_id, customer_id, ops):
+        if self.memory_store is not None:
+            return self.memory_store.apply(sales_channel_id, customer_id, ops)
+
+        assignments, increments = fold_cart_operations(ops)
+
+        folds = {}
+        for article_id, fold in increments.items():
+            folds.setdefault(fold, []).append(article_id)
+
+        with CartItem._meta.database.atomic():
+            if assignments:
+                upsert_cart_items(sales_channel_id, customer_id, sorted(assignments.items()), EXCLUDED.quantity)
+            # One statement per distinct fold, since the update expression is shared by all rows.
+            for (a, b), article_ids in sorted(folds.items()):
+                upsert_cart_items(
+                    sales_channel_id,
+                    customer_id,
+                    [(article_id, max(a, b)) for article_id in sorted(article_ids)],
+                    Case(None, [(CartItem.quantity + a < b, b)], CartItem.quantity + a),
+                )
+            # Items taken down to zero leave the cart, rather than showing up as empty lines.
+            delete_cart_items(
+                sales_channel_id,
+                customer_id,
+                sorted(assignments.keys() | increments.keys()),
+                CartItem.quantity <= 0,
+            )
+
+            return self.get_customers_cart_items(sales_channel_id, customer_id)
+
+    @procedure(idempotent=True)
     def get_customers_cart_items(self, sales_channel_id, customer_id):
+        if self.memory_store is not None:
+            return self.memory_store.get(sales_channel_id, customer_id)
+
         customers_cart_items = []
 
         for cart_item in CartItem.select().where(
-            sales_channel_id=sales_channel_id,
-            customer_id=customer_id,
-        ):
+            CartItem.sales_channel_id == sales_channel_id,
+            CartItem.customer_id == customer_id,
+        ).order_by(CartItem.id):
             customers_cart_items.append(cart_item.to_dict())
+
+        return customers_cart_items
+
+    @procedure(idempotent=True)
+    def get_cart_store_metrics(self):
+        if self.memory_store is None:
+            return dict(store=self.cart_store)
+        return dict(store=self.cart_store, **self.memory_store.metrics())
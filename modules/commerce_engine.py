@@ -1,5 +1,259 @@
-from modules.base import Module
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from modules.base import Module, procedure, invalidation_bus
+
+
+TOPOLOGY = {
+    'sales_channel': 'get_sales_channels',
+    'supplier': 'get_suppliers',
+    'fulfillment_center': 'get_fulfillment_centers',
+    'warehouse': 'get_warehouses',
+}
+
+
+KINDS = (
+    'sales_channels',
+    'suppliers',
+    'fulfillment_centers',
+    'warehouses',
+)
+
+
+def make_topology(sales_channels, suppliers, fulfillment_centers, warehouses):
+    topology = {
+        kind: {entity['uuid']: entity for entity in entities}
+        for kind, entities
+        in zip(KINDS, (sales_channels, suppliers, fulfillment_centers, warehouses))
+    }
+    topology['counts'] = {kind: len(topology[kind]) for kind in KINDS}
+    return topology
+
+
+def make_topology_version(topology):
+    data = json.dumps([topology[kind] for kind in KINDS], sort_keys=True, default=str)
+    # Derived from the content, so that every process serving the topology agrees on versions.
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+def diff_topology(old, new):
+    return {
+        kind: {
+            'changed': {uuid: entity for uuid, entity in new[kind].items() if old[kind].get(uuid) != entity},
+            'removed': [uuid for uuid in old[kind] if uuid not in new[kind]],
+        }
+        for kind
+        in KINDS
+    }
+
+
+def apply_topology_delta(topology, delta):
+    topology = {kind: dict(topology[kind]) for kind in KINDS}
+    for kind in KINDS:
+        topology[kind].update(delta[kind]['changed'])
+        for uuid in delta[kind]['removed']:
+            topology[kind].pop(uuid, None)
+    topology['counts'] = {kind: len(topology[kind]) for kind in KINDS}
+    return topology
+
+
+class RoutingGraph:
+    def __init__(self, sales_channels, suppliers, fulfillment_centers):
+        suppliers = {supplier['uuid']: supplier for supplier in suppliers}
+        fulfillment_centers = {fulfillment_center['uuid']: fulfillment_center for fulfillment_center in fulfillment_centers}
+
+        # Every sales channel ships from its warehouses in supplier, then fulfillment center, ordering.
+        self.routes = {}
+        for sales_channel in sales_channels:
+            candidates, warehouse_ids = [], set()
+            for supplier_id in sales_channel['supplier_ids']:
+                for fulfillment_center_id in suppliers.get(supplier_id, {}).get('fulfillment_center_ids', []):
+                    fulfillment_center = fulfillment_centers.get(fulfillment_center_id)
+                    if fulfillment_center is None or fulfillment_center['warehouse_id'] in warehouse_ids:
+                        continue
+                    warehouse_ids.add(fulfillment_center['warehouse_id'])
+                    candidates.append(dict(
+                        warehouse=fulfillment_center['warehouse_id'],
+                        fulfillment_center=fulfillment_center_id,
+                        supplier=supplier_id,
+                    ))
+            self.routes[sales_channel['uuid']] = candidates
+
+
+def allocate(candidates, quantities, stock):
+    available = [
+        {
+            sku: stock[sku]['warehouses'].get(candidate['warehouse'], 0)
+            for sku
+            in quantities
+            if sku in stock
+        }
+        for candidate
+        in candidates
+    ]
+    covers = [
+        {sku for sku, quantity in quantities.items() if warehouse_stock.get(sku, 0) >= quantity}
+        for warehouse_stock
+        in available
+    ]
+
+    # Greedy set cover: ship whole lines from the warehouse that completes the most of them,
+    # preferring earlier warehouses on ties.
+    shipments, remaining = {}, set(quantities)
+    while remaining:
+        best, best_count = None, 0
+        for i, cover in enumerate(covers):
+            count = len(cover & remaining)
+            if count > best_count:
+                best, best_count = i, count
+        if best is None:
+            break
+        for sku in covers[best] & remaining:
+            shipments.setdefault(best, {})[sku] = quantities[sku]
+        remaining -= covers[best]
+
+    # Lines no single warehouse can complete are split, filling from warehouses already shipping first.
+    unallocated = {}
+    order = sorted(range(len(candidates)), key=lambda i: (i not in shipments, i))
+    for sku in sorted(remaining):
+        needed = quantities[sku]
+        for i in order:
+            quantity = min(needed, available[i].get(sku, 0))
+            if quantity > 0:
+                shipments.setdefault(i, {})[sku] = quantity
+                needed -= quantity
+            if not needed:
+                break
+        if needed:
+            unallocated[sku] = needed
+
+    return {
+        'shipments': [
+            dict(
+                candidates[i],
+                lines=[dict(sku=sku, quantity=quantity) for sku, quantity in sorted(shipments[i].items())],
+            )
+            for i
+            in sorted(shipments)
+        ],
+        'unallocated': [dict(sku=sku, quantity=quantity) for sku, quantity in sorted(unallocated.items())],
+        'splits': max(len(shipments) - 1, 0),
+    }
 
 
 class CommerceEngine(Module):
     name = 'commerce_engine'
+    topology_history_size = 100
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.topology = None
+        self.topology_version = None
+        # Bumped on every change; a refresh stores the generation it started from, so a change
+        # arriving while it fetches leaves the topology stale.
+        self.topology_generation = 1
+        self.topology_loaded_generation = 0
+        self.topology_generation_lock = threading.Lock()
+        self.topology_history = OrderedDict()
+        self.replica = None
+        self.replica_version = None
+        self.routing_graph = None
+        self.routing_graph_version = None
+        self.topology_lock = threading.RLock()
+        invalidation_bus.watch(self.watched)
+
+    def watched(self, module_name, method_names, version, payload=None):
+        if not self.remote and TOPOLOGY.get(module_name) in method_names:
+            self.mark_topology_stale()
+
+    def mark_topology_stale(self):
+        # Not the topology lock: the bus listener must not wait behind a refresh's RPCs.
+        with self.topology_generation_lock:
+            self.topology_generation += 1
+
+    def refresh_topology(self):
+        with self.topology_lock:
+            with self.topology_generation_lock:
+                generation = self.topology_generation
+            if generation != self.topology_loaded_generation:
+                topology = make_topology(*(
+                    getattr(self.get(module_name), method_name)()
+                    for module_name, method_name
+                    in TOPOLOGY.items()
+                ))
+                version = make_topology_version(topology)
+                if version != self.topology_version:
+                    if self.topology is not None:
+                        # Each version remembers how to get to its successor.
+                        self.topology_history[self.topology_version] = (version, diff_topology(self.topology, topology))
+                        while len(self.topology_history) > self.topology_history_size:
+                            self.topology_history.popitem(last=False)
+                    self.topology, self.topology_version = topology, version
+                self.topology_loaded_generation = generation
+            return self.topology, self.topology_version
+
+    def get_topology_deltas(self, since_version):
+        deltas, version = [], since_version
+        while version != self.topology_version:
+            if version not in self.topology_history:
+                return None
+            version, delta = self.topology_history[version]
+            deltas.append(delta)
+        return deltas
+
+    def get_routing_graph(self):
+        with self.topology_lock:
+            topology, version = self.refresh_topology()
+            if self.routing_graph_version != version:
+                self.routing_graph = RoutingGraph(*(
+                    topology[kind].values()
+                    for kind
+                    in ('sales_channels', 'suppliers', 'fulfillment_centers')
+                ))
+                self.routing_graph_version = version
+            return self.routing_graph
+
+    def sync_topology(self):
+        with self.topology_lock:
+            reply = self.get_topology(self.replica_version)
+            if 'topology' in reply:
+                self.replica = reply['topology']
+            for delta in reply.get('deltas', []):
+                self.replica = apply_topology_delta(self.replica, delta)
+            self.replica_version = reply['version']
+            return self.replica, self.replica_version
+
+    @procedure
+    def topology_changed(self):
+        self.mark_topology_stale()
+
+    @procedure(idempotent=True)
+    def get_topology(self, since_version=None):
+        with self.topology_lock:
+            topology, version = self.refresh_topology()
+            if since_version == version:
+                return {'version': version, 'unchanged': True}
+            deltas = self.get_topology_deltas(since_version) if since_version is not None else None
+            if deltas is not None:
+                return {'version': version, 'deltas': deltas}
+            return {'version': version, 'topology': topology}
+
+    @procedure(idempotent=True)
+    def route_order(self, sales_channel_id, lines):
+        quantities = {}
+        for line in lines:
+            sku, quantity = (line['sku'], line['quantity']) if isinstance(line, dict) else line
+            quantities[sku] = quantities.get(sku, 0) + int(quantity)
+
+        candidates = self.get_routing_graph().routes.get(sales_channel_id, [])
+        stock = self.get('warehouse').count_stock_many(
+            sorted(quantities),
+            [candidate['warehouse'] for candidate in candidates],
+            # The routing graph may still list a warehouse deleted since; it just has no stock.
+            skip_missing=True,
+        ) if candidates else {}
+
+        return allocate(candidates, quantities, stock)
@@ -16,6 +16,7 @@ class Customer(peewee.Model):
 
 class CustomerModule(Module):
     name = 'customer'
+    models = (Customer,)
 
     @procedure
     def create_customer(self):
@@ -23,7 +24,7 @@ class CustomerModule(Module):
         customer.save()
         return customer.to_dict()
 
-    @procedure
+    @procedure(idempotent=True)
     def get_customer(self, uuid):
         try:
             customer = Customer.get(Customer.uuid == str(uuid))
@@ -1,6 +1,7 @@
+from datetime import datetime
 from uuid import uuid4
 
-from modules.base import Module, procedure
+from modules.base import Module, procedure, filter_query, paginate, prefetch_related, aggregate
 
 import peewee
 
@@ -9,6 +10,7 @@ class FulfillmentCenter(peewee.Model):
     uuid = peewee.CharField(unique=True)
     name = peewee.CharField()
     warehouse_id = peewee.CharField(unique=True)
+    created_at = peewee.DateTimeField(default=datetime.now)
 
     def to_dict(self):
         return dict(
@@ -20,8 +22,9 @@ class FulfillmentCenter(peewee.Model):
 
 class FulfillmentCenterModule(Module):
     name = 'fulfillment_center'
+    models = (FulfillmentCenter,)
 
-    @procedure
+    @procedure(invalidates=('get_fulfillment_centers', 'aggregate_fulfillment_centers'))
     def create_fulfillment_center(self, name, warehouse):
         fulfillment_center = FulfillmentCenter.create(
             uuid=str(uuid4()),
@@ -31,7 +34,7 @@ class FulfillmentCenterModule(Module):
 
         return fulfillment_center.to_dict()
 
-    @procedure
+    @procedure(cache=60)
     def get_fulfillment_center(self, uuid):
         try:
             fulfillment_center = FulfillmentCenter.get(uuid=uuid).to_dict()
@@ -39,19 +42,21 @@ class FulfillmentCenterModule(Module):
             fulfillment_center = None
         return fulfillment_center
 
-    @procedure
-    def get_fulfillment_centers(self, **kwargs):
+    @procedure(cache=60)
+    def get_fulfillment_centers(self, limit=None, after=None, uuids=None, **kwargs):
         fulfillment_centers = []
 
-        _fulfillment_centers = FulfillmentCenter.select()
-        if kwargs:
-            _fulfillment_centers = _fulfillment_centers.where(*(
-                getattr(FulfillmentCenter, keyword) == argument
-                for keyword, argument
-                in kwargs.items()
-            ))
+        _fulfillment_centers = filter_query(FulfillmentCenter.select(), FulfillmentCenter, kwargs)
+        if uuids is not None:
+            _fulfillment_centers = _fulfillment_centers.where(FulfillmentCenter.uuid.in_(list(uuids)))
+        _fulfillment_centers = paginate(_fulfillment_centers, FulfillmentCenter, limit, after)
 
-        for fulfillment_center in _fulfillment_centers:
+        for fulfillment_center in prefetch_related(_fulfillment_centers):
             fulfillment_centers.append(fulfillment_center.to_dict())
 
         return fulfillment_centers
+
+    @procedure(cache=60)
+    def aggregate_fulfillment_centers(self, count_by=None, min=(), max=(), **kwargs):
+        _fulfillment_centers = filter_query(FulfillmentCenter.select(), FulfillmentCenter, kwargs)
+        return aggregate(_fulfillment_centers, FulfillmentCenter, count_by, min, max)
@@ -1,83 +1,288 @@
+import os
+import time
+import secrets
+import threading
+
+import requests
+
 from modules.base import Module, procedure
+from modules.online_shop import CLAIM_SECRET_HEADER
+
+
+IMAGE_NAME = 'commerce_engine_online_shop'
+SLOT_LABEL = 'online_shop_slot'
+
+
+class SlotAllocator:
+    def __init__(self, first_port, size):
+        self.first_port = first_port
+        self.size = size
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            for slot in range(self.size):
+                if slot not in self.used:
+                    self.used.add(slot)
+                    return slot, self.first_port + slot
+        raise RuntimeError('all {} online shop slots are in use'.format(self.size))
+
+    def release(self, slot):
+        with self.lock:
+            self.used.discard(slot)
 
-import docker
+    def available(self):
+        with self.lock:
+            return self.size - len(self.used)
 
 
 class InfrastructureModule(Module):
     name = 'infrastructure'
+    models = ()
+    warm_pool_size = 2
+    max_online_shops = 50
+    ready_timeout = 60
+    network = 'commerce_engine_default'
+    # Slots and container names are allocated in-process: a second worker would hand out the same ones.
+    max_workers = 1
+    # Used when the module's address names no port, e.g. when it is colocated.
+    port = 5009
 
     def __init__(self, *args, **kwargs):
+        client = kwargs.pop('client', None)
+        self.warm_pool_size = kwargs.pop('warm_pool_size', self.warm_pool_size)
+        self.max_online_shops = kwargs.pop('max_online_shops', self.max_online_shops)
+        self.ready_timeout = kwargs.pop('ready_timeout', self.ready_timeout)
+        # Online shops only accept claims carrying it; a fresh one per run unless configured.
+        self.claim_secret = kwargs.pop('claim_secret', None) or secrets.token_urlsafe(32)
         super().__init__(*args, **kwargs)
-        self.client = docker.from_env()
-
-    def __post_init__(self, module_name):
-        if module_name == self.name:
-            for container in self.client.containers.list(
-                filters=dict(
-                    label='sales_channel_id',
-                ),
-            ):
-                container.stop()
-                container.remove()
+        self.client = None
+        self.slots = None
+        if not self.remote:
+            if client is None:
+                import docker
+                client = docker.from_env()
+            self.client = client
+            _, _, port = self.address.partition(':')
+            self.port = int(port) if port else self.port
+            self.slots = SlotAllocator(self.port + 1, self.max_online_shops)
+        self.image = None
+        self.image_lock = threading.Lock()
+        # Online shops by slot; a shop without a sales channel is warm and waiting to be claimed.
+        self.online_shops = {}
+        self.online_shops_lock = threading.RLock()
+        self.fill_lock = threading.Lock()
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
 
-    @procedure
-    def spin_up_online_shop(self, sales_channel_id):
-        images = self.client.images.list(
-            filters=dict(label='name=commerce_engine_online_shop'),
-        )
-
-        if images:
-            image = images[0]
-        else:
-            image, _ = self.client.images.build(
-                path='/mnt',
-                dockerfile='Dockerfile',
-                labels=dict(name='commerce_engine_online_shop'),
+    def start_pool(self):
+        # On first use rather than while wiring, so that processes which only wire the module (the
+        # reloader's parent, gunicorn's arbiter) leave the containers alone.
+        with self.pool_lock:
+            if self.pool_pid == os.getpid():
+                return
+            self.pool_pid = os.getpid()
+            # Left over from a previous run; their slots aren't known to this one.
+            for label in ('sales_channel_id', SLOT_LABEL):
+                for container in self.client.containers.list(all=True, filters=dict(label=label)):
+                    container.stop()
+                    container.remove()
+        self.fill_pool_in_background()
+
+    def get_image(self):
+        with self.image_lock:
+            if self.image is None:
+                images = self.client.images.list(
+                    filters=dict(label='name=' + IMAGE_NAME),
+                )
+                if images:
+                    self.image = images[0]
+                else:
+                    self.image, _ = self.client.images.build(
+                        path='/mnt',
+                        dockerfile='Dockerfile',
+                        labels=dict(name=IMAGE_NAME),
+                    )
+            return self.image
+
+    def get_online_shop_url(self, online_shop, path):
+        return 'http://{}:{}{}'.format(online_shop['host'], online_shop['port'], path)
+
+    def check_health(self, online_shop):
+        try:
+            response = self.session.get(
+                self.get_online_shop_url(online_shop, '/_health'),
+                timeout=(self.connect_timeout, self.read_timeout),
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+        return response.status_code == 200
+
+    def wait_until_ready(self, online_shop):
+        deadline = time.monotonic() + self.ready_timeout
+        while not self.check_health(online_shop):
+            if time.monotonic() > deadline:
+                raise TimeoutError('online shop in slot {} not ready after {}s'.format(online_shop['slot'], self.ready_timeout))
+            time.sleep(0.1)
+        online_shop['ready'] = True
+
+    def reserve_online_shop(self, sales_channel_id=None):
+        with self.online_shops_lock:
+            slot, port = self.slots.allocate()
+            online_shop = dict(
+                slot=slot,
+                port=port,
+                host=IMAGE_NAME + '_' + str(slot),
+                container=None,
+                sales_channel_id=sales_channel_id,
+                ready=False,
+            )
+            self.online_shops[slot] = online_shop
+            return online_shop
+
+    def start_online_shop(self, sales_channel_id=None):
+        return self.launch_online_shop(self.reserve_online_shop(sales_channel_id))
+
+    def launch_online_shop(self, online_shop):
+        slot, port = online_shop['slot'], online_shop['port']
+        try:
+            online_shop['container'] = self.client.containers.run(
+                image=self.get_image().attrs['Id'],
+                command=['python3', 'online_shop.py'],
+                name=online_shop['host'],
+                environment={
+                    'DEBUG': 'true' if self.debug else 'false',
+                    'MASTER_MODULE_NAME': 'commerce_engine',
+                    'MODULE_NAME': 'online_shop',
+                    # The sales channel is assigned on claim, which only reaches the process it is sent to.
+                    'MODULE_WORKERS': '1',
+                    'ONLINE_SHOP_CLAIM_SECRET': self.claim_secret,
+                    'COMMERCE_ENGINE_MODULE_ADDRESS': 'commerce_engine:5000',
+                    'WAREHOUSE_MODULE_ADDRESS': 'warehouse:5000',
+                    'FULFILLMENT_CENTER_MODULE_ADDRESS': 'fulfillment_center:5000',
+                    'SUPPLIER_MODULE_ADDRESS': 'supplier:5000',
+                    'SALES_CHANNEL_MODULE_ADDRESS': 'sales_channel:5000',
+                    'CART_MODULE_ADDRESS': 'cart:5000',
+                    'CUSTOMER_MODULE_ADDRESS': 'customer:5000',
+                    'PRODUCT_MODULE_ADDRESS': 'product:5000',
+                    'MANAGEMENT_MODULE_ADDRESS': 'management:5000',
+                    'INFRASTRUCTURE_MODULE_ADDRESS': 'infrastructure:' + str(self.port),
+                    'ONLINE_SHOP_MODULE_ADDRESS': '0.0.0.0:' + str(port),
+                },
+                ports={
+                    str(port) + '/tcp': port,
+                },
+                network=self.network,
+                working_dir='/mnt',
+                detach=True,
+                labels={
+                    SLOT_LABEL: str(slot),
+                },
             )
+            self.wait_until_ready(online_shop)
+        except Exception:
+            self.stop_online_shop(online_shop)
+            raise
+        return online_shop
 
-        containers = self.client.containers.list(
-            filters=dict(
-                label='sales_channel_id=' + str(sales_channel_id),
+    def stop_online_shop(self, online_shop):
+        with self.online_shops_lock:
+            self.online_shops.pop(online_shop['slot'], None)
+        if online_shop['container'] is not None:
+            online_shop['container'].stop()
+            online_shop['container'].remove()
+        self.slots.release(online_shop['slot'])
+
+    def fill_pool(self):
+        # A single filler at a time, so that concurrent claims don't overshoot the pool size.
+        if not self.fill_lock.acquire(blocking=False):
+            return
+        try:
+            while True:
+                with self.online_shops_lock:
+                    warm = sum(1 for online_shop in self.online_shops.values() if online_shop['sales_channel_id'] is None)
+                # Out of slots: claims start their own shop once one is torn down.
+                if warm >= self.warm_pool_size or not self.slots.available():
+                    return
+                self.start_online_shop()
+        finally:
+            self.fill_lock.release()
+
+    def fill_pool_in_background(self):
+        threading.Thread(target=self.fill_pool, daemon=True).start()
+
+    def claim_online_shop(self, online_shop, sales_channel_id):
+        try:
+            response = self.session.post(
+                self.get_online_shop_url(online_shop, '/_claim'),
+                json={'sales_channel_id': sales_channel_id},
+                headers={CLAIM_SECRET_HEADER: self.claim_secret},
+                timeout=(self.connect_timeout, self.read_timeout),
             )
-        )
-
-        if containers:
-            for container in containers:
-                container.stop()
-                container.remove()
-
-        infrastructure_host, infrastructure_port = self.address.split(':')
-        infrastructure_port = int(infrastructure_port)
-
-        port = 1 + infrastructure_port + len(self.client.containers.list())
-
-        self.client.containers.run(
-            image=image.attrs['Id'],
-            command=['python3', 'online_shop.py'],
-            environment={
-                'DEBUG': 'true' if self.debug else 'false',
-                'MASTER_MODULE_NAME': 'commerce_engine',
-                'MODULE_NAME': 'online_shop',
-                'COMMERCE_ENGINE_MODULE_ADDRESS': 'commerce_engine:5000',
-                'WAREHOUSE_MODULE_ADDRESS': 'warehouse:5000',
-                'FULFILLMENT_CENTER_MODULE_ADDRESS': 'fulfillment_center:5000',
-                'SUPPLIER_MODULE_ADDRESS': 'supplier:5000',
-                'SALES_CHANNEL_MODULE_ADDRESS': 'sales_channel:5000',
-                'CART_MODULE_ADDRESS': 'cart:5000',
-                'CUSTOMER_MODULE_ADDRESS': 'customer:5000',
-                'PRODUCT_MODULE_ADDRESS': 'product:5000',
-                'MANAGEMENT_MODULE_ADDRESS': 'management:5000',
-                'INFRASTRUCTURE_MODULE_ADDRESS': 'infrastructure:' + str(infrastructure_port),
-                'ONLINE_SHOP_MODULE_ADDRESS': '0.0.0.0:' + str(port),
-                'SALES_CHANNEL_ID': str(sales_channel_id),
-            },
-            ports={
-                str(port) + '/tcp': port,
-            },
-            network='commerce_engine_default',
-            working_dir='/mnt',
-            detach=True,
-            labels=dict(
-                sales_channel_id=str(sales_channel_id),
-            ),
-        )
+            response.raise_for_status()
+        except Exception:
+            self.stop_online_shop(online_shop)
+            raise
+
+    def describe_online_shop(self, online_shop):
+        return {
+            'slot': online_shop['slot'],
+            'port': online_shop['port'],
+            'address': '{}:{}'.format(online_shop['host'], online_shop['port']),
+            'sales_channel_id': online_shop['sales_channel_id'],
+            'ready': online_shop['ready'],
+        }
+
+    @procedure
+    def spin_up_online_shop(self, sales_channel_id):
+        self.start_pool()
+        sales_channel_id = str(sales_channel_id)
+        with self.online_shops_lock:
+            for online_shop in self.online_shops.values():
+                if online_shop['sales_channel_id'] == sales_channel_id:
+                    return self.describe_online_shop(online_shop)
+            online_shop = next((
+                online_shop
+                for online_shop
+                in sorted(self.online_shops.values(), key=lambda online_shop: online_shop['slot'])
+                if online_shop['sales_channel_id'] is None and online_shop['ready']
+            ), None)
+            launch = online_shop is None
+            if launch:
+                # Pool ran dry: start one for this sales channel instead of waiting for the filler.
+                # Its slot is recorded before the lock is released, so a concurrent spin up finds it.
+                online_shop = self.reserve_online_shop(sales_channel_id)
+            else:
+                online_shop['sales_channel_id'] = sales_channel_id
+
+        if launch:
+            self.launch_online_shop(online_shop)
+        self.claim_online_shop(online_shop, sales_channel_id)
+        self.fill_pool_in_background()
+        return self.describe_online_shop(online_shop)
+
+    @procedure
+    def tear_down_online_shop(self, sales_channel_id):
+        self.start_pool()
+        sales_channel_id = str(sales_channel_id)
+        with self.online_shops_lock:
+            online_shops = [
+                online_shop
+                for online_shop
+                in self.online_shops.values()
+                if online_shop['sales_channel_id'] == sales_channel_id
+            ]
+        for online_shop in online_shops:
+            self.stop_online_shop(online_shop)
+        self.fill_pool_in_background()
+
+    @procedure(idempotent=True)
+    def get_online_shops(self):
+        self.start_pool()
+        with self.online_shops_lock:
+            return [
+                self.describe_online_shop(online_shop)
+                for _, online_shop
+                in sorted(self.online_shops.items())
+            ]
@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import math
+import mmap
+import heapq
+import atexit
+import threading
+
+from array import array
+from bisect import bisect_left, insort
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').casefold())
+
+
+class InvertedIndex:
+    k1 = 1.2
+    b = 0.75
+    magic = b'IIDX2\n'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # Postings are parallel arrays of ascending document numbers and term frequencies.
+            # Loaded ones are read-only views of the index file until a document is added to them.
+            self.postings = {}
+            self.terms = None
+            self.doc_ids = []
+            self.doc_facets = []
+            self.doc_numbers = {}
+            self.doc_lengths = array('l')
+            self.total_length = 0
+            self.deleted = 0
+
+    def __len__(self):
+        return len(self.doc_numbers)
+
+    def add(self, doc_id, text, facets=None):
+        with self.lock:
+            self.remove(doc_id)
+            number, tokens = len(self.doc_ids), tokenize(text)
+            self.doc_ids.append(doc_id)
+            self.doc_facets.append(facets or {})
+            self.doc_numbers[doc_id] = number
+            if not isinstance(self.doc_lengths, array):
+                self.doc_lengths = array('l', self.doc_lengths)
+            self.doc_lengths.append(len(tokens))
+            self.total_length += len(tokens)
+
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for term, frequency in frequencies.items():
+                if term not in self.postings:
+                    self.postings[term] = (array('l'), array('l'))
+                    if self.terms is not None:
+                        insort(self.terms, term)
+                docs, counts = self.postings[term]
+                if not isinstance(docs, array):
+                    docs, counts = self.postings[term] = (array('l', docs), array('l', counts))
+                docs.append(number)
+                counts.append(frequency)
+
+    def remove(self, doc_id):
+        with self.lock:
+            number = self.doc_numbers.pop(doc_id, None)
+            if number is None:
+                return
+            self.doc_ids[number] = None
+            self.doc_facets[number] = {}
+            self.total_length -= self.doc_lengths[number]
+            self.deleted += 1
+            if self.deleted > len(self.doc_numbers):
+                self.compact()
+
+    def compact(self):
+        with self.lock:
+            numbers, doc_ids, doc_facets, doc_lengths = {}, [], [], array('l')
+            for number, doc_id in enumerate(self.doc_ids):
+                if doc_id is not None:
+                    numbers[number] = len(doc_ids)
+                    doc_ids.append(doc_id)
+                    doc_facets.append(self.doc_facets[number])
+                    doc_lengths.append(self.doc_lengths[number])
+
+            postings = {}
+            for term, (docs, counts) in self.postings.items():
+                live_docs, live_counts = array('l'), array('l')
+                for number, frequency in zip(docs, counts):
+                    if number in numbers:
+                        live_docs.append(numbers[number])
+                        live_counts.append(frequency)
+                if live_docs:
+                    postings[term] = (live_docs, live_counts)
+
+            self.postings, self.terms = postings, None
+            self.doc_ids, self.doc_facets, self.doc_lengths = doc_ids, doc_facets, doc_lengths
+            self.doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+            self.deleted = 0
+
+    def expand(self, token):
+        if self.terms is None:
+            self.terms = sorted(self.postings)
+        start = bisect_left(self.terms, token)
+        end = bisect_left(self.terms, token + '\U0010ffff', start)
+        return self.terms[start:end]
+
+    def score(self, tokens):
+        documents = len(self.doc_numbers)
+        average_length = self.total_length / documents if documents else 0
+        scores = None
+
+        for token in tokens:
+            # Every token is a prefix, so a token scores the best of the terms it expands to.
+            token_scores = {}
+            for term in self.expand(token):
+                docs, counts = self.postings[term]
+                idf = math.log(1 + (documents - len(docs) + 0.5) / (len(docs) + 0.5))
+                for number, frequency in zip(docs, counts):
+                    if self.doc_ids[number] is None:
+                        continue
+                    norm = 1 - self.b + self.b * self.doc_lengths[number] / average_length if average_length else 1
+                    score = idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+                    if score > token_scores.get(number, 0):
+                        token_scores[number] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {number: score + token_scores[number] for number, score in scores.items() if number in token_scores}
+            if not scores:
+                break
+
+        if scores is None:
+            scores = dict.fromkeys(self.doc_numbers.values(), 0)
+        return scores
+
+    def matches(self, number, filters, skip=None):
+        facets = self.doc_facets[number]
+        return all(
+            facets.get(field) == value
+            for field, value
+            in filters.items()
+            if value is not None and field != skip
+        )
+
+    def search(self, q, offset=0, limit=20, filters=None, facets=()):
+        filters = filters or {}
+        with self.lock:
+            scores = self.score(tokenize(q))
+
+            facet_counts = {}
+            for field in facets:
+                counts = {}
+                for number in scores:
+                    if self.matches(number, filters, skip=field):
+                        value = self.doc_facets[number].get(field)
+                        counts[value] = counts.get(value, 0) + 1
+                facet_counts[field] = sorted(
+                    ([value, count] for value, count in counts.items() if value is not None),
+                    key=lambda item: (-item[1], item[0]),
+                )
+
+            numbers = [number for number in scores if self.matches(number, filters)]
+            key = lambda number: (-scores[number], number)  # noqa: E731
+            if limit is None:
+                ranked = sorted(numbers, key=key)[offset:]
+            else:
+                ranked = heapq.nsmallest(offset + limit, numbers, key=key)[offset:]
+
+            return {
+                'results': [self.doc_ids[number] for number in ranked],
+                'count': len(numbers),
+                'facets': facet_counts,
+            }
+
+    def save(self, fingerprint=None):
+        if self.path is None:
+            return
+        with self.lock:
+            if self.deleted:
+                self.compact()
+            terms = sorted(self.postings)
+            header = json.dumps({
+                'fingerprint': fingerprint,
+                'itemsize': array('l').itemsize,
+                'doc_ids': self.doc_ids,
+                'doc_facets': self.doc_facets,
+                'total_length': self.total_length,
+                'terms': [[term, len(self.postings[term][0])] for term in terms],
+            }).encode('utf-8')
+            # Padded so that the arrays after it start aligned.
+            header += b' ' * (-(len(self.magic) + 8 + len(header)) % 8)
+
+            # Written aside and swapped in, so concurrent readers never see a partial file.
+            temporary_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temporary_path, 'wb') as f:
+                f.write(self.magic)
+                f.write(len(header).to_bytes(8, 'little'))
+                f.write(header)
+                f.write(self.doc_lengths)
+                for term in terms:
+                    f.write(self.postings[term][0])
+                for term in terms:
+                    f.write(self.postings[term][1])
+            os.replace(temporary_path, self.path)
+
+    def load(self, fingerprint=None):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with self.lock, open(self.path, 'rb') as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            if data[:len(self.magic)] != self.magic:
+                return False
+            position = len(self.magic) + 8
+            size = int.from_bytes(data[len(self.magic):position], 'little')
+            header = json.loads(bytes(data[position:position + size]))
+            itemsize = array('l').itemsize
+            if header['fingerprint'] != fingerprint or header['itemsize'] != itemsize:
+                return False
+            position += size
+
+            # Views into the mapping rather than copies, so loading costs little beyond parsing the header.
+            def read(length):
+                nonlocal position
+                values = data[position:position + length * itemsize].cast('l')
+                position += length * itemsize
+                return values
+
+            self.clear()
+            self.doc_ids = header['doc_ids']
+            self.doc_facets = header['doc_facets']
+            self.doc_numbers = {doc_id: number for number, doc_id in enumerate(self.doc_ids)}
+            self.doc_lengths = read(len(self.doc_ids))
+            self.total_length = header['total_length']
+            docs = [read(length) for _, length in header['terms']]
+            self.postings = {
+                term: (term_docs, read(length))
+                for (term, length), term_docs
+                in zip(header['terms'], docs)
+            }
+            self.terms = [term for term, _ in header['terms']]
+        return True
+
+
+class SearchIndex(InvertedIndex):
+    # Notifications carry the ids of changed documents; this many stay under the bus' payload limit.
+    ids_per_notification = 150
+
+    def __init__(self, path=None, load_documents=None, get_fingerprint=None):
+        super().__init__(path)
+        self.load_documents = load_documents
+        self.get_fingerprint = get_fingerprint
+        self.digests = {}
+        self.built = False
+
+    def warm_up(self):
+        with self.lock:
+            if self.built:
+                return
+            fingerprint = self.get_fingerprint()
+            if not self.load(fingerprint):
+                self.build()
+                self.save(fingerprint)
+            self.built = True
+            atexit.register(self.persist)
+
+    def build(self):
+        with self.lock:
+            self.clear()
+            self.digests = {}
+            for doc_id, text, facets in self.load_documents():
+                self.add(doc_id, text, facets)
+            self.built = True
+
+    def apply(self, documents):
+        with self.lock:
+            if not self.built:
+                return
+            for doc_id, text, facets in documents:
+                if text is None:
+                    self.digests.pop(doc_id, None)
+                    self.remove(doc_id)
+                    continue
+                # Writers apply their own changes before the bus echoes them back.
+                digest = hash((text, json.dumps(facets, sort_keys=True)))
+                if self.digests.get(doc_id) != digest:
+                    self.digests[doc_id] = digest
+                    self.add(doc_id, text, facets)
+
+    def refresh(self, doc_ids):
+        if not self.built:
+            return
+        # Documents that are gone or no longer searchable come back as deletions.
+        documents = {doc_id: [doc_id, None, None] for doc_id in doc_ids}
+        for doc_id, text, facets in self.load_documents(list(documents)):
+            documents[doc_id] = [doc_id, text, facets]
+        self.apply(documents.values())
+
+    def chunk_ids(self, documents):
+        doc_ids = [doc_id for doc_id, _, _ in documents]
+        return [
+            doc_ids[start:start + self.ids_per_notification]
+            for start
+            in range(0, len(doc_ids), self.ids_per_notification)
+        ]
+
+    def persist(self):
+        self.save(self.get_fingerprint())
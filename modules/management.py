@@ -3,3 +3,4 @@ from modules.base import Module
 
 class ManagementModule(Module):
     name = 'management'
+    models = ()
@@ -1,18 +1,39 @@
+import threading
+
+from decimal import Decimal
+
 from modules.base import Module, procedure
 
 
+# Header carrying the secret the infrastructure module shares with the online shops it starts.
+CLAIM_SECRET_HEADER = 'X-Claim-Secret'
+
+
 class OnlineShopModule(Module):
     name = 'online_shop'
+    models = ()
 
     def __init__(self, *args, **kwargs):
         self.sales_channel_id = kwargs.pop('sales_channel_id')
+        self.claim_secret = kwargs.pop('claim_secret', None)
         super().__init__(*args, **kwargs)
+        self.claim_lock = threading.Lock()
+        if self.sales_channel_id is None:
+            # The sales channel is assigned on claim, which only reaches the process it is sent to.
+            self.max_workers = 1
 
     @procedure
+    def claim(self, sales_channel_id):
+        with self.claim_lock:
+            if self.sales_channel_id is not None:
+                raise ValueError('online shop is already claimed by sales channel {!r}'.format(self.sales_channel_id))
+            self.sales_channel_id = sales_channel_id
+
+    @procedure(idempotent=True)
     def describe(self):
         return self.get('sales_channel').get_sales_channel(self.sales_channel_id)
 
-    @procedure
+    @procedure(idempotent=True)
     def describe_customers_cart(self, customer_id):
         cart_items = self.get('cart').get_customers_cart_items(
             sales_channel_id=self.sales_channel_id,
@@ -22,3 +43,72 @@ class OnlineShopModule(Module):
             'items': cart_items,
             'customer_id': customer_id,
         }
+
+    @procedure(idempotent=True)
+    def view_customers_cart(self, customer_id):
+        # A fixed number of lookups per cart, whatever its size. Stock in a warehouse that
+        # no longer exists counts as unavailable instead of failing the whole cart.
+        cart_items = self.get('cart').get_customers_cart_items(
+            sales_channel_id=self.sales_channel_id,
+            customer_id=customer_id,
+        )
+        articles = {
+            article['uuid']: article
+            for article
+            in self.get('product').get_articles(
+                [cart_item['article_id'] for cart_item in cart_items],
+                sales_channel_id=self.sales_channel_id,
+            )
+        }
+        supplier_skus = {
+            supplier_sku['uuid']: supplier_sku
+            for supplier_sku
+            in self.get('supplier').get_supplier_skus(sorted({
+                supplier_sku_id
+                for article in articles.values()
+                for supplier_sku_id in article['supplier_sku_ids']
+            }))
+        }
+        warehouse_ids = {
+            fulfillment_center['uuid']: fulfillment_center['warehouse_id']
+            for fulfillment_center
+            in self.get('fulfillment_center').get_fulfillment_centers(uuids=sorted({
+                fulfillment_center_id
+                for supplier_sku in supplier_skus.values()
+                for fulfillment_center_id in supplier_sku['fulfillment_center_skus']
+            }))
+        }
+        stock = self.get('warehouse').count_stock_many(sorted({
+            sku
+            for supplier_sku in supplier_skus.values()
+            for sku in supplier_sku['fulfillment_center_skus'].values()
+        }), sorted(set(warehouse_ids.values())), skip_missing=True)
+
+        items, total = [], Decimal(0)
+        for cart_item in cart_items:
+            article = articles.get(cart_item['article_id'])
+            price, available = None, 0
+            if article is not None:
+                if article['price'] is not None:
+                    price = article['price']['price']
+                for supplier_sku_id in article['supplier_sku_ids']:
+                    supplier_sku = supplier_skus.get(supplier_sku_id)
+                    if supplier_sku is None:
+                        continue
+                    for fulfillment_center_id, sku in supplier_sku['fulfillment_center_skus'].items():
+                        if fulfillment_center_id in warehouse_ids and sku in stock:
+                            available += stock[sku]['warehouses'].get(warehouse_ids[fulfillment_center_id], 0)
+            if price is not None:
+                total += Decimal(price) * cart_item['quantity']
+            items.append(dict(
+                cart_item,
+                article=article,
+                price=price,
+                available=available,
+            ))
+
+        return {
+            'items': items,
+            'total': str(total),
+            'customer_id': customer_id,
+        }
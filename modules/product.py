@@ -1,13 +1,31 @@
+import io
+import os
 import sys
-
+import csv
+import json
+import time
+import queue
+import threading
+import traceback
+
+from array import array
+from bisect import bisect_left
 from copy import copy
+from decimal import Decimal
+from itertools import islice
 
 from uuid import uuid4
 from datetime import datetime
 
-from modules.base import Module, procedure, validate, enhance_schema_with_data
+from modules.base import (
+    Module, procedure, filter_query, paginate, prefetch_related, aggregate, validate, enhance_schema_with_data,
+    make_search_vector, search_query, invalidation_bus,
+)
+from modules.inverted_index import SearchIndex
+from modules.sales_channel import SUPPLIER_ORDERING
 
 import peewee
+from playhouse.postgres_ext import TSVectorField
 
 
 def make_attribute_value_resolver(
@@ -16,11 +34,62 @@ def make_attribute_value_resolver(
 ):
     def resolve(value):
         attribute, _ = Attribute.get_or_create(name=attribute_name, defaults={'multiple': False})
-        attribute_value, _ = AttributeValue.get_or_create(name=value, attribute=attribute)
+        attribute_value, _ = AttributeValue.get_or_create(
+            name=value,
+            attribute=attribute,
+            defaults={'search_vector': make_search_vector((value, 'A'))},
+        )
         return attribute_value
     return resolve
 
 
+def resolve_attribute_values(attribute_name, names, resolved, created):
+    missing = set(names) - resolved.keys()
+    if not missing:
+        return resolved
+
+    attribute, _ = Attribute.get_or_create(name=attribute_name, defaults={'multiple': False})
+
+    def select(names):
+        return {
+            attribute_value.name: attribute_value.id
+            for attribute_value
+            in AttributeValue
+            .select(AttributeValue.id, AttributeValue.name)
+            .where(AttributeValue.attribute == attribute, AttributeValue.name.in_(list(names)))
+        }
+
+    resolved.update(select(missing))
+    missing -= resolved.keys()
+
+    if missing:
+        AttributeValue.insert_many([
+            {'attribute': attribute, 'name': name, 'search_vector': make_search_vector((name, 'A'))}
+            for name
+            in missing
+        ]).on_conflict_ignore().execute()
+        resolved.update(select(missing))
+        created.extend((attribute_name, name) for name in missing)
+
+    return resolved
+
+
+def parse_json_line(line):
+    try:
+        return json.loads(line), []
+    except ValueError as e:
+        return None, [str(e)]
+
+
+def parse_rows(lines, format, fieldnames=None):
+    if format == 'csv':
+        # The reader pulls in further lines for quoted fields that span several.
+        return ((row, []) for row in csv.DictReader(lines, fieldnames=fieldnames))
+    if format == 'jsonl':
+        return (parse_json_line(line) for line in lines if line.strip())
+    raise ValueError('unsupported import format {!r}'.format(format))
+
+
 NAME = 'Name'
 TYPE = 'Type'
 BRAND = 'Brand'
@@ -43,6 +112,7 @@ class Attribute(peewee.Model):
 class AttributeValue(peewee.Model):
     attribute = peewee.ForeignKeyField(Attribute, backref='values')
     name = peewee.CharField()
+    search_vector = TSVectorField(null=True)
 
     class Meta:
         indexes = (
@@ -56,6 +126,55 @@ class AttributeValue(peewee.Model):
         return '<' + repr(self.attribute) + ': ' + str(self) + '>'
 
 
+class AttributeValueIndex:
+    max_age = 300
+
+    def __init__(self):
+        self.entries = {}
+        self.loaded_at = {}
+        self.lock = threading.RLock()
+
+    def get(self, attribute_name):
+        with self.lock:
+            if time.monotonic() - self.loaded_at.get(attribute_name, float('-inf')) > self.max_age:
+                self.entries[attribute_name] = sorted(
+                    (attribute_value.name.casefold(), attribute_value.name)
+                    for attribute_value
+                    in AttributeValue
+                    .select(AttributeValue.name)
+                    .join(Attribute)
+                    .where(Attribute.name == attribute_name)
+                )
+                self.loaded_at[attribute_name] = time.monotonic()
+            return self.entries[attribute_name]
+
+    def add(self, attribute_name, name):
+        with self.lock:
+            entries = self.get(attribute_name)
+            entry = (name.casefold(), name)
+            i = bisect_left(entries, entry)
+            if i == len(entries) or entries[i] != entry:
+                entries.insert(i, entry)
+
+    def search(self, attribute_name, prefix='', offset=0, limit=20):
+        with self.lock:
+            entries = self.get(attribute_name)
+            prefix = prefix.casefold()
+            start = bisect_left(entries, (prefix,))
+            end = bisect_left(entries, (prefix + '\U0010ffff',), start)
+            return [name for _, name in entries[start + offset:min(end, start + offset + limit)]], end - start
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.loaded_at.clear()
+
+
+attribute_value_index = AttributeValueIndex()
+
+ATTRIBUTE_VALUES = 'attribute_values'
+
+
 class Product(peewee.Model):
     uuid = peewee.CharField(unique=True)
     name = peewee.CharField()
@@ -63,10 +182,15 @@ class Product(peewee.Model):
     deleted_at = peewee.DateTimeField(null=True)
     type = peewee.ForeignKeyField(AttributeValue, backref='as_products_type')
     brand = peewee.ForeignKeyField(AttributeValue, backref='as_products_brand')
+    search_vector = TSVectorField(null=True)
 
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def make_search_vector(name, type, brand):
+        return make_search_vector((name, 'A'), (type, 'B'), (brand, 'B'))
+
     @classmethod
     def get_schema(cls, mode):
         schema = dict(
@@ -84,15 +208,7 @@ class Product(peewee.Model):
                     key='type',
                     name=TYPE,
                     type='string',
-                    choices=[
-                        attribute_value.name
-                        for attribute_value
-                        in AttributeValue
-                        .select()
-                        .join(Attribute)
-                        .where(Attribute.name == 'Type')
-                        .order_by(Attribute.name)
-                    ],
+                    choices_attribute=TYPE,
                     can_create_choices=True,
                     ordering=1,
                     resolver=TYPE,
@@ -101,15 +217,7 @@ class Product(peewee.Model):
                     key='brand',
                     name=BRAND,
                     type='string',
-                    choices=[
-                        attribute_value.name
-                        for attribute_value
-                        in AttributeValue
-                        .select()
-                        .join(Attribute)
-                        .where(Attribute.name == 'Brand')
-                        .order_by(Attribute.name)
-                    ],
+                    choices_attribute=BRAND,
                     can_create_choices=True,
                     ordering=2,
                     resolver=BRAND,
@@ -143,6 +251,18 @@ class Product(peewee.Model):
 
         return processors
 
+    @classmethod
+    def load_related(cls, products):
+        attribute_value_ids = {product.type_id for product in products} | {product.brand_id for product in products}
+        attribute_values = {
+            attribute_value.id: attribute_value
+            for attribute_value
+            in AttributeValue.select().where(AttributeValue.id.in_(list(attribute_value_ids)))
+        }
+        for product in products:
+            product.type = attribute_values[product.type_id]
+            product.brand = attribute_values[product.brand_id]
+
     def to_dict(self):
         return dict(
             uuid=self.uuid,
@@ -174,6 +294,16 @@ class Article(peewee.Model):
         max_digits=9,
         decimal_places=2,
     )
+    search_vector = TSVectorField(null=True)
+
+    def to_dict(self):
+        return dict(
+            uuid=self.uuid,
+            name=self.name,
+            product=self.product.uuid,
+            product_name=self.product.name,
+            recommended_retail_price=str(self.recommended_retail_price),
+        )
 
 
 class ArticleAttributeValue(peewee.Model):
@@ -210,26 +340,329 @@ class ArticleSupplierSKUPricing(peewee.Model):
         )
 
 
-class ProductModule(Module):
-    name = 'product'
+PRICES = 'prices'
+
+CHEAPEST = 'cheapest'
+PREFERRED = 'preferred'
+
+# Supplier SKUs whose supplier isn't linked to the sales channel rank after all linked ones.
+UNRANKED = 2 ** 15
+
+
+def to_cents(price):
+    return int(Decimal(price).scaleb(2))
+
+
+def from_cents(cents):
+    return str(Decimal(cents).scaleb(-2))
+
+
+class PriceTable:
+    # Best rows per article are kept up to date on write, so resolving is a single lookup pass.
+    def __init__(self, supplier_ranks):
+        self.supplier_ranks = supplier_ranks
+        self.article_positions = {}
+        self.article_rows = []
+        self.row_indexes = {}
+        self.supplier_sku_ids = []
+        self.ranks = array('l')
+        self.prices = array('q')
+        self.cheapest = array('l')
+        self.preferred = array('l')
+        self.loaded_at = time.monotonic()
+
+    def set(self, article_id, supplier_sku_id, cents):
+        position = self.article_positions.get(article_id)
+        if position is None:
+            position = self.article_positions[article_id] = len(self.article_rows)
+            self.article_rows.append([])
+            self.cheapest.append(-1)
+            self.preferred.append(-1)
+        row = self.row_indexes.get((position, supplier_sku_id))
+        if row is None:
+            row = self.row_indexes[(position, supplier_sku_id)] = len(self.prices)
+            self.article_rows[position].append(row)
+            self.supplier_sku_ids.append(supplier_sku_id)
+            self.ranks.append(self.supplier_ranks.get(supplier_sku_id, UNRANKED))
+            self.prices.append(cents)
+        else:
+            self.prices[row] = cents
+        return position
+
+    def update(self, positions):
+        ranks, prices = self.ranks, self.prices
+        for position in positions:
+            rows = self.article_rows[position]
+            self.cheapest[position] = min(rows, key=lambda row: (prices[row], ranks[row], row))
+            self.preferred[position] = min(rows, key=lambda row: (ranks[row], prices[row], row))
+
+    def resolve(self, article_ids, strategy=PREFERRED):
+        if strategy not in (CHEAPEST, PREFERRED):
+            raise ValueError('unknown pricing strategy {!r}'.format(strategy))
+        best = self.preferred if strategy == PREFERRED else self.cheapest
+        rows = [
+            best[position] if position is not None else -1
+            for position
+            in map(self.article_positions.get, article_ids)
+        ]
+        return {
+            article_id: (
+                dict(supplier_sku_id=self.supplier_sku_ids[row], price=from_cents(self.prices[row]))
+                if row >= 0
+                else None
+            )
+            for article_id, row
+            in zip(article_ids, rows)
+        }
+
+
+class PriceTableLoad:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table = None
+
+
+class PricingEngine:
+    max_age = 300
+
+    def __init__(self, get_supplier_ranks):
+        self.get_supplier_ranks = get_supplier_ranks
+        self.tables = {}
+        self.loads = {}
+        self.lock = threading.RLock()
+        self.updates = None
+        self.pid = None
+
+    def load(self, sales_channel_id):
+        rows = list(
+            ArticleSupplierSKUPricing
+            .select(Article.uuid, ArticleSupplierSKU.supplier_sku_id, ArticleSupplierSKUPricing.price)
+            .join(ArticleSupplierSKU)
+            .join(Article)
+            .where(ArticleSupplierSKUPricing.sales_channel_id == sales_channel_id)
+            .tuples()
+        )
+        table = PriceTable(self.get_supplier_ranks(
+            sales_channel_id,
+            {supplier_sku_id for _, supplier_sku_id, _ in rows},
+        ))
+        table.update({
+            table.set(article_id, supplier_sku_id, to_cents(price))
+            for article_id, supplier_sku_id, price
+            in rows
+        })
+        return table
+
+    def get(self, sales_channel_id):
+        with self.lock:
+            table = self.tables.get(sales_channel_id)
+            if table is not None and time.monotonic() - table.loaded_at <= self.max_age:
+                return table
+            load = self.loads.setdefault(sales_channel_id, PriceTableLoad())
+
+        # Loaded outside the engine lock, once per sales channel however many requests wait for it.
+        with load.lock:
+            if load.table is None:
+                load.table = self.load(sales_channel_id)
+                with self.lock:
+                    # Prices set or reset during the load may be missing from it, so it serves the waiting requests only.
+                    if self.loads.get(sales_channel_id) is load:
+                        del self.loads[sales_channel_id]
+                        self.tables[sales_channel_id] = load.table
+            return load.table
+
+    def set(self, sales_channel_id, prices):
+        with self.lock:
+            self.loads.pop(sales_channel_id, None)
+            table = self.tables.get(sales_channel_id)
+            if table is None:
+                return
+            supplier_sku_ids = {supplier_sku_id for _, supplier_sku_id, _ in prices} - set(table.supplier_ranks)
+        supplier_ranks = self.get_supplier_ranks(sales_channel_id, supplier_sku_ids) if supplier_sku_ids else {}
+        with self.lock:
+            table.supplier_ranks.update(supplier_ranks)
+            table.update({
+                table.set(article_id, supplier_sku_id, to_cents(price))
+                for article_id, supplier_sku_id, price
+                in prices
+            })
+
+    def reset(self, sales_channel_id=None):
+        with self.lock:
+            if sales_channel_id is None:
+                self.tables.clear()
+                self.loads.clear()
+            else:
+                self.tables.pop(sales_channel_id, None)
+                self.loads.pop(sales_channel_id, None)
+
+    def submit(self, sales_channel_id, prices=None):
+        # Bus deliveries are applied in order on a thread of their own, so that fetching supplier
+        # ranks never holds up the invalidation listener. Like it, the thread is restarted after a fork.
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.updates = os.getpid(), queue.Queue()
+                threading.Thread(target=self.run, args=(self.updates,), daemon=True).start()
+            self.updates.put((sales_channel_id, prices))
+
+    def run(self, updates):
+        while True:
+            sales_channel_id, prices = updates.get()
+            try:
+                if prices is None:
+                    self.reset(sales_channel_id)
+                else:
+                    self.set(sales_channel_id, prices)
+            except Exception:
+                traceback.print_exc()
+
+    def resolve(self, sales_channel_id, article_ids, strategy=PREFERRED):
+        table = self.get(sales_channel_id)
+        with self.lock:
+            return table.resolve(article_ids, strategy)
+
+
+SEARCH = 'search'
+
+
+def make_product_document(uuid, name, type, brand):
+    return [uuid, ' '.join((name, type, brand)), {TYPE: type, BRAND: brand}]
+
+
+def join_product_attributes(query, Type, Brand):
+    return (
+        query
+        .join(Type, on=(Product.type == Type.id))
+        .switch(Product)
+        .join(Brand, on=(Product.brand == Brand.id))
+        .where(Product.deleted_at.is_null(True))
+    )
 
-    @procedure
-    def get_products(self, **kwargs):
-        products, _products = [], Product.select().where(Product.deleted_at.is_null(True))
 
-        if kwargs:
-            _products = _products.where(*(
-                getattr(Product, keyword) == argument
-                for keyword, argument
-                in kwargs.items()
-            ))
+def load_product_documents(uuids=None):
+    Type, Brand = AttributeValue.alias(), AttributeValue.alias()
+    products = join_product_attributes(Product.select(Product.uuid, Product.name, Type.name, Brand.name), Type, Brand)
+    if uuids is not None:
+        products = products.where(Product.uuid.in_(uuids))
+    for uuid, name, type, brand in products.tuples().iterator():
+        yield make_product_document(uuid, name, type, brand)
+
+
+def get_products_fingerprint():
+    Type, Brand = AttributeValue.alias(), AttributeValue.alias()
+    # A sum of row hashes, so that edits change it as well as creates and deletes.
+    count, digest = join_product_attributes(Product.select(
+        peewee.fn.COUNT(Product.id),
+        peewee.fn.SUM(peewee.fn.hashtextextended(
+            Product.uuid.concat(':').concat(Product.name).concat(':').concat(Type.name).concat(':').concat(Brand.name),
+            0,
+        )),
+    ), Type, Brand).tuples().get()
+    return [count, str(digest or 0)]
+
 
-        for product in _products:
+class ProductModule(Module):
+    name = 'product'
+    models = (
+        Attribute,
+        AttributeValue,
+        Product,
+        ProductAttributeValue,
+        Article,
+        ArticleAttributeValue,
+        ArticleSupplierSKU,
+        ArticleSupplierSKUPricing,
+    )
+    search_backend = 'database'
+    search_index_path = None
+
+    def __init__(self, *args, **kwargs):
+        self.search_backend = kwargs.pop('search_backend', None) or self.search_backend
+        self.search_index_path = kwargs.pop('search_index_path', None) or self.search_index_path
+        super().__init__(*args, **kwargs)
+        self.pricing_engine = PricingEngine(self.get_supplier_ranks)
+        self.search_index = None
+        if self.search_backend == 'memory' and not self.remote:
+            self.search_index = SearchIndex(
+                os.path.join(self.search_index_path, 'product.idx') if self.search_index_path else None,
+                load_documents=load_product_documents,
+                get_fingerprint=get_products_fingerprint,
+            )
+        invalidation_bus.watch(self.watched)
+
+    def watched(self, module_name, method_names, version, payload=None):
+        # Supplier ranks follow the sales channel's supplier ordering, so its price table is loaded anew.
+        if not self.remote and module_name == 'sales_channel' and SUPPLIER_ORDERING in method_names:
+            self.pricing_engine.submit(payload)
+
+    def warm_up(self):
+        if self.search_index is not None:
+            self.search_index.warm_up()
+
+    def invalidated(self, method_names, version, payload=None):
+        super().invalidated(method_names, version, payload)
+        if self.remote:
+            return
+        if PRICES in method_names:
+            if payload is None:
+                self.pricing_engine.submit(None)
+            else:
+                self.pricing_engine.submit(*payload)
+        if ATTRIBUTE_VALUES in method_names:
+            if payload is None:
+                attribute_value_index.clear()
+            else:
+                for attribute_name, name in payload:
+                    attribute_value_index.add(attribute_name, name)
+        if SEARCH in method_names and self.search_index is not None:
+            if payload is None:
+                self.search_index.build()
+            else:
+                self.search_index.refresh(payload)
+
+    def index_products(self, documents):
+        if self.search_index is not None and documents:
+            self.search_index.apply(documents)
+            for uuids in self.search_index.chunk_ids(documents):
+                self.invalidate((SEARCH,), payload=uuids)
+
+    def index_attribute_values(self, attribute_values):
+        if attribute_values:
+            for attribute_name, name in attribute_values:
+                attribute_value_index.add(attribute_name, name)
+            self.invalidate((ATTRIBUTE_VALUES,), payload=[list(attribute_value) for attribute_value in attribute_values])
+
+    def get_supplier_ranks(self, sales_channel_id, supplier_sku_ids):
+        sales_channel, errors = self.get('sales_channel').get_sales_channel(sales_channel_id)
+        ranks = {
+            supplier_id: rank
+            for rank, supplier_id
+            in enumerate(sales_channel['supplier_ids'] if sales_channel is not None else [])
+        }
+        return {
+            supplier_sku['uuid']: ranks.get(supplier_sku['supplier'], UNRANKED)
+            for supplier_sku
+            in self.get('supplier').get_supplier_skus(sorted(supplier_sku_ids))
+        }
+
+    @procedure(cache=60)
+    def get_products(self, limit=None, after=None, **kwargs):
+        products = []
+
+        _products = filter_query(Product.select().where(Product.deleted_at.is_null(True)), Product, kwargs)
+        _products = paginate(_products, Product, limit, after)
+
+        for product in prefetch_related(_products):
             products.append(product.to_dict())
 
         return products
 
-    @procedure
+    @procedure(cache=60)
+    def aggregate_products(self, count_by=None, min=(), max=(), **kwargs):
+        _products = filter_query(Product.select().where(Product.deleted_at.is_null(True)), Product, kwargs)
+        return aggregate(_products, Product, count_by, min, max)
+
+    @procedure(invalidates=('get_products', 'aggregate_products'))
     def create_product(self, dto):
         schema = Product.get_schema('create')
         errors = validate(dto, schema)
@@ -240,26 +673,124 @@ class ProductModule(Module):
         brand_attribute, _ = Attribute.get_or_create(name='Brand', defaults={'multiple': False})
         type_attribute, _ = Attribute.get_or_create(name='Type', defaults={'multiple': False})
 
-        brand_attribute_value, _ = AttributeValue.get_or_create(name=dto['brand'], attribute=brand_attribute)
-        type_attribute_value, _ = AttributeValue.get_or_create(name=dto['type'], attribute=type_attribute)
+        brand_attribute_value, brand_created = AttributeValue.get_or_create(
+            name=dto['brand'],
+            attribute=brand_attribute,
+            defaults={'search_vector': make_search_vector((dto['brand'], 'A'))},
+        )
+        type_attribute_value, type_created = AttributeValue.get_or_create(
+            name=dto['type'],
+            attribute=type_attribute,
+            defaults={'search_vector': make_search_vector((dto['type'], 'A'))},
+        )
+
+        self.index_attribute_values([
+            (attribute_name, attribute_value.name)
+            for attribute_name, attribute_value, created
+            in ((BRAND, brand_attribute_value, brand_created), (TYPE, type_attribute_value, type_created))
+            if created
+        ])
 
         product = Product.create(
             uuid=str(uuid4()),
             name=dto['name'],
             brand=brand_attribute_value,
             type=type_attribute_value,
+            search_vector=Product.make_search_vector(dto['name'], dto['type'], dto['brand']),
         )
 
+        self.index_products([make_product_document(product.uuid, dto['name'], dto['type'], dto['brand'])])
+
         return product.to_dict(), errors
 
-    @procedure
+    @procedure(invalidates=('get_products', 'aggregate_products'))
+    def import_products(self, data, format='jsonl', fieldnames=None, offset=0, chunk_size=1000):
+        return self.import_rows(parse_rows(io.StringIO(data), format, fieldnames), offset, chunk_size)
+
+    def import_products_from(self, lines, format='jsonl', chunk_size=1000):
+        report = {'rows': 0, 'created': 0, 'errors': [], 'seconds': 0.0}
+        rows = parse_rows(lines, format)
+        started_at = time.perf_counter()
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            result = self.import_rows(chunk, offset=report['rows'], chunk_size=chunk_size)
+            report['rows'] += result['rows']
+            report['created'] += result['created']
+            report['errors'].extend(result['errors'])
+
+        self.invalidate(('get_products', 'aggregate_products'))
+
+        report['seconds'] = time.perf_counter() - started_at
+        report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0
+
+        return report
+
+    def import_rows(self, parsed_rows, offset=0, chunk_size=1000):
+        started_at = time.perf_counter()
+        schema = Product.get_schema('create')
+        rows, errors = [], []
+
+        for i, (row, row_errors) in enumerate(parsed_rows, offset):
+            if not row_errors:
+                row_errors = validate(row, schema) if isinstance(row, dict) else ['row must be an object']
+            if row_errors:
+                errors.append([i, row_errors])
+            else:
+                rows.append(row)
+
+        resolved = {TYPE: {}, BRAND: {}}
+        database = Product._meta.database
+        documents = []
+
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            created = []
+            with database.atomic():
+                types = resolve_attribute_values(TYPE, (row['type'] for row in chunk), resolved[TYPE], created)
+                brands = resolve_attribute_values(BRAND, (row['brand'] for row in chunk), resolved[BRAND], created)
+                uuids = [str(uuid4()) for _ in chunk]
+                Product.insert_many([
+                    {
+                        'uuid': uuid,
+                        'name': row['name'],
+                        'type': types[row['type']],
+                        'brand': brands[row['brand']],
+                        'search_vector': Product.make_search_vector(row['name'], row['type'], row['brand']),
+                    }
+                    for uuid, row
+                    in zip(uuids, chunk)
+                ]).execute()
+            # Only once committed, so a rolled back chunk leaves no choices without rows behind.
+            self.index_attribute_values(created)
+            documents.extend(
+                make_product_document(uuid, row['name'], row['type'], row['brand'])
+                for uuid, row
+                in zip(uuids, chunk)
+            )
+
+        self.index_products(documents)
+
+        seconds = time.perf_counter() - started_at
+
+        return {
+            'rows': len(rows) + len(errors),
+            'created': len(rows),
+            'errors': errors,
+            'seconds': seconds,
+            'rows_per_second': (len(rows) + len(errors)) / seconds if seconds else 0,
+        }
+
+    @procedure(cache=60)
     def get_product(self, uuid):
         try:
             return Product.get(uuid=uuid).to_dict(), []
         except Product.DoesNotExist as e:
             return None, [str(e)]
 
-    @procedure
+    @procedure(invalidates=('get_product', 'get_products', 'aggregate_products'))
     def update_product(self, uuid, dto):
         product = Product.get(uuid=uuid)
         schema = Product.get_schema('update')
@@ -269,19 +800,242 @@ class ProductModule(Module):
         if errors:
             return False, errors
 
+        attribute_value_ids = (product.type_id, product.brand_id)
         processors = Product.get_processors(dto, schema)
         for process in processors:
             process(product)
-
+        self.index_attribute_values([
+            (attribute_name, attribute_value.name)
+            for attribute_name, attribute_value, attribute_value_id
+            in zip((TYPE, BRAND), (product.type, product.brand), attribute_value_ids)
+            if attribute_value.id != attribute_value_id
+        ])
+
+        product.search_vector = Product.make_search_vector(product.name, product.type.name, product.brand.name)
         product.save()
+        Article.update(
+            search_vector=make_search_vector((Article.name, 'A'), (product.name, 'B')),
+        ).where(Article.product == product).execute()
+
+        self.index_products([make_product_document(product.uuid, product.name, product.type.name, product.brand.name)])
 
         return True, []
 
-    @procedure
+    @procedure(invalidates=('get_product', 'get_products', 'aggregate_products'))
     def delete_product(self, uuid):
         product = Product.get(uuid=uuid)
         product.delete()
 
-    @procedure
+        self.index_products([[uuid, None, None]])
+
+    @procedure(cache=300)
     def get_product_schema(self, mode):
         return Product.get_schema(mode)
+
+    @procedure(idempotent=True)
+    def search_attribute_values(self, attribute_name, prefix='', offset=0, limit=20):
+        choices, count = attribute_value_index.search(attribute_name, prefix, offset, limit)
+        return {
+            'choices': choices,
+            'count': count,
+        }
+
+    @procedure(idempotent=True)
+    def get_articles(self, uuids, sales_channel_id=None):
+        articles = list(
+            Article
+            .select(Article, Product)
+            .join(Product)
+            .where(Article.uuid.in_(list(uuids)))
+        )
+        supplier_sku_ids = {article.id: [] for article in articles}
+        prices = {article.id: {} for article in articles}
+
+        for article_id, supplier_sku_id in (
+            ArticleSupplierSKU
+            .select(ArticleSupplierSKU.article, ArticleSupplierSKU.supplier_sku_id)
+            .where(ArticleSupplierSKU.article.in_(list(supplier_sku_ids)))
+            .order_by(ArticleSupplierSKU.id)
+            .tuples()
+        ):
+            supplier_sku_ids[article_id].append(supplier_sku_id)
+
+        if sales_channel_id is not None:
+            for article_id, supplier_sku_id, price in (
+                ArticleSupplierSKUPricing
+                .select(ArticleSupplierSKU.article, ArticleSupplierSKU.supplier_sku_id, ArticleSupplierSKUPricing.price)
+                .join(ArticleSupplierSKU)
+                .where(
+                    ArticleSupplierSKU.article.in_(list(prices)),
+                    ArticleSupplierSKUPricing.sales_channel_id == sales_channel_id,
+                )
+                .tuples()
+            ):
+                prices[article_id][supplier_sku_id] = str(price)
+            resolved = self.pricing_engine.resolve(sales_channel_id, [article.uuid for article in articles])
+        else:
+            resolved = {}
+
+        return [
+            dict(
+                article.to_dict(),
+                supplier_sku_ids=supplier_sku_ids[article.id],
+                prices=prices[article.id],
+                price=resolved.get(article.uuid),
+            )
+            for article
+            in articles
+        ]
+
+    @procedure(idempotent=True)
+    def resolve_prices(self, sales_channel_id, article_ids, strategy=PREFERRED):
+        return self.pricing_engine.resolve(sales_channel_id, list(article_ids), strategy)
+
+    @procedure
+    def set_prices(self, sales_channel_id, prices):
+        prices = [(price['article_id'], price['supplier_sku_id'], str(price['price'])) for price in prices]
+        keys = {(article_id, supplier_sku_id) for article_id, supplier_sku_id, _ in prices}
+
+        article_supplier_sku_ids = {
+            (article_id, supplier_sku_id): article_supplier_sku_id
+            for article_supplier_sku_id, article_id, supplier_sku_id
+            in ArticleSupplierSKU
+            .select(ArticleSupplierSKU.id, Article.uuid, ArticleSupplierSKU.supplier_sku_id)
+            .join(Article)
+            .where(peewee.Tuple(Article.uuid, ArticleSupplierSKU.supplier_sku_id).in_(sorted(keys)))
+            .tuples()
+        }
+        for key in keys - set(article_supplier_sku_ids):
+            raise ArticleSupplierSKU.DoesNotExist('article {!r} has no supplier SKU {!r}'.format(*key))
+
+        with ArticleSupplierSKUPricing._meta.database.atomic():
+            for batch in peewee.chunked(prices, 500):
+                ArticleSupplierSKUPricing.insert_many([
+                    dict(
+                        article_supplier_sku=article_supplier_sku_ids[(article_id, supplier_sku_id)],
+                        sales_channel_id=sales_channel_id,
+                        price=Decimal(price),
+                    )
+                    for article_id, supplier_sku_id, price
+                    in batch
+                ]).on_conflict(
+                    conflict_target=[ArticleSupplierSKUPricing.article_supplier_sku, ArticleSupplierSKUPricing.sales_channel_id],
+                    update={ArticleSupplierSKUPricing.price: peewee.EXCLUDED.price},
+                ).execute()
+
+        self.pricing_engine.set(sales_channel_id, prices)
+        # Other processes patch their price tables with the same rows.
+        self.invalidate((PRICES,), payload=[sales_channel_id, [list(price) for price in prices]])
+
+        return len(prices)
+
+    @procedure
+    def refresh_prices(self, sales_channel_id=None):
+        self.pricing_engine.reset(sales_channel_id)
+        self.invalidate((PRICES,))
+
+    def filter_facets(self, products, facets):
+        for attribute_name, field in ((TYPE, Product.type), (BRAND, Product.brand)):
+            if facets.get(attribute_name) is not None:
+                products = products.where(field.in_(
+                    AttributeValue
+                    .select(AttributeValue.id)
+                    .join(Attribute)
+                    .where(Attribute.name == attribute_name, AttributeValue.name == facets[attribute_name])
+                ))
+        return products
+
+    @procedure(idempotent=True)
+    def search_products(self, q, type=None, brand=None, offset=0, limit=20):
+        if self.search_index is not None:
+            self.search_index.warm_up()
+            found = self.search_index.search(q, offset, limit, filters={TYPE: type, BRAND: brand}, facets=(TYPE, BRAND))
+            products = {
+                product.uuid: product
+                for product
+                in prefetch_related(Product.select().where(Product.uuid.in_(found['results'])))
+            }
+            return dict(found, results=[products[uuid].to_dict() for uuid in found['results'] if uuid in products])
+
+        products = search_query(Product.select().where(Product.deleted_at.is_null(True)), Product, q)
+        selected = {TYPE: type, BRAND: brand}
+
+        facets = {}
+        for attribute_name, field in ((TYPE, Product.type), (BRAND, Product.brand)):
+            # Each facet counts the matches of the other selections, so choices stay visible.
+            counts = peewee.fn.COUNT(Product.id)
+            facets[attribute_name] = [
+                [name, count]
+                for name, count
+                in self.filter_facets(products, dict(selected, **{attribute_name: None}))
+                .select(AttributeValue.name, counts)
+                .join(AttributeValue, on=(field == AttributeValue.id))
+                .group_by(AttributeValue.name)
+                .order_by(counts.desc(), AttributeValue.name)
+                .tuples()
+            ]
+
+        products = self.filter_facets(products, selected)
+
+        return {
+            'results': [product.to_dict() for product in prefetch_related(products.offset(offset).limit(limit))],
+            'count': products.order_by().count(),
+            'facets': facets,
+        }
+
+    @procedure(idempotent=True)
+    def search_articles(self, q, offset=0, limit=20):
+        articles = search_query(
+            Article.select(Article, Product).join(Product).where(Product.deleted_at.is_null(True)),
+            Article,
+            q,
+        )
+
+        return {
+            'results': [article.to_dict() for article in articles.offset(offset).limit(limit)],
+            'count': articles.order_by().count(),
+        }
+
+    @procedure(idempotent=True)
+    def search_attributes(self, q, attribute_name=None, offset=0, limit=20):
+        attribute_values = search_query(
+            AttributeValue.select(AttributeValue, Attribute).join(Attribute),
+            AttributeValue,
+            q,
+        )
+        if attribute_name is not None:
+            attribute_values = attribute_values.where(Attribute.name == attribute_name)
+
+        return {
+            'results': [
+                dict(attribute=attribute_value.attribute.name, name=attribute_value.name)
+                for attribute_value
+                in attribute_values.offset(offset).limit(limit)
+            ],
+            'count': attribute_values.order_by().count(),
+        }
+
+    @procedure
+    def reindex_products(self):
+        Type, Brand = AttributeValue.alias(), AttributeValue.alias()
+        database = Product._meta.database
+
+        with database.atomic():
+            AttributeValue.update(
+                search_vector=make_search_vector((AttributeValue.name, 'A')),
+            ).execute()
+            updated = Product.update(
+                search_vector=Product.make_search_vector(
+                    Product.name,
+                    Type.select(Type.name).where(Type.id == Product.type),
+                    Brand.select(Brand.name).where(Brand.id == Product.brand),
+                ),
+            ).execute()
+            Article.update(
+                search_vector=make_search_vector(
+                    (Article.name, 'A'),
+                    (Product.select(Product.name).where(Product.id == Article.product), 'B'),
+                ),
+            ).execute()
+
+        return updated
@@ -1,9 +1,13 @@
+import os
+
 from datetime import datetime
 from uuid import uuid4
 
-from modules.base import Module, procedure
+from modules.base import Module, procedure, filter_query, paginate, prefetch_related, aggregate, make_search_vector, search_query
+from modules.inverted_index import SearchIndex
 
 import peewee
+from playhouse.postgres_ext import TSVectorField
 
 
 class SalesChannel(peewee.Model):
@@ -20,6 +24,7 @@ class SalesChannel(peewee.Model):
     type = peewee.CharField(constraints=[peewee.Check("type in {!r}".format(TYPES))])
     created_at = peewee.DateTimeField(default=datetime.now)
     deleted_at = peewee.DateTimeField(null=True)
+    search_vector = TSVectorField(null=True)
 
     @property
     def supplier_ids(self):
@@ -28,15 +33,24 @@ class SalesChannel(peewee.Model):
                 'supplier_ids': [
                     sales_channel_supplier.supplier_id
                     for sales_channel_supplier
-                    in (
-                        supplier.supplier_id
-                        for supplier
-                        in self.suppliers
-                    )
+                    in self.suppliers.order_by(SalesChannelSupplier.ordering)
                 ]
             })
         return self.__dict__['supplier_ids']
 
+    @classmethod
+    def load_related(cls, sales_channels):
+        supplier_ids = {sales_channel.id: [] for sales_channel in sales_channels}
+        for sales_channel_supplier in (
+            SalesChannelSupplier
+            .select()
+            .where(SalesChannelSupplier.sales_channel.in_(list(supplier_ids)))
+            .order_by(SalesChannelSupplier.ordering)
+        ):
+            supplier_ids[sales_channel_supplier.sales_channel_id].append(sales_channel_supplier.supplier_id)
+        for sales_channel in sales_channels:
+            sales_channel.__dict__['supplier_ids'] = supplier_ids[sales_channel.id]
+
     def to_dict(self):
         return {
             'uuid': self.uuid,
@@ -84,35 +98,98 @@ class SalesChannelSupplier(peewee.Model):
     ordering = peewee.SmallIntegerField()
 
     class Meta:
-        database = db
         indexes = (
             (('sales_channel', 'supplier_id'), True),
         )
 
 
+SEARCH = 'search'
+# Published with the sales channel's uuid whenever its suppliers or their ordering change.
+SUPPLIER_ORDERING = 'supplier_ordering'
+
+
+def load_sales_channel_documents(uuids=None):
+    sales_channels = SalesChannel.select(SalesChannel.uuid, SalesChannel.name).where(
+        SalesChannel.deleted_at.is_null(True)
+    )
+    if uuids is not None:
+        sales_channels = sales_channels.where(SalesChannel.uuid.in_(uuids))
+    for uuid, name in sales_channels.tuples().iterator():
+        yield uuid, name, None
+
+
+def get_sales_channels_fingerprint():
+    # A sum of row hashes, so that renames change it as well as creates and deletes.
+    count, digest = SalesChannel.select(
+        peewee.fn.COUNT(SalesChannel.id),
+        peewee.fn.SUM(peewee.fn.hashtextextended(SalesChannel.uuid.concat(':').concat(SalesChannel.name), 0)),
+    ).where(SalesChannel.deleted_at.is_null(True)).tuples().get()
+    return [count, str(digest or 0)]
+
+
 class SalesChannelModule(Module):
     name = 'sales_channel'
+    models = (
+        SalesChannel,
+        SalesChannelSupplier,
+    )
+    search_backend = 'database'
+    search_index_path = None
+
+    def __init__(self, *args, **kwargs):
+        self.search_backend = kwargs.pop('search_backend', None) or self.search_backend
+        self.search_index_path = kwargs.pop('search_index_path', None) or self.search_index_path
+        super().__init__(*args, **kwargs)
+        self.search_index = None
+        if self.search_backend == 'memory' and not self.remote:
+            self.search_index = SearchIndex(
+                os.path.join(self.search_index_path, 'sales_channel.idx') if self.search_index_path else None,
+                load_documents=load_sales_channel_documents,
+                get_fingerprint=get_sales_channels_fingerprint,
+            )
 
-    @procedure
+    def warm_up(self):
+        if self.search_index is not None:
+            self.search_index.warm_up()
+
+    def invalidated(self, method_names, version, payload=None):
+        super().invalidated(method_names, version, payload)
+        if self.search_index is None or SEARCH not in method_names:
+            return
+        if payload is None:
+            self.search_index.build()
+        else:
+            self.search_index.refresh(payload)
+
+    def index_sales_channels(self, documents):
+        if self.search_index is not None and documents:
+            self.search_index.apply(documents)
+            for uuids in self.search_index.chunk_ids(documents):
+                self.invalidate((SEARCH,), payload=uuids)
+
+    @procedure(invalidates=('get_sales_channels', 'aggregate_sales_channels'))
     def create_sales_channel(self, name, type=SalesChannel.ONLINE_SHOP, suppliers=None):
         uuid = str(uuid4())
         sales_channel = SalesChannel.create(
             uuid=uuid,
             name=name,
             type=type,
+            search_vector=make_search_vector((name, 'A')),
         )
 
         for i, supplier in enumerate(suppliers or []):
             supplier_id = supplier['uuid'] if isinstance(supplier, dict) else supplier
             SalesChannelSupplier.create(
                 sales_channel=sales_channel,
-                supplier=supplier_id,
+                supplier_id=supplier_id,
                 ordering=i,
             )
 
+        self.index_sales_channels([[uuid, name, None]])
+
         return sales_channel.to_dict()
 
-    @procedure
+    @procedure(cache=60)
     def get_sales_channel(self, uuid):
         try:
             sales_channel = SalesChannel.get(uuid=str(uuid)).to_dict()
@@ -120,24 +197,24 @@ class SalesChannelModule(Module):
             return None, [str(e)]
         return sales_channel, []
 
-    @procedure
-    def get_sales_channels(self, **kwargs):
+    @procedure(cache=60)
+    def get_sales_channels(self, limit=None, after=None, **kwargs):
         sales_channels = []
 
-        _sales_channels = SalesChannel.select().where(SalesChannel.deleted_at.is_null(True))
-        if kwargs:
-            _sales_channels = _sales_channels.where(*(
-                getattr(SalesChannel, keyword) == argument
-                for keyword, argument
-                in kwargs.items()
-            ))
+        _sales_channels = filter_query(SalesChannel.select().where(SalesChannel.deleted_at.is_null(True)), SalesChannel, kwargs)
+        _sales_channels = paginate(_sales_channels, SalesChannel, limit, after)
 
-        for sales_channel in _sales_channels:
+        for sales_channel in prefetch_related(_sales_channels):
             sales_channels.append(sales_channel.to_dict())
 
         return sales_channels
 
-    @procedure
+    @procedure(cache=60)
+    def aggregate_sales_channels(self, count_by=None, min=(), max=(), **kwargs):
+        _sales_channels = filter_query(SalesChannel.select().where(SalesChannel.deleted_at.is_null(True)), SalesChannel, kwargs)
+        return aggregate(_sales_channels, SalesChannel, count_by, min, max)
+
+    @procedure(invalidates=('get_sales_channel', 'get_sales_channels', 'aggregate_sales_channels'))
     def update_sales_channel(self, uuid, name=None, type=None):
         updates = {}
         if name:
@@ -148,18 +225,43 @@ class SalesChannelModule(Module):
         sales_channel = SalesChannel.get(uuid=uuid)
         for field, value in updates.items():
             setattr(sales_channel, field, value)
+        if 'name' in updates:
+            sales_channel.search_vector = make_search_vector((sales_channel.name, 'A'))
         sales_channel.save(only=sales_channel.dirty_fields)
 
+        if 'name' in updates:
+            self.index_sales_channels([[sales_channel.uuid, sales_channel.name, None]])
+
     @procedure
+    def set_sales_channel_suppliers(self, uuid, suppliers):
+        sales_channel = SalesChannel.get(uuid=uuid)
+        with SalesChannelSupplier._meta.database.atomic():
+            SalesChannelSupplier.delete().where(SalesChannelSupplier.sales_channel == sales_channel).execute()
+            for i, supplier in enumerate(suppliers):
+                supplier_id = supplier['uuid'] if isinstance(supplier, dict) else supplier
+                SalesChannelSupplier.create(
+                    sales_channel=sales_channel,
+                    supplier_id=supplier_id,
+                    ordering=i,
+                )
+
+        # In one notification, so that watchers of the ordering never read a cached sales channel.
+        self.invalidate(('get_sales_channel', 'get_sales_channels', SUPPLIER_ORDERING), payload=uuid)
+
+        return SalesChannel.get(uuid=uuid).to_dict()
+
+    @procedure(invalidates=('get_sales_channel', 'get_sales_channels', 'aggregate_sales_channels'))
     def delete_sales_channel(self, uuid):
         try:
             SalesChannel.get(SalesChannel.uuid == uuid).delete()
         except SalesChannel.DoesNotExist as e:
             return False, [str(e)]
 
+        self.index_sales_channels([[uuid, None, None]])
+
         return True, [['Sales Channel was deleted.', 'success']]
 
-    @procedure
+    @procedure(idempotent=True)
     def find_sales_channel_which_uuid_starts_with(self, string):
         try:
             sales_channel = SalesChannel.get(SalesChannel.uuid.startswith(string)).to_dict()
@@ -167,33 +269,37 @@ class SalesChannelModule(Module):
             sales_channel = None
         return sales_channel
 
-    @procedure
-    def search_for_sales_channels(self, q):
+    @procedure(idempotent=True)
+    def search_for_sales_channels(self, q, offset=0, limit=None):
         sales_channels = []
-        if q:
-            q = ' & '.join(q.split())
-            sql = """
-            SELECT
-                *
-            FROM
-                "saleschannel"
-            WHERE
-                to_tsvector('english', "saleschannel"."name") @@ to_tsquery('english', %s)
-            ORDER BY
-                ts_rank(
-                    to_tsvector('english', "saleschannel"."name"),
-                    to_tsquery('english', %s)
-                )
-            """
 
-            for sales_channel in SalesChannel.raw(sql, *[str(q) for _ in range(2)]):
-                sales_channels.append(sales_channel.to_dict())
-        else:
-            for sales_channel in SalesChannel.select():
-                sales_channels.append(sales_channel.to_dict())
+        if self.search_index is not None:
+            self.search_index.warm_up()
+            uuids = self.search_index.search(q, offset, limit)['results']
+            _sales_channels = {
+                sales_channel.uuid: sales_channel
+                for sales_channel
+                in prefetch_related(SalesChannel.select().where(SalesChannel.uuid.in_(uuids)))
+            }
+            return [_sales_channels[uuid].to_dict() for uuid in uuids if uuid in _sales_channels]
+
+        _sales_channels = search_query(
+            SalesChannel.select().where(SalesChannel.deleted_at.is_null(True)),
+            SalesChannel,
+            q,
+        ).offset(offset).limit(limit)
+
+        for sales_channel in prefetch_related(_sales_channels):
+            sales_channels.append(sales_channel.to_dict())
 
         return sales_channels
 
     @procedure
+    def reindex_sales_channels(self):
+        return SalesChannel.update(
+            search_vector=make_search_vector((SalesChannel.name, 'A')),
+        ).execute()
+
+    @procedure(cache=300)
     def get_sales_channel_schema(self, mode):
         return SalesChannel.get_schema(mode)
@@ -1,13 +1,17 @@
+from datetime import datetime
 from uuid import uuid4
 
-from modules.base import Module, procedure
+from modules.base import Module, procedure, filter_query, paginate, prefetch_related, aggregate, make_search_vector, search_query
 
 import peewee
+from playhouse.postgres_ext import TSVectorField
 
 
 class Supplier(peewee.Model):
     uuid = peewee.CharField(unique=True)
     name = peewee.CharField()
+    created_at = peewee.DateTimeField(default=datetime.now)
+    search_vector = TSVectorField(null=True)
 
     @property
     def fulfillment_center_ids(self):
@@ -16,11 +20,26 @@ class Supplier(peewee.Model):
                 'fulfillment_center_ids': [
                     fulfillment_center.fulfillment_center_id
                     for fulfillment_center
-                    in self.fulfillment_centers
+                    in self.fulfillment_centers.order_by(SupplierFulfillmentCenter.ordering)
                 ]
             })
         return self.__dict__['fulfillment_center_ids']
 
+    @classmethod
+    def load_related(cls, suppliers):
+        fulfillment_center_ids = {supplier.id: [] for supplier in suppliers}
+        for supplier_fulfillment_center in (
+            SupplierFulfillmentCenter
+            .select()
+            .where(SupplierFulfillmentCenter.supplier.in_(list(fulfillment_center_ids)))
+            .order_by(SupplierFulfillmentCenter.ordering)
+        ):
+            fulfillment_center_ids[supplier_fulfillment_center.supplier_id].append(
+                supplier_fulfillment_center.fulfillment_center_id
+            )
+        for supplier in suppliers:
+            supplier.__dict__['fulfillment_center_ids'] = fulfillment_center_ids[supplier.id]
+
     def to_dict(self):
         return dict(
             uuid=self.uuid,
@@ -64,12 +83,19 @@ class SupplierFulfillmentCenterSKU(peewee.Model):
 
 class SupplierModule(Module):
     name = 'supplier'
-
-    @procedure
+    models = (
+        Supplier,
+        SupplierFulfillmentCenter,
+        SupplierSKU,
+        SupplierFulfillmentCenterSKU,
+    )
+
+    @procedure(invalidates=('get_suppliers', 'aggregate_suppliers'))
     def create_supplier(self, name, fulfillment_center_ids=None):
         supplier = Supplier.create(
             uuid=str(uuid4()),
             name=name,
+            search_vector=make_search_vector((name, 'A')),
         )
 
         for i, fulfillment_center in enumerate(fulfillment_center_ids or []):
@@ -82,7 +108,7 @@ class SupplierModule(Module):
 
         return supplier.to_dict()
 
-    @procedure
+    @procedure(cache=60)
     def get_supplier(self, uuid):
         try:
             supplier = Supplier.get(uuid=uuid).to_dict()
@@ -90,19 +116,72 @@ class SupplierModule(Module):
             supplier = None
         return supplier
 
-    @procedure
-    def get_suppliers(self, **kwargs):
+    @procedure(cache=60)
+    def get_suppliers(self, limit=None, after=None, **kwargs):
         suppliers = []
 
-        _suppliers = Supplier.select()
-        if kwargs:
-            _suppliers = _suppliers.where(*(
-                getattr(Supplier, keyword) == argument
-                for keyword, argument
-                in kwargs.items()
-            ))
+        _suppliers = filter_query(Supplier.select(), Supplier, kwargs)
+        _suppliers = paginate(_suppliers, Supplier, limit, after)
 
-        for supplier in _suppliers:
+        for supplier in prefetch_related(_suppliers):
             suppliers.append(supplier.to_dict())
 
         return suppliers
+
+    @procedure(cache=60)
+    def aggregate_suppliers(self, count_by=None, min=(), max=(), **kwargs):
+        _suppliers = filter_query(Supplier.select(), Supplier, kwargs)
+        return aggregate(_suppliers, Supplier, count_by, min, max)
+
+    @procedure(idempotent=True)
+    def search_suppliers(self, q, offset=0, limit=20):
+        suppliers = []
+
+        _suppliers = search_query(Supplier.select(), Supplier, q)
+
+        for supplier in prefetch_related(_suppliers.offset(offset).limit(limit)):
+            suppliers.append(supplier.to_dict())
+
+        return {
+            'results': suppliers,
+            'count': _suppliers.order_by().count(),
+        }
+
+    @procedure
+    def reindex_suppliers(self):
+        return Supplier.update(
+            search_vector=make_search_vector((Supplier.name, 'A')),
+        ).execute()
+
+    @procedure(idempotent=True)
+    def get_supplier_skus(self, uuids):
+        supplier_skus = list(
+            SupplierSKU
+            .select(SupplierSKU, Supplier)
+            .join(Supplier)
+            .where(SupplierSKU.uuid.in_(list(uuids)))
+        )
+        fulfillment_center_skus = {supplier_sku.id: {} for supplier_sku in supplier_skus}
+
+        for supplier_sku_id, fulfillment_center_id, sku in (
+            SupplierFulfillmentCenterSKU
+            .select(
+                SupplierFulfillmentCenterSKU.supplier_sku,
+                SupplierFulfillmentCenterSKU.fulfillment_center_id,
+                SupplierFulfillmentCenterSKU.sku,
+            )
+            .where(SupplierFulfillmentCenterSKU.supplier_sku.in_(list(fulfillment_center_skus)))
+            .tuples()
+        ):
+            fulfillment_center_skus[supplier_sku_id][fulfillment_center_id] = sku
+
+        return [
+            dict(
+                uuid=supplier_sku.uuid,
+                supplier=supplier_sku.supplier.uuid,
+                sku=supplier_sku.sku,
+                fulfillment_center_skus=fulfillment_center_skus[supplier_sku.id],
+            )
+            for supplier_sku
+            in supplier_skus
+        ]
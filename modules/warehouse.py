@@ -1,13 +1,21 @@
+import os
+import time
+import threading
+import traceback
+
+from datetime import datetime
 from uuid import uuid4
 
-from modules.base import Module, procedure
+from modules.base import Module, procedure, filter_query, paginate, prefetch_related, aggregate
 
 import peewee
+from peewee import EXCLUDED, Tuple, Value, chunked, fn
 
 
 class Warehouse(peewee.Model):
     uuid = peewee.CharField(unique=True)
     name = peewee.CharField()
+    created_at = peewee.DateTimeField(default=datetime.now)
 
     def to_dict(self):
         return dict(
@@ -21,6 +29,8 @@ class WarehouseStockLine(peewee.Model):
     location = peewee.CharField()
     sku = peewee.CharField()
     quantity = peewee.IntegerField()
+    # Id of the last movement applied, so that stock index updates can be ordered.
+    version = peewee.IntegerField(default=0)
 
     class Meta:
         indexes = (
@@ -28,10 +38,345 @@ class WarehouseStockLine(peewee.Model):
         )
 
 
+class StockMovement(peewee.Model):
+    warehouse = peewee.ForeignKeyField(Warehouse, backref='stock_movements')
+    location = peewee.CharField()
+    sku = peewee.CharField()
+    delta = peewee.IntegerField()
+    reason = peewee.CharField(default='')
+    created_at = peewee.DateTimeField(default=datetime.now, index=True)
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            warehouse=get_warehouse_uuid(self.warehouse_id),
+            location=self.location,
+            sku=self.sku,
+            delta=self.delta,
+            reason=self.reason,
+            created_at=self.created_at.isoformat(),
+        )
+
+
+class StockSnapshot(peewee.Model):
+    last_movement_id = peewee.IntegerField()
+    created_at = peewee.DateTimeField(default=datetime.now, index=True)
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            last_movement_id=self.last_movement_id,
+            created_at=self.created_at.isoformat(),
+        )
+
+
+class StockSnapshotLine(peewee.Model):
+    snapshot = peewee.ForeignKeyField(StockSnapshot, backref='lines', on_delete='CASCADE')
+    warehouse = peewee.ForeignKeyField(Warehouse)
+    location = peewee.CharField()
+    sku = peewee.CharField()
+    quantity = peewee.IntegerField()
+
+    class Meta:
+        indexes = (
+            (('snapshot', 'warehouse', 'location', 'sku'), True),
+        )
+
+
+STOCK = 'stock'
+# Advisory lock key held while a stock snapshot is taken.
+STOCK_SNAPSHOT_LOCK = 0x73746f636b
+
+ADD = 'add'
+REMOVE = 'remove'
+SET = 'set'
+
+warehouse_ids, warehouse_uuids = {}, {}
+
+
+def get_warehouse_id(warehouse):
+    warehouse_uuid = warehouse['uuid'] if isinstance(warehouse, dict) else warehouse
+    if warehouse_uuid not in warehouse_ids:
+        warehouse_id = Warehouse.select(Warehouse.id).where(Warehouse.uuid == warehouse_uuid).scalar()
+        if warehouse_id is None:
+            raise Warehouse.DoesNotExist('warehouse {!r} does not exist'.format(warehouse_uuid))
+        warehouse_ids[warehouse_uuid], warehouse_uuids[warehouse_id] = warehouse_id, warehouse_uuid
+    return warehouse_ids[warehouse_uuid]
+
+
+def get_warehouse_uuid(warehouse_id):
+    if warehouse_id not in warehouse_uuids:
+        warehouse_uuid = Warehouse.select(Warehouse.uuid).where(Warehouse.id == warehouse_id).scalar()
+        warehouse_ids[warehouse_uuid], warehouse_uuids[warehouse_id] = warehouse_id, warehouse_uuid
+    return warehouse_uuids[warehouse_id]
+
+
+def upsert_stock_lines(rows, increment, versions):
+    query = WarehouseStockLine.insert_many(
+        [
+            dict(warehouse=key[0], location=key[1], sku=key[2], quantity=quantity, version=versions[key])
+            for key, quantity
+            in rows
+        ],
+    ).on_conflict(
+        conflict_target=[WarehouseStockLine.warehouse, WarehouseStockLine.location, WarehouseStockLine.sku],
+        update={
+            WarehouseStockLine.quantity: (
+                WarehouseStockLine.quantity + EXCLUDED.quantity
+                if increment
+                else EXCLUDED.quantity
+            ),
+            WarehouseStockLine.version: EXCLUDED.version,
+        },
+    ).returning(
+        WarehouseStockLine.warehouse,
+        WarehouseStockLine.location,
+        WarehouseStockLine.sku,
+        WarehouseStockLine.quantity,
+        WarehouseStockLine.version,
+    )
+
+    return {
+        (stock_line.warehouse_id, stock_line.location, stock_line.sku): (stock_line.quantity, stock_line.version)
+        for stock_line
+        in query.execute()
+    }
+
+
+def lock_stock_lines(keys):
+    if not keys:
+        return {}
+    # Create missing lines first so that concurrent movements serialize on the row lock.
+    WarehouseStockLine.insert_many([
+        dict(warehouse=warehouse_id, location=location, sku=sku, quantity=0)
+        for warehouse_id, location, sku
+        in keys
+    ]).on_conflict_ignore().execute()
+
+    query = WarehouseStockLine.select(
+        WarehouseStockLine.warehouse,
+        WarehouseStockLine.location,
+        WarehouseStockLine.sku,
+        WarehouseStockLine.quantity,
+    ).where(
+        Tuple(WarehouseStockLine.warehouse, WarehouseStockLine.location, WarehouseStockLine.sku).in_(keys)
+    )
+    if isinstance(WarehouseStockLine._meta.database, peewee.PostgresqlDatabase):
+        query = query.order_by(
+            WarehouseStockLine.warehouse,
+            WarehouseStockLine.location,
+            WarehouseStockLine.sku,
+        ).for_update()
+
+    return {
+        (warehouse_id, location, sku): quantity
+        for warehouse_id, location, sku, quantity
+        in query.tuples()
+    }
+
+
+def record_stock_movements(entries, previous, batch_size=500):
+    quantities, created_at, rows = dict(previous), datetime.now(), []
+
+    for key, type, quantity, reason in entries:
+        if type == SET:
+            delta = quantity - quantities[key]
+            quantities[key] = quantity
+        else:
+            delta = quantity
+            if key in quantities:
+                quantities[key] += quantity
+        rows.append(dict(
+            warehouse=key[0],
+            location=key[1],
+            sku=key[2],
+            delta=delta,
+            reason=reason,
+            created_at=created_at,
+        ))
+
+    versions = {}
+    for batch in chunked(rows, batch_size):
+        for movement in StockMovement.insert_many(batch).returning(
+            StockMovement.id,
+            StockMovement.warehouse,
+            StockMovement.location,
+            StockMovement.sku,
+        ).execute():
+            key = (movement.warehouse_id, movement.location, movement.sku)
+            versions[key] = max(versions.get(key, 0), movement.id)
+
+    return versions
+
+
+def filter_stock_query(query, model, skus=None, warehouse_ids=None):
+    if skus is not None:
+        query = query.where(model.sku.in_(skus))
+    if warehouse_ids is not None:
+        query = query.where(model.warehouse.in_(warehouse_ids))
+    return query
+
+
+def replay_stock_movements(at=None, skus=None, warehouse_ids=None):
+    quantities = {}
+
+    snapshots = StockSnapshot.select().order_by(StockSnapshot.id.desc())
+    if at is not None:
+        snapshots = snapshots.where(StockSnapshot.created_at <= at)
+    snapshot = snapshots.first()
+
+    if snapshot is not None:
+        lines = StockSnapshotLine.select(
+            StockSnapshotLine.warehouse,
+            StockSnapshotLine.location,
+            StockSnapshotLine.sku,
+            StockSnapshotLine.quantity,
+        ).where(StockSnapshotLine.snapshot == snapshot)
+        for warehouse_id, location, sku, quantity in filter_stock_query(
+            lines, StockSnapshotLine, skus, warehouse_ids,
+        ).tuples():
+            quantities[(warehouse_id, location, sku)] = quantity
+
+    movements = StockMovement.select(
+        StockMovement.warehouse,
+        StockMovement.location,
+        StockMovement.sku,
+        fn.SUM(StockMovement.delta),
+    ).where(
+        StockMovement.id > (snapshot.last_movement_id if snapshot is not None else 0)
+    ).group_by(
+        StockMovement.warehouse,
+        StockMovement.location,
+        StockMovement.sku,
+    )
+    if at is not None:
+        movements = movements.where(StockMovement.created_at <= at)
+    for warehouse_id, location, sku, delta in filter_stock_query(
+        movements, StockMovement, skus, warehouse_ids,
+    ).tuples():
+        key = (warehouse_id, location, sku)
+        quantities[key] = quantities.get(key, 0) + delta
+
+    return quantities
+
+
+class StockIndex:
+    def __init__(self):
+        self.locations = None
+        self.warehouses = None
+        self.versions = None
+        self.lock = threading.RLock()
+
+    def build(self):
+        locations, warehouses, versions = {}, {}, {}
+        with self.lock:
+            for warehouse_id, warehouse_uuid in Warehouse.select(Warehouse.id, Warehouse.uuid).tuples():
+                warehouse_ids[warehouse_uuid], warehouse_uuids[warehouse_id] = warehouse_id, warehouse_uuid
+            for warehouse_id, location, sku, quantity, version in WarehouseStockLine.select(
+                WarehouseStockLine.warehouse,
+                WarehouseStockLine.location,
+                WarehouseStockLine.sku,
+                WarehouseStockLine.quantity,
+                WarehouseStockLine.version,
+            ).tuples():
+                locations.setdefault((warehouse_id, sku), {})[location] = quantity
+                totals = warehouses.setdefault(sku, {})
+                totals[warehouse_id] = totals.get(warehouse_id, 0) + quantity
+                versions[(warehouse_id, location, sku)] = version
+            self.locations, self.warehouses, self.versions = locations, warehouses, versions
+
+    def reset(self):
+        with self.lock:
+            self.locations = self.warehouses = self.versions = None
+
+    def ensure_built(self):
+        if self.locations is None:
+            self.build()
+
+    def set(self, warehouse_id, location, sku, quantity, version):
+        with self.lock:
+            self.ensure_built()
+            # Skips updates the index already reflects, e.g. ones committed before it was built.
+            if version <= self.versions.get((warehouse_id, location, sku), -1):
+                return
+            self.versions[(warehouse_id, location, sku)] = version
+            locations = self.locations.setdefault((warehouse_id, sku), {})
+            totals = self.warehouses.setdefault(sku, {})
+            totals[warehouse_id] = totals.get(warehouse_id, 0) + quantity - locations.get(location, 0)
+            locations[location] = quantity
+
+    def count(self, skus, warehouse_ids=None, by_location=False):
+        with self.lock:
+            self.ensure_built()
+            counts = {}
+            for sku in skus:
+                totals = self.warehouses.get(sku, {})
+                if warehouse_ids is not None:
+                    totals = {
+                        warehouse_id: totals[warehouse_id]
+                        for warehouse_id
+                        in warehouse_ids
+                        if warehouse_id in totals
+                    }
+                counts[sku] = dict(
+                    quantity=sum(totals.values()),
+                    warehouses={
+                        warehouse_uuids[warehouse_id]: (
+                            dict(self.locations[(warehouse_id, sku)])
+                            if by_location
+                            else quantity
+                        )
+                        for warehouse_id, quantity
+                        in totals.items()
+                    },
+                )
+            return counts
+
+
 class WarehouseModule(Module):
     name = 'warehouse'
+    models = (
+        Warehouse,
+        WarehouseStockLine,
+        StockMovement,
+        StockSnapshot,
+        StockSnapshotLine,
+    )
+    stock_snapshot_interval = 10000
+    stock_snapshot_check_interval = 60
 
-    @procedure
+    def __init__(self, *args, **kwargs):
+        self.stock_snapshot_interval = kwargs.pop('stock_snapshot_interval', None) or self.stock_snapshot_interval
+        super().__init__(*args, **kwargs)
+        self.stock_index = StockIndex()
+        self.stock_snapshotter_pid = None
+
+    def start_stock_snapshotter(self):
+        # Like the invalidation listener, the snapshotter thread has to be restarted after a fork.
+        if self.stock_snapshotter_pid == os.getpid():
+            return
+        self.stock_snapshotter_pid = os.getpid()
+        threading.Thread(target=self.run_stock_snapshotter, daemon=True).start()
+
+    def run_stock_snapshotter(self):
+        while True:
+            time.sleep(self.stock_snapshot_check_interval)
+            try:
+                self.snapshot_stock_if_due()
+            except Exception:
+                traceback.print_exc()
+
+    def invalidated(self, method_names, version, payload=None):
+        super().invalidated(method_names, version, payload)
+        if self.remote or STOCK not in method_names:
+            return
+        if payload is None:
+            self.stock_index.reset()
+            return
+        for warehouse_id, location, sku, quantity, version in payload:
+            self.stock_index.set(warehouse_id, location, sku, quantity, version)
+
+    @procedure(invalidates=('get_warehouses', 'aggregate_warehouses'))
     def create_warehouse(self, name):
         warehouse = Warehouse.create(
             uuid=str(uuid4()),
@@ -40,7 +385,7 @@ class WarehouseModule(Module):
 
         return warehouse.to_dict()
 
-    @procedure
+    @procedure(cache=60)
     def get_warehouse(self, uuid):
         try:
             warehouse = Warehouse.get(uuid=uuid).to_dict()
@@ -48,76 +393,221 @@ class WarehouseModule(Module):
             warehouse = None
         return warehouse
 
-    @procedure
-    def get_warehouses(self, **kwargs):
+    @procedure(cache=60)
+    def get_warehouses(self, limit=None, after=None, **kwargs):
         warehouses = []
 
-        _warehouses = Warehouse.select()
-        if kwargs:
-            _warehouses = _warehouses.where(*(
-                getattr(Warehouse, keyword) == argument
-                for keyword, argument
-                in kwargs.items()
-            ))
+        _warehouses = filter_query(Warehouse.select(), Warehouse, kwargs)
+        _warehouses = paginate(_warehouses, Warehouse, limit, after)
 
-        for warehouse in _warehouses:
+        for warehouse in prefetch_related(_warehouses):
             warehouses.append(warehouse.to_dict())
 
         return warehouses
 
-    @procedure
+    @procedure(cache=60)
+    def aggregate_warehouses(self, count_by=None, min=(), max=(), **kwargs):
+        _warehouses = filter_query(Warehouse.select(), Warehouse, kwargs)
+        return aggregate(_warehouses, Warehouse, count_by, min, max)
+
+    @procedure(idempotent=True)
     def count_stock(self, warehouse_id, sku):
-        count = 0
+        return self.count_stock_many([sku], [warehouse_id])[sku]['quantity']
 
-        for stock_line in Warehouse.get(uuid=warehouse_id).stock_lines.where(sku=sku):
-            count += stock_line.quantity
+    @procedure(idempotent=True)
+    def count_stock_many(self, skus, warehouse_ids=None, by_location=False, skip_missing=False):
+        if warehouse_ids is not None:
+            ids = []
+            for warehouse in warehouse_ids:
+                try:
+                    ids.append(get_warehouse_id(warehouse))
+                except Warehouse.DoesNotExist:
+                    if not skip_missing:
+                        raise
+            warehouse_ids = ids
+        return self.stock_index.count(skus, warehouse_ids, by_location)
 
-        return count
+    @procedure
+    def add_stock(self, warehouse, sku, location, quantity, reason=''):
+        return self.apply_stock_movements([
+            dict(warehouse=warehouse, sku=sku, location=location, quantity=quantity, type=ADD, reason=reason),
+        ])[0]['quantity']
 
     @procedure
-    def add_stock(self, warehouse, sku, location, quantity):
-        warehouse_id = warehouse['uuid'] if isinstance(warehouse, dict) else warehouse
-        warehouse = Warehouse.get(uuid=warehouse_id)
-        stock_lines = warehouse.stock_lines.where(sku=sku, location=location)
-        if not stock_lines.exists():
-            stock_line = WarehouseStockLine.create(
-                warehouse=warehouse,
-                location=location,
-                sku=sku,
-                quantity=0,
+    def remove_stock(self, warehouse, sku, location, quantity, reason=''):
+        return self.apply_stock_movements([
+            dict(warehouse=warehouse, sku=sku, location=location, quantity=quantity, type=REMOVE, reason=reason),
+        ])[0]['quantity']
+
+    @procedure(idempotent=True)
+    def set_stock(self, warehouse, sku, location, quantity, reason=''):
+        return self.apply_stock_movements([
+            dict(warehouse=warehouse, sku=sku, location=location, quantity=quantity, type=SET, reason=reason),
+        ])[0]['quantity']
+
+    @procedure
+    def apply_stock_movements(self, movements):
+        keys, increments, assignments, entries = [], {}, {}, []
+
+        for movement in movements:
+            key = (
+                get_warehouse_id(movement['warehouse']),
+                movement['location'],
+                movement['sku'],
+            )
+            if key not in increments and key not in assignments:
+                keys.append(key)
+            type, quantity = movement.get('type', ADD), int(movement['quantity'])
+            if type == SET:
+                increments.pop(key, None)
+                assignments[key] = quantity
+            elif type in (ADD, REMOVE):
+                quantity = quantity if type == ADD else -quantity
+                if key in assignments:
+                    assignments[key] += quantity
+                else:
+                    increments[key] = increments.get(key, 0) + quantity
+            else:
+                raise ValueError('unknown stock movement type {!r}'.format(type))
+            entries.append((key, type, quantity, movement.get('reason', '')))
+
+        self.start_stock_snapshotter()
+
+        quantities = {}
+        with WarehouseStockLine._meta.database.atomic():
+            # Every line is locked up front in one sorted pass, so concurrent batches
+            # take their row locks in the same order whatever mix of movements they hold.
+            # The locked quantities also turn assignments into ledger deltas.
+            previous = lock_stock_lines(sorted(increments.keys() | assignments.keys()))
+            versions = record_stock_movements(entries, previous)
+            for rows, increment in ((increments, True), (assignments, False)):
+                if rows:
+                    quantities.update(upsert_stock_lines(sorted(rows.items()), increment, versions))
+            # Sent inside the transaction, so that every process, this one included, applies
+            # the absolute quantities through the bus once committed and in commit order.
+            self.invalidate((STOCK,), payload=[
+                [warehouse_id, location, sku, quantity, version]
+                for (warehouse_id, location, sku), (quantity, version)
+                in quantities.items()
+            ])
+
+        # The bus echo reaches this process later; until then its reads would lag behind its own writes.
+        # Being versioned, the echo is skipped once it arrives.
+        for (warehouse_id, location, sku), (quantity, version) in quantities.items():
+            self.stock_index.set(warehouse_id, location, sku, quantity, version)
+
+        return [
+            dict(
+                warehouse=warehouse_uuids[key[0]],
+                location=key[1],
+                sku=key[2],
+                quantity=quantities[key][0],
             )
-        stock_line.quantity += quantity
-        stock_line.save()
-        return stock_line.quantity
+            for key
+            in keys
+        ]
+
+    def snapshot_stock_if_due(self):
+        database = StockSnapshot._meta.database
+        with database.atomic():
+            # Every worker runs a snapshotter; whichever holds the lock checks, the others skip this round.
+            if isinstance(database, peewee.PostgresqlDatabase) and not database.execute_sql(
+                'SELECT pg_try_advisory_xact_lock(%s)', (STOCK_SNAPSHOT_LOCK,),
+            ).fetchone()[0]:
+                return None
+            last_movement_id = StockMovement.select(fn.MAX(StockMovement.id)).scalar() or 0
+            snapshot_movement_id = StockSnapshot.select(fn.MAX(StockSnapshot.last_movement_id)).scalar() or 0
+            if last_movement_id - snapshot_movement_id >= self.stock_snapshot_interval:
+                return self.take_stock_snapshot()
 
     @procedure
-    def remove_stock(self, warehouse, sku, location, quantity):
-        warehouse_id = warehouse['uuid'] if isinstance(warehouse, dict) else warehouse
-        warehouse = Warehouse.get(uuid=warehouse_id)
-        stock_lines = warehouse.stock_lines.where(sku=sku, location=location)
-        if not stock_lines.exists():
-            stock_line = WarehouseStockLine.create(
-                warehouse=warehouse,
-                location=location,
-                sku=sku,
-                quantity=0,
+    def take_stock_snapshot(self):
+        database = StockSnapshot._meta.database
+        with database.atomic():
+            if isinstance(database, peewee.PostgresqlDatabase):
+                database.execute_sql('SELECT pg_advisory_xact_lock(%s)', (STOCK_SNAPSHOT_LOCK,))
+                # Waits for in-flight movements and holds off new ones while the projection is copied.
+                database.execute_sql('LOCK TABLE {} IN SHARE MODE'.format(WarehouseStockLine._meta.table_name))
+            snapshot = StockSnapshot.create(
+                last_movement_id=StockMovement.select(fn.MAX(StockMovement.id)).scalar() or 0,
             )
-        stock_line.quantity -= quantity
-        stock_line.save()
-        return stock_line.quantity
+            StockSnapshotLine.insert_from(
+                WarehouseStockLine.select(
+                    Value(snapshot.id),
+                    WarehouseStockLine.warehouse,
+                    WarehouseStockLine.location,
+                    WarehouseStockLine.sku,
+                    WarehouseStockLine.quantity,
+                ),
+                fields=[
+                    StockSnapshotLine.snapshot,
+                    StockSnapshotLine.warehouse,
+                    StockSnapshotLine.location,
+                    StockSnapshotLine.sku,
+                    StockSnapshotLine.quantity,
+                ],
+            ).execute()
+
+        return snapshot.to_dict()
+
+    @procedure
+    def open_stock_ledger(self):
+        # Stock that predates the ledger has no movements behind it; a snapshot is its opening balance.
+        if StockMovement.select().exists() or StockSnapshot.select().exists():
+            return None
+        if not WarehouseStockLine.select().exists():
+            return None
+        return self.take_stock_snapshot()
 
     @procedure
-    def set_stock(self, warehouse, sku, location, quantity):
-        warehouse_id = warehouse['uuid'] if isinstance(warehouse, dict) else warehouse
-        warehouse = Warehouse.get(uuid=warehouse_id)
-        stock_lines = warehouse.stock_lines.where(sku=sku, location=location)
-        if not stock_lines.exists():
-            stock_line = WarehouseStockLine.create(
-                warehouse=warehouse,
+    def rebuild_stock_projection(self):
+        database = WarehouseStockLine._meta.database
+        # Without a snapshot the projection is replayed from the first movement.
+        with database.atomic():
+            if isinstance(database, peewee.PostgresqlDatabase):
+                database.execute_sql('LOCK TABLE {} IN EXCLUSIVE MODE'.format(WarehouseStockLine._meta.table_name))
+            quantities = replay_stock_movements()
+            version = StockMovement.select(fn.MAX(StockMovement.id)).scalar() or 0
+            WarehouseStockLine.delete().execute()
+            for batch in chunked(sorted(quantities.items()), 500):
+                WarehouseStockLine.insert_many([
+                    dict(warehouse=warehouse_id, location=location, sku=sku, quantity=quantity, version=version)
+                    for (warehouse_id, location, sku), quantity
+                    in batch
+                ]).execute()
+            self.invalidate((STOCK,))
+
+        return len(quantities)
+
+    @procedure(idempotent=True)
+    def get_stock_at(self, at, skus=None, warehouse_ids=None):
+        if isinstance(at, str):
+            at = datetime.fromisoformat(at)
+        if warehouse_ids is not None:
+            warehouse_ids = [get_warehouse_id(warehouse) for warehouse in warehouse_ids]
+
+        return [
+            dict(
+                warehouse=get_warehouse_uuid(warehouse_id),
                 location=location,
                 sku=sku,
-                quantity=0,
+                quantity=quantity,
             )
-        stock_line.quantity = quantity
-        stock_line.save()
-        return stock_line.quantity
+            for (warehouse_id, location, sku), quantity
+            in sorted(replay_stock_movements(at, skus, warehouse_ids).items())
+        ]
+
+    @procedure(idempotent=True)
+    def get_stock_movements(self, warehouse=None, sku=None, limit=None, after=None):
+        movements = StockMovement.select()
+        if warehouse is not None:
+            movements = movements.where(StockMovement.warehouse == get_warehouse_id(warehouse))
+        if sku is not None:
+            movements = movements.where(StockMovement.sku == sku)
+        if after is not None:
+            movements = movements.where(StockMovement.id > after)
+        movements = movements.order_by(StockMovement.id)
+        if limit is not None:
+            movements = movements.limit(limit)
+
+        return [movement.to_dict() for movement in movements]
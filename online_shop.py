@@ -1,18 +1,22 @@
 import os
+import hmac
 from distutils.util import strtobool
 
-from flask import Flask, jsonify, session
+from flask import Flask, jsonify, request, session
 
-from main import module
+from modules.base import serve
+from modules.online_shop import CLAIM_SECRET_HEADER
+from main import module, setup_database, post_fork, worker_exit
 
-host, port = module.address.split(':')
-port = int(port)
 app = Flask(__name__)
 app.secret_key = 'SUPERSECRETKEY'
 
 
 @app.before_request
 def get_or_create_customer():
+    # Infrastructure endpoints, served before the shop has a sales channel.
+    if request.path.startswith('/_'):
+        return
     customer = module.get('customer').get_customer(session.get('customer_id'))
     if customer is None:
         customer = module.get('customer').create_customer()
@@ -32,12 +36,31 @@ def api_cart():
 
 @app.route('/_health')
 def health():
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'sales_channel_id': module.sales_channel_id})
+
+
+@app.route('/_claim', methods=['POST'])
+def claim():
+    # Without a configured secret nobody may claim this shop.
+    secret = request.headers.get(CLAIM_SECRET_HEADER, '')
+    if not module.claim_secret or not hmac.compare_digest(secret, module.claim_secret):
+        return jsonify({'error': 'invalid claim secret'}), 403
+    try:
+        module.claim(request.get_json()['sales_channel_id'])
+    except ValueError as exception:
+        return jsonify({'error': str(exception)}), 409
+    return jsonify({'sales_channel_id': module.sales_channel_id})
 
 
 if __name__ == '__main__':
-    app.run(
-        host=host,
-        port=port,
+    setup_database()
+    serve(
+        app,
+        module.address,
         debug=module.debug,
+        server=module.server,
+        workers=module.workers,
+        threads=module.threads,
+        post_fork=post_fork,
+        worker_exit=worker_exit,
     )
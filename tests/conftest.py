@@ -0,0 +1,46 @@
+import os
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peewee  # noqa: E402
+import pytest  # noqa: E402
+
+
+def make_database(models, path=':memory:'):
+    database = peewee.SqliteDatabase(path, pragmas={'foreign_keys': 1})
+
+    # Full text search is Postgres only; the vectors are written but never matched here.
+    @database.func('to_tsvector')
+    def to_tsvector(config, text):
+        return text
+
+    @database.func('setweight')
+    def setweight(vector, weight):
+        return vector
+
+    @database.func('hashtextextended')
+    def hashtextextended(text, seed):
+        return zlib.crc32(text.encode('utf-8'))
+
+    database.bind(models)
+    for model in models:
+        for field in model._meta.fields.values():
+            if field.name == 'search_vector':
+                field.index = False
+    database.create_tables(models)
+    return database
+
+
+@pytest.fixture
+def bind_models():
+    databases = []
+
+    def bind(models, path=':memory:'):
+        databases.append(make_database(models, path))
+        return databases[-1]
+
+    yield bind
+    for database in databases:
+        database.close()
@@ -0,0 +1,31 @@
+import pytest
+
+from modules.fulfillment_center import FulfillmentCenterModule
+from modules.product import ProductModule
+from modules.sales_channel import SalesChannelModule
+from modules.supplier import SupplierModule
+from modules.warehouse import WarehouseModule
+
+
+@pytest.mark.parametrize('module_class, create, method_name', [
+    (SalesChannelModule, lambda module, i: module.create_sales_channel(str(i)), 'aggregate_sales_channels'),
+    (SupplierModule, lambda module, i: module.create_supplier(str(i)), 'aggregate_suppliers'),
+    (FulfillmentCenterModule, lambda module, i: module.create_fulfillment_center(str(i), str(i)), 'aggregate_fulfillment_centers'),
+    (WarehouseModule, lambda module, i: module.create_warehouse(str(i)), 'aggregate_warehouses'),
+])
+def test_aggregate_created_at(bind_models, module_class, create, method_name):
+    bind_models(module_class.models)
+    module = module_class()
+    for i in range(3):
+        create(module, i)
+
+    result = getattr(module, method_name)(min='created_at', max='created_at')
+
+    assert result['count'] == 3
+    assert result['min']['created_at'] <= result['max']['created_at']
+
+
+def test_aggregate_rejects_unknown_fields(bind_models):
+    bind_models(ProductModule.models)
+    with pytest.raises(ValueError):
+        ProductModule().aggregate_products(max='updated_at')
@@ -0,0 +1,127 @@
+import socket
+import asyncio
+import threading
+
+from aiohttp import web
+from flask import Flask
+
+from modules.base import Module, procedure, get_codec, event_loop
+
+
+class ExampleModule(Module):
+    name = 'example'
+
+    @procedure
+    def inner(self):
+        return [1, 2]
+
+    @procedure
+    def outer(self):
+        return self.inner()[0]
+
+    @procedure
+    def fail(self):
+        raise ValueError('failed')
+
+
+class AsyncExampleModule(Module):
+    name = 'async_example'
+
+    @procedure
+    async def get_loop_id(self):
+        return id(asyncio.get_running_loop())
+
+
+class CachedExampleModule(Module):
+    name = 'cached_example'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 1
+        self.during_read = None
+
+    @procedure(cache=60)
+    def read(self):
+        value = self.value
+        if self.during_read is not None:
+            self.during_read()
+        return value
+
+    @procedure(invalidates=('read',))
+    def write(self, value):
+        self.value = value
+
+
+def make_client(module):
+    flask = Flask(__name__)
+    flask.route('/', methods=['GET', 'POST'])(module.route)
+    return flask.test_client()
+
+
+def test_batch_runs_nested_local_calls():
+    module = ExampleModule()
+    with module.batch():
+        outer, inner = module.outer(), module.inner()
+    assert outer.result() == 1
+    assert inner.result() == [1, 2]
+    assert module.local.batch is None
+
+
+def test_route_answers_batch_in_order():
+    codec = get_codec('application/json')
+    response = make_client(ExampleModule()).post(
+        '/',
+        data=codec.dumps({'batch': [
+            {'method_name': 'outer', 'args': [], 'kwargs': {}},
+            {'method_name': 'fail', 'args': [], 'kwargs': {}},
+            {'method_name': 'inner', 'args': [], 'kwargs': {}},
+        ]}),
+        content_type=codec.content_type,
+        headers={'Accept': codec.content_type},
+    )
+    batch = codec.loads(response.data)['batch']
+    assert batch[0] == {'return': 1}
+    assert batch[1]['raise']['name'] == 'ValueError'
+    assert batch[2] == {'return': [1, 2]}
+
+
+def test_dispatch_runs_async_procedures_on_one_loop():
+    module = AsyncExampleModule()
+    body = {'method_name': 'get_loop_id', 'args': [], 'kwargs': {}}
+    assert module.dispatch(body) == module.dispatch(body) == id(event_loop.get_loop())
+
+
+def test_sync_remote_calls_share_one_async_session():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(ExampleModule().make_web_app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    client = ExampleModule(remote=True, address='127.0.0.1:{}'.format(port))
+    assert [client.outer(), client.outer()] == [1, 1]
+    assert list(client.async_sessions) == [event_loop.get_loop()]
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_results_computed_across_an_invalidation_are_not_cached():
+    module = CachedExampleModule()
+
+    def write():
+        module.during_read = None
+        module.write(2)
+
+    # The write lands after the read took its value, but before the read's result is stored.
+    module.during_read = write
+    assert module.read() == 1
+    assert module.read() == 2
+    assert module.read() == 2
+    assert module.cache.stats()['hits'] == 1
@@ -0,0 +1,121 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from modules.cart import CartModule, CartItem, MemoryCartStore, MAX_QUANTITY, ADD, REMOVE, SET
+
+
+def test_memory_store_rejects_quantities_the_database_cannot_hold(bind_models):
+    bind_models(CartModule.models)
+    module = CartModule(cart_store='memory')
+    module.set_cart_item_quantity('shop', 'customer', 'article', 2)
+
+    with pytest.raises(ValueError):
+        module.apply_cart_operations('shop', 'customer', [
+            dict(article_id='other', quantity=1, type=SET),
+            dict(article_id='article', quantity=MAX_QUANTITY, type='add'),
+        ])
+
+    assert module.get_customers_cart_items('shop', 'customer') == [
+        dict(sales_channel_id='shop', customer_id='customer', article_id='article', quantity=2),
+    ]
+    assert module.memory_store.flush() == 1
+
+
+def test_memory_store_flushes_on_sigterm(bind_models):
+    bind_models(CartModule.models)
+    module = CartModule(cart_store='memory')
+    assert module.max_workers == 1
+    received = []
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: received.append(signum))
+    try:
+        module.__post_init__('cart')
+        module.add_item_to_cart('shop', 'customer', 'article')
+        os.kill(os.getpid(), signal.SIGTERM)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    assert received == [signal.SIGTERM]
+    assert [cart_item.to_dict() for cart_item in CartItem.select()] == [
+        dict(sales_channel_id='shop', customer_id='customer', article_id='article', quantity=1),
+    ]
+
+
+def test_memory_store_flushes_one_at_a_time(bind_models, monkeypatch, tmp_path):
+    # A file, so that the flushing threads share the database.
+    bind_models(CartModule.models, str(tmp_path / 'cart.db'))
+    store = MemoryCartStore(flush_interval=3600)
+    store.apply('shop', 'customer', [dict(article_id='article', quantity=1)])
+
+    writing, release = threading.Event(), threading.Event()
+    insert_many = CartItem.insert_many
+
+    def slow_insert_many(rows):
+        writing.set()
+        release.wait(5)
+        return insert_many(rows)
+
+    monkeypatch.setattr(CartItem, 'insert_many', slow_insert_many)
+    timer_flush = threading.Thread(target=store.flush)
+    timer_flush.start()
+    assert writing.wait(5)
+
+    # A shutdown flush has nothing left to swap, but must wait until the timer flush has written.
+    shutdown_flush = threading.Thread(target=store.flush)
+    shutdown_flush.start()
+    shutdown_flush.join(0.2)
+    assert shutdown_flush.is_alive()
+
+    release.set()
+    shutdown_flush.join(5)
+    assert not timer_flush.is_alive()
+    assert [cart_item.quantity for cart_item in CartItem.select()] == [1]
+
+
+def get_quantities():
+    return {cart_item.article_id: cart_item.quantity for cart_item in CartItem.select()}
+
+
+def test_database_store_upserts_and_clamps_quantities(bind_models):
+    bind_models(CartModule.models)
+    module = CartModule()
+
+    assert module.add_item_to_cart('shop', 'customer', 'article', 2) == 2
+    assert module.add_item_to_cart('shop', 'customer', 'article', 3) == 5
+    assert module.remove_item_from_cart('shop', 'customer', 'article', 1) == 4
+    assert module.set_cart_item_quantity('shop', 'customer', 'other', 7) == 7
+    assert module.set_cart_item_quantity('shop', 'customer', 'other', 3) == 3
+    assert get_quantities() == dict(article=4, other=3)
+
+    # Folded into a single upsert per article: the removal clamps at zero before the addition.
+    module.apply_cart_operations('shop', 'customer', [
+        dict(article_id='article', quantity=10, type=REMOVE),
+        dict(article_id='article', quantity=2, type=ADD),
+        dict(article_id='other', quantity=1, type=ADD),
+    ])
+    assert get_quantities() == dict(article=2, other=4)
+
+
+@pytest.mark.parametrize('cart_store', ['database', 'memory'])
+def test_items_taken_down_to_zero_leave_the_cart(bind_models, cart_store):
+    bind_models(CartModule.models)
+    module = CartModule(cart_store=cart_store)
+    if module.memory_store:
+        # Flushed by the test, since the flusher thread wouldn't see the in-memory database.
+        module.memory_store.flush_interval = 3600
+    module.add_item_to_cart('shop', 'customer', 'article', 2)
+    module.add_item_to_cart('shop', 'customer', 'other')
+    module.memory_store and module.memory_store.flush()
+
+    assert module.remove_item_from_cart('shop', 'customer', 'missing') == 0
+    assert module.remove_item_from_cart('shop', 'customer', 'article', 5) == 0
+    assert module.set_cart_item_quantity('shop', 'customer', 'other', 0) == 0
+    assert module.get_customers_cart_items('shop', 'customer') == []
+
+    module.memory_store and module.memory_store.flush()
+    assert get_quantities() == {}
+    assert module.add_item_to_cart('shop', 'customer', 'article') == 1
+    module.memory_store and module.memory_store.flush()
+    assert get_quantities() == dict(article=1)
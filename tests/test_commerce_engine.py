@@ -0,0 +1,73 @@
+from modules.commerce_engine import CommerceEngine
+from modules.warehouse import WarehouseModule
+
+
+class FakeTopologyModule:
+    def __init__(self, name, method_name, entities):
+        self.name = name
+        self.entities = entities
+        self.fetched = None
+        setattr(self, method_name, self.fetch)
+
+    def fetch(self):
+        entities = list(self.entities)
+        if self.fetched is not None:
+            self.fetched()
+        return entities
+
+
+def test_change_during_a_refresh_leaves_the_routing_graph_stale():
+    commerce_engine = CommerceEngine()
+    sales_channels = FakeTopologyModule('sales_channel', 'get_sales_channels', [
+        dict(uuid='shop', supplier_ids=['supplier']),
+    ])
+    suppliers = FakeTopologyModule('supplier', 'get_suppliers', [
+        dict(uuid='supplier', fulfillment_center_ids=['first']),
+    ])
+    fulfillment_centers = FakeTopologyModule('fulfillment_center', 'get_fulfillment_centers', [
+        dict(uuid='first', warehouse_id='first'),
+        dict(uuid='second', warehouse_id='second'),
+    ])
+    warehouses = FakeTopologyModule('warehouse', 'get_warehouses', [])
+    for module in (sales_channels, suppliers, fulfillment_centers, warehouses):
+        commerce_engine.install(module)
+
+    def change():
+        # Lands after the suppliers were read, as a notification from the bus listener would.
+        suppliers.entities[0] = dict(uuid='supplier', fulfillment_center_ids=['first', 'second'])
+        commerce_engine.watched('supplier', ('get_suppliers',), None)
+
+    fulfillment_centers.fetched = change
+    routes = commerce_engine.get_routing_graph().routes
+    assert [candidate['warehouse'] for candidate in routes['shop']] == ['first']
+
+    fulfillment_centers.fetched = None
+    routes = commerce_engine.get_routing_graph().routes
+    assert [candidate['warehouse'] for candidate in routes['shop']] == ['first', 'second']
+
+
+def test_route_order_skips_what_the_warehouses_no_longer_know(bind_models):
+    bind_models(WarehouseModule.models)
+    commerce_engine = CommerceEngine()
+    warehouses = WarehouseModule()
+    warehouse = warehouses.create_warehouse('north')['uuid']
+    warehouses.add_stock(warehouse, 'stocked', 'shelf', 5)
+    commerce_engine.install(FakeTopologyModule('sales_channel', 'get_sales_channels', [
+        dict(uuid='shop', supplier_ids=['supplier']),
+    ]))
+    commerce_engine.install(FakeTopologyModule('supplier', 'get_suppliers', [
+        dict(uuid='supplier', fulfillment_center_ids=['gone', 'north']),
+    ]))
+    # The first fulfillment center still points at a warehouse that has since been deleted.
+    commerce_engine.install(FakeTopologyModule('fulfillment_center', 'get_fulfillment_centers', [
+        dict(uuid='gone', warehouse_id='gone'),
+        dict(uuid='north', warehouse_id=warehouse),
+    ]))
+    commerce_engine.install(warehouses)
+
+    plan = commerce_engine.route_order('shop', [dict(sku='stocked', quantity=2), dict(sku='missing', quantity=1)])
+
+    assert [(shipment['warehouse'], shipment['lines']) for shipment in plan['shipments']] == [
+        (warehouse, [dict(sku='stocked', quantity=2)]),
+    ]
+    assert plan['unallocated'] == [dict(sku='missing', quantity=1)]
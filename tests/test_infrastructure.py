@@ -0,0 +1,165 @@
+import time
+import threading
+
+import pytest
+import requests
+
+from modules.infrastructure import InfrastructureModule
+from modules.online_shop import OnlineShopModule, CLAIM_SECRET_HEADER
+
+
+class FakeImage:
+    attrs = {'Id': 'image'}
+
+
+class FakeImages:
+    def list(self, filters=None):
+        return [FakeImage()]
+
+
+class FakeContainer:
+    def __init__(self, name):
+        self.name = name
+        self.stopped = self.removed = False
+
+    def stop(self):
+        self.stopped = True
+
+    def remove(self):
+        self.removed = True
+
+
+class FakeContainers:
+    def __init__(self):
+        self.started = []
+        self.lock = threading.Lock()
+
+    def run(self, name, **kwargs):
+        # Slow enough for concurrent spin ups to overlap.
+        time.sleep(0.05)
+        with self.lock:
+            self.started.append(FakeContainer(name))
+            return self.started[-1]
+
+    def list(self, **kwargs):
+        return []
+
+
+class FakeClient:
+    def __init__(self):
+        self.images = FakeImages()
+        self.containers = FakeContainers()
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+class FakeSession:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.claims = []
+
+    def get(self, url, **kwargs):
+        if not self.healthy:
+            raise requests.ConnectionError(url)
+        return FakeResponse(200)
+
+    def post(self, url, json=None, headers=None, **kwargs):
+        self.claims.append((url, json['sales_channel_id'], headers[CLAIM_SECRET_HEADER]))
+        return FakeResponse(200)
+
+
+def make_infrastructure(healthy=True, **kwargs):
+    infrastructure = InfrastructureModule(client=FakeClient(), address='0.0.0.0:5009', claim_secret='secret', **kwargs)
+    infrastructure.session = FakeSession(healthy)
+    # Refill right away, so that tests see the pool as it is left.
+    infrastructure.fill_pool_in_background = infrastructure.fill_pool
+    return infrastructure
+
+
+def test_slots_are_allocated_and_released():
+    infrastructure = make_infrastructure(warm_pool_size=2, max_online_shops=3)
+    infrastructure.fill_pool()
+    assert [(shop['slot'], shop['port'], shop['ready']) for shop in infrastructure.get_online_shops()] == [
+        (0, 5010, True),
+        (1, 5011, True),
+    ]
+
+    infrastructure.stop_online_shop(infrastructure.online_shops[0])
+    assert infrastructure.client.containers.started[0].removed
+    assert infrastructure.slots.available() == 2
+    assert infrastructure.start_online_shop()['slot'] == 0
+
+
+def test_spin_up_claims_a_warm_shop_and_refills_the_pool():
+    infrastructure = make_infrastructure(warm_pool_size=2, max_online_shops=3)
+    infrastructure.fill_pool()
+
+    online_shop = infrastructure.spin_up_online_shop('shop')
+
+    assert online_shop['slot'] == 0
+    assert infrastructure.session.claims == [('http://commerce_engine_online_shop_0:5010/_claim', 'shop', 'secret')]
+    assert [shop['sales_channel_id'] for shop in infrastructure.get_online_shops()] == ['shop', None, None]
+    # Already spun up: no second claim.
+    assert infrastructure.spin_up_online_shop('shop')['slot'] == 0
+    assert len(infrastructure.session.claims) == 1
+
+
+def test_concurrent_spin_ups_with_an_empty_pool_start_one_shop():
+    infrastructure = make_infrastructure(warm_pool_size=0, max_online_shops=3)
+    threads = [threading.Thread(target=infrastructure.spin_up_online_shop, args=('shop',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(infrastructure.client.containers.started) == 1
+    assert [shop['sales_channel_id'] for shop in infrastructure.get_online_shops()] == ['shop']
+
+
+def test_unhealthy_shop_times_out_and_frees_its_slot():
+    infrastructure = make_infrastructure(healthy=False, max_online_shops=1, ready_timeout=0.2)
+
+    with pytest.raises(TimeoutError):
+        infrastructure.start_online_shop()
+
+    assert infrastructure.client.containers.started[0].stopped
+    assert infrastructure.online_shops == {}
+    assert infrastructure.slots.available() == 1
+
+
+def test_wiring_twice_launches_a_single_pool():
+    client = FakeClient()
+    # As the reloader's parent and its child both do; neither touches the containers yet.
+    for _ in range(2):
+        infrastructure = InfrastructureModule(client=client, address='0.0.0.0:5009', warm_pool_size=2)
+        infrastructure.session = FakeSession()
+        infrastructure.fill_pool_in_background = infrastructure.fill_pool
+    assert client.containers.started == []
+
+    infrastructure.get_online_shops()
+    infrastructure.get_online_shops()
+    assert len(client.containers.started) == 2
+    assert InfrastructureModule.max_workers == 1
+
+
+def test_colocated_without_an_address_and_remote_stubs():
+    assert InfrastructureModule(client=FakeClient(), address='').slots.first_port == InfrastructureModule.port + 1
+    assert InfrastructureModule(remote=True, address='infrastructure:5009').slots is None
+
+
+def test_online_shop_accepts_a_single_claim():
+    online_shop = OnlineShopModule(sales_channel_id=None)
+    assert online_shop.max_workers == 1
+
+    online_shop.claim('shop')
+    with pytest.raises(ValueError):
+        online_shop.claim('other')
+    assert online_shop.sales_channel_id == 'shop'
+    assert OnlineShopModule(sales_channel_id='shop').max_workers is None
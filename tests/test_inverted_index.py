@@ -0,0 +1,58 @@
+from modules.inverted_index import InvertedIndex, SearchIndex
+from modules.product import ProductModule, Product, get_products_fingerprint
+
+
+def test_loaded_index_maps_postings_and_accepts_new_documents(tmp_path):
+    path = str(tmp_path / 'test.idx')
+    index = InvertedIndex(path)
+    index.add('a', 'trail runner')
+    index.add('b', 'classic runner')
+    index.save('fingerprint')
+
+    loaded = InvertedIndex(path)
+    assert loaded.load('fingerprint')
+    assert isinstance(loaded.postings['runner'][0], memoryview)
+    assert loaded.search('run')['results'] == ['a', 'b']
+
+    loaded.add('c', 'runner trainer')
+    loaded.add('d', 'zebra')
+    assert loaded.search('run')['count'] == 3
+    assert sorted(loaded.search('tra')['results']) == ['a', 'c']
+    assert loaded.terms == sorted(loaded.postings)
+
+    loaded.save('fingerprint')
+    reloaded = InvertedIndex(path)
+    assert reloaded.load('fingerprint')
+    assert reloaded.search('ze')['results'] == ['d']
+    assert not InvertedIndex(path).load('other fingerprint')
+
+
+def test_search_index_refreshes_documents_by_id():
+    documents = {'a': ['a', 'trail runner', {}], 'b': ['b', 'classic', {}]}
+    index = SearchIndex(
+        load_documents=lambda ids=None: [documents[doc_id] for doc_id in (ids or documents) if doc_id in documents],
+        get_fingerprint=lambda: None,
+    )
+    index.build()
+
+    documents['a'] = ['a', 'city walker', {}]
+    del documents['b']
+    documents['c'] = ['c', 'classic walker', {}]
+    index.refresh(['a', 'b', 'c'])
+
+    assert sorted(index.search('walk')['results']) == ['a', 'c']
+    assert index.search('trail')['count'] == 0
+    assert index.search('classic')['results'] == ['c']
+    assert [len(chunk) for chunk in index.chunk_ids([[str(i), '', {}] for i in range(320)])] == [150, 150, 20]
+
+
+def test_products_fingerprint_changes_on_edits(bind_models):
+    bind_models(ProductModule.models)
+    module = ProductModule()
+    product, _ = module.create_product({'name': 'Desk', 'type': 'Furniture', 'brand': 'Acme'})
+    fingerprint = get_products_fingerprint()
+
+    Product.update(name='Table').where(Product.uuid == product['uuid']).execute()
+
+    assert get_products_fingerprint() != fingerprint
+    assert get_products_fingerprint()[0] == 1
@@ -0,0 +1,47 @@
+from uuid import uuid4
+
+from modules.cart import CartModule
+from modules.fulfillment_center import FulfillmentCenterModule
+from modules.online_shop import OnlineShopModule
+from modules.product import ProductModule, Attribute, AttributeValue, Product, Article, ArticleSupplierSKU
+from modules.sales_channel import SalesChannelModule
+from modules.supplier import SupplierModule, Supplier, SupplierSKU, SupplierFulfillmentCenterSKU
+from modules.warehouse import WarehouseModule
+
+MODULE_CLASSES = (
+    SalesChannelModule,
+    ProductModule,
+    SupplierModule,
+    FulfillmentCenterModule,
+    WarehouseModule,
+    CartModule,
+)
+
+
+def test_cart_view_counts_stock_in_a_missing_warehouse_as_unavailable(bind_models):
+    bind_models([model for module_class in MODULE_CLASSES for model in module_class.models])
+    online_shop = OnlineShopModule(sales_channel_id=None)
+    for module_class in MODULE_CLASSES:
+        online_shop.install(module_class, remote=False)
+
+    warehouse = online_shop.get('warehouse').create_warehouse('Warehouse')
+    fulfillment_centers = [
+        online_shop.get('fulfillment_center').create_fulfillment_center('Fulfillment center', warehouse),
+        online_shop.get('fulfillment_center').create_fulfillment_center('Gone', str(uuid4())),
+    ]
+    supplier = online_shop.get('supplier').create_supplier('Supplier', fulfillment_centers)
+    online_shop.claim(online_shop.get('sales_channel').create_sales_channel('Shop', suppliers=[supplier])['uuid'])
+
+    attribute_value = AttributeValue.create(attribute=Attribute.create(name='Brand'), name='Brand')
+    product = Product.create(uuid=str(uuid4()), name='Product', type=attribute_value, brand=attribute_value)
+    article = Article.create(uuid=str(uuid4()), name='Article', product=product, recommended_retail_price=10)
+    supplier_sku = SupplierSKU.create(uuid=str(uuid4()), supplier=Supplier.get(uuid=supplier['uuid']), sku='SKU')
+    ArticleSupplierSKU.create(article=article, supplier_sku_id=supplier_sku.uuid)
+    for fulfillment_center in fulfillment_centers:
+        SupplierFulfillmentCenterSKU.create(supplier_sku=supplier_sku, fulfillment_center_id=fulfillment_center['uuid'], sku='SKU')
+    online_shop.get('warehouse').add_stock(warehouse, 'SKU', 'A1', 4)
+    online_shop.get('cart').add_item_to_cart(online_shop.sales_channel_id, 'customer', article.uuid)
+
+    items = online_shop.view_customers_cart('customer')['items']
+
+    assert [(item['article_id'], item['available']) for item in items] == [(article.uuid, 4)]
@@ -0,0 +1,54 @@
+import pytest
+
+from modules.product import ProductModule, Product, Attribute, AttributeValue
+from modules.sales_channel import SalesChannelModule, SalesChannel, SalesChannelSupplier
+from modules.supplier import SupplierModule, Supplier, SupplierFulfillmentCenter
+
+
+def count_queries(monkeypatch, database, call):
+    queries = []
+    execute_sql = database.execute_sql
+
+    def counting_execute_sql(sql, params=None, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, params, *args, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, 'execute_sql', counting_execute_sql)
+        call()
+    return len(queries)
+
+
+def create_sales_channels(numbers):
+    for i in numbers:
+        sales_channel = SalesChannel.create(uuid='sales-channel-{}'.format(i), name=str(i), type=SalesChannel.ONLINE_SHOP)
+        for ordering in range(3):
+            SalesChannelSupplier.create(sales_channel=sales_channel, supplier_id=str(ordering), ordering=ordering)
+
+
+def create_suppliers(numbers):
+    for i in numbers:
+        supplier = Supplier.create(uuid='supplier-{}'.format(i), name=str(i))
+        for ordering in range(3):
+            SupplierFulfillmentCenter.create(supplier=supplier, fulfillment_center_id=str(ordering), ordering=ordering)
+
+
+def create_products(numbers):
+    attribute, _ = Attribute.get_or_create(name='Brand')
+    for i in numbers:
+        attribute_value = AttributeValue.create(attribute=attribute, name=str(i))
+        Product.create(uuid='product-{}'.format(i), name=str(i), type=attribute_value, brand=attribute_value)
+
+
+@pytest.mark.parametrize('module_class, create, method_name', [
+    (SalesChannelModule, create_sales_channels, 'get_sales_channels'),
+    (SupplierModule, create_suppliers, 'get_suppliers'),
+    (ProductModule, create_products, 'get_products'),
+])
+def test_list_query_count_does_not_grow_with_rows(bind_models, monkeypatch, module_class, create, method_name):
+    database = bind_models(module_class.models)
+    create(range(5))
+    few = count_queries(monkeypatch, database, lambda: getattr(module_class(), method_name)())
+    create(range(5, 50))
+    many = count_queries(monkeypatch, database, lambda: getattr(module_class(), method_name)())
+    assert few == many == 2
@@ -0,0 +1,173 @@
+import time
+import threading
+
+from uuid import uuid4
+
+import pytest
+
+from modules.base import invalidation_bus
+from modules.product import (
+    ProductModule, Product, Article, ArticleSupplierSKU, ArticleSupplierSKUPricing, PriceTable, PricingEngine,
+    attribute_value_index, ATTRIBUTE_VALUES,
+)
+from modules.sales_channel import SalesChannelModule
+from modules.supplier import SupplierModule, SupplierSKU, Supplier
+
+
+def test_import_reports_malformed_jsonl_lines(bind_models):
+    bind_models(ProductModule.models)
+    report = ProductModule().import_products(
+        '{"name": "Desk", "type": "Furniture", "brand": "Acme"}\n'
+        '{"name": "Chair", \n'
+        '{"name": "Lamp", "type": "Lighting", "brand": "Acme"}\n'
+    )
+    assert report['created'] == 2
+    assert [i for i, _ in report['errors']] == [1]
+    assert Product.select().count() == 2
+
+
+def test_import_reports_values_that_are_not_strings(bind_models):
+    bind_models(ProductModule.models)
+    report = ProductModule().import_products(
+        '{"name": "Desk", "type": "Furniture", "brand": "Acme"}\n'
+        '{"name": "Chair", "type": 5, "brand": "Acme"}\n'
+        '{"name": "Lamp", "type": "Lighting", "brand": ["Acme"]}\n'
+        '{"name": null, "type": "Lighting", "brand": "Acme"}\n'
+        '{"name": "Rug", "type": "Furniture", "brand": "Acme"}\n',
+        chunk_size=1,
+    )
+    assert report['created'] == 2
+    assert report['errors'] == [
+        [1, ["'Type' must be a string"]],
+        [2, ["'Brand' must be a string"]],
+        [3, ["'Name' must be something"]],
+    ]
+    assert sorted(product.name for product in Product.select()) == ['Desk', 'Rug']
+
+
+def test_import_reads_multiline_csv_fields(bind_models):
+    bind_models(ProductModule.models)
+    report = ProductModule().import_products_from(iter([
+        'name,type,brand\n',
+        '"Desk\n',
+        'with drawers",Furniture,Acme\n',
+        'Lamp,Lighting,Acme\n',
+    ]), format='csv')
+    assert report['created'] == 2
+    assert report['errors'] == []
+    assert Product.get(Product.name == 'Desk\nwith drawers')
+
+
+def test_import_adds_attribute_values_after_commit(bind_models, monkeypatch):
+    bind_models(ProductModule.models)
+    attribute_value_index.entries.clear()
+    attribute_value_index.loaded_at.clear()
+
+    def insert_many(*args, **kwargs):
+        raise RuntimeError('insert failed')
+
+    monkeypatch.setattr(Product, 'insert_many', insert_many)
+    with pytest.raises(RuntimeError):
+        ProductModule().import_products('{"name": "Desk", "type": "Furniture", "brand": "Rolled Back"}\n')
+    assert attribute_value_index.search('Brand') == ([], 0)
+
+
+def test_attribute_values_are_kept_current_from_the_bus(bind_models, monkeypatch):
+    bind_models(ProductModule.models)
+    attribute_value_index.clear()
+    module = ProductModule()
+    module.create_product(dict(name='Desk', type='Furniture', brand='Acme'))
+    assert attribute_value_index.search('Brand') == (['Acme'], 1)
+
+    published = []
+    monkeypatch.setattr(invalidation_bus, 'publish', lambda *args: published.append(args))
+    module.create_product(dict(name='Chair', type='Furniture', brand='Bolt'))
+    assert [payload for _, method_names, _, payload in published if ATTRIBUTE_VALUES in method_names] == [
+        [['Brand', 'Bolt']],
+    ]
+
+    # Created by another worker, whose index loaded the brands before then.
+    module.invalidated((ATTRIBUTE_VALUES,), 0, payload=[['Brand', 'Crate']])
+    assert attribute_value_index.search('Brand') == (['Acme', 'Bolt', 'Crate'], 3)
+    module.invalidated((ATTRIBUTE_VALUES,), 0)
+    assert attribute_value_index.search('Brand') == (['Acme', 'Bolt'], 2)
+
+
+def test_pricing_engine_loads_each_sales_channel_once_outside_its_lock(monkeypatch):
+    engine = PricingEngine(lambda sales_channel_id, supplier_sku_ids: {})
+    loads, loading, release = [], threading.Event(), threading.Event()
+
+    def load(sales_channel_id):
+        loads.append(sales_channel_id)
+        if sales_channel_id == 'slow':
+            loading.set()
+            release.wait(5)
+        table = PriceTable({})
+        table.update({table.set('article', 'supplier-sku', 100)})
+        return table
+
+    monkeypatch.setattr(engine, 'load', load)
+    threads = [threading.Thread(target=engine.resolve, args=('slow', ['article'])) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    loading.wait(5)
+
+    assert engine.resolve('fast', ['article']) == {'article': {'supplier_sku_id': 'supplier-sku', 'price': '1.00'}}
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(loads) == ['fast', 'slow']
+
+
+def test_pricing_engine_applies_bus_updates_off_the_calling_thread():
+    engine = PricingEngine(lambda sales_channel_id, supplier_sku_ids: {})
+    engine.tables['channel'] = PriceTable({})
+    done = threading.Event()
+    threads = []
+
+    def get_supplier_ranks(sales_channel_id, supplier_sku_ids):
+        threads.append(threading.current_thread())
+        done.set()
+        return {}
+
+    engine.get_supplier_ranks = get_supplier_ranks
+    engine.submit('channel', [['article', 'supplier-sku', '2.50']])
+
+    assert done.wait(5)
+    assert threads != [threading.current_thread()]
+
+
+def test_prices_follow_a_change_of_supplier_ordering(bind_models):
+    bind_models(SalesChannelModule.models + SupplierModule.models + ProductModule.models)
+    module = ProductModule()
+    sales_channels = module.install(SalesChannelModule, remote=False)
+    supplier_module = module.install(SupplierModule, remote=False)
+    suppliers = [supplier_module.create_supplier(name) for name in ('first', 'second')]
+    sales_channel_id = sales_channels.create_sales_channel('Shop', suppliers=suppliers)['uuid']
+
+    product, _ = module.create_product(dict(name='Desk', type='Furniture', brand='Acme'))
+    article = Article.create(uuid=str(uuid4()), name='Desk', product=Product.get(uuid=product['uuid']), recommended_retail_price=10)
+    supplier_sku_ids = []
+    for supplier, price in zip(suppliers, ('5.00', '4.00')):
+        supplier_sku = SupplierSKU.create(uuid=str(uuid4()), supplier=Supplier.get(uuid=supplier['uuid']), sku='SKU')
+        # Written directly: a price set through the module would also be echoed to the pricing engine.
+        ArticleSupplierSKUPricing.create(
+            article_supplier_sku=ArticleSupplierSKU.create(article=article, supplier_sku_id=supplier_sku.uuid),
+            sales_channel_id=sales_channel_id,
+            price=price,
+        )
+        supplier_sku_ids.append(supplier_sku.uuid)
+
+    def resolve():
+        return module.resolve_prices(sales_channel_id, [article.uuid])[article.uuid]['supplier_sku_id']
+
+    assert resolve() == supplier_sku_ids[0]
+    assert sales_channel_id in module.pricing_engine.tables
+
+    sales_channels.set_sales_channel_suppliers(sales_channel_id, list(reversed(suppliers)))
+
+    # Applied by the pricing engine's own thread.
+    deadline = time.monotonic() + 5
+    while resolve() != supplier_sku_ids[1] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert resolve() == supplier_sku_ids[1]
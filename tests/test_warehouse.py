@@ -0,0 +1,145 @@
+import random
+import threading
+
+from datetime import datetime
+
+from peewee import fn
+
+from modules.base import invalidation_bus
+
+from modules.warehouse import (
+    WarehouseModule, Warehouse, WarehouseStockLine, StockMovement, StockSnapshot, ADD, REMOVE, SET,
+)
+
+
+def test_concurrent_stock_movements_keep_ledger_and_projection_in_step(bind_models, tmp_path):
+    bind_models(WarehouseModule.models, str(tmp_path / 'warehouse.db'))
+    module = WarehouseModule()
+    warehouses = [module.create_warehouse(name)['uuid'] for name in ('north', 'south')]
+    keys = [(warehouse, sku) for warehouse in warehouses for sku in ('a', 'b', 'c')]
+    errors = []
+
+    def apply(seed):
+        generator = random.Random(seed)
+        try:
+            for _ in range(20):
+                # Overlapping keys in a different order and type mix for every batch.
+                module.apply_stock_movements([
+                    dict(
+                        warehouse=warehouse,
+                        sku=sku,
+                        location='shelf',
+                        quantity=generator.randint(0, 5),
+                        type=generator.choice((ADD, REMOVE, SET)),
+                    )
+                    for warehouse, sku
+                    in generator.sample(keys, 4)
+                ])
+        except Exception as exception:
+            errors.append(exception)
+
+    threads = [threading.Thread(target=apply, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    ledger = {
+        (warehouse, sku): delta
+        for warehouse, sku, delta
+        in StockMovement
+        .select(Warehouse.uuid, StockMovement.sku, fn.SUM(StockMovement.delta))
+        .join(Warehouse)
+        .group_by(Warehouse.uuid, StockMovement.sku)
+        .tuples()
+    }
+    projection = {
+        (warehouse, sku): quantity
+        for warehouse, sku, quantity
+        in WarehouseStockLine
+        .select(Warehouse.uuid, WarehouseStockLine.sku, WarehouseStockLine.quantity)
+        .join(Warehouse)
+        .tuples()
+    }
+    assert ledger == projection
+    assert {key: module.count_stock(*key) for key in projection} == projection
+
+
+def test_stock_index_ignores_updates_older_than_it_holds(bind_models):
+    bind_models(WarehouseModule.models)
+    module = WarehouseModule()
+    warehouse = module.create_warehouse('north')['uuid']
+    module.add_stock(warehouse, 'a', 'shelf', 5)
+    warehouse_id, version = WarehouseStockLine.select(WarehouseStockLine.warehouse, WarehouseStockLine.version).tuples().get()
+
+    module.invalidated(('stock',), 0, payload=[[warehouse_id, 'shelf', 'a', 1, version - 1]])
+    assert module.count_stock(warehouse, 'a') == 5
+
+    module.invalidated(('stock',), 0, payload=[[warehouse_id, 'shelf', 'a', 7, version + 1]])
+    assert module.count_stock(warehouse, 'a') == 7
+
+
+def test_stock_snapshot_is_taken_once_due(bind_models):
+    bind_models(WarehouseModule.models)
+    module = WarehouseModule(stock_snapshot_interval=3)
+    warehouse = module.create_warehouse('north')['uuid']
+    module.add_stock(warehouse, 'a', 'shelf', 1)
+    module.add_stock(warehouse, 'a', 'shelf', 1)
+    assert module.snapshot_stock_if_due() is None
+
+    module.add_stock(warehouse, 'a', 'shelf', 1)
+    assert module.snapshot_stock_if_due()['last_movement_id'] == 3
+    assert module.snapshot_stock_if_due() is None
+    assert StockSnapshot.select().count() == 1
+
+
+def test_rebuild_without_snapshot_replays_every_movement(bind_models):
+    bind_models(WarehouseModule.models)
+    module = WarehouseModule()
+    warehouse = module.create_warehouse('north')['uuid']
+    module.add_stock(warehouse, 'a', 'shelf', 4)
+    module.remove_stock(warehouse, 'a', 'shelf', 1)
+    WarehouseStockLine.update(quantity=100).execute()
+
+    assert module.rebuild_stock_projection() == 1
+    assert WarehouseStockLine.get().quantity == 3
+    assert not StockSnapshot.select().exists()
+    assert module.count_stock(warehouse, 'a') == 3
+
+
+def test_rebuild_keeps_stock_from_before_the_ledger(bind_models):
+    bind_models(WarehouseModule.models)
+    module = WarehouseModule()
+    warehouse = module.create_warehouse('north')['uuid']
+    # As an upgraded database has it: stock lines, but no movements behind them.
+    WarehouseStockLine.create(warehouse=Warehouse.get(uuid=warehouse), location='shelf', sku='a', quantity=5)
+
+    assert module.open_stock_ledger() is not None
+    assert module.open_stock_ledger() is None
+    before_movements = datetime.now()
+    module.add_stock(warehouse, 'a', 'shelf', 2)
+    WarehouseStockLine.update(quantity=100).execute()
+
+    assert module.rebuild_stock_projection() == 1
+    assert WarehouseStockLine.get().quantity == 7
+    assert [line['quantity'] for line in module.get_stock_at(before_movements)] == [5]
+
+
+def test_writes_are_read_back_before_the_bus_echo(bind_models, monkeypatch):
+    bind_models(WarehouseModule.models)
+    module = WarehouseModule()
+    warehouse = module.create_warehouse('north')['uuid']
+    module.add_stock(warehouse, 'a', 'shelf', 4)
+    assert module.count_stock(warehouse, 'a') == 4
+
+    # As with Postgres, where the notification comes back through the listener thread some time later.
+    published = []
+    monkeypatch.setattr(invalidation_bus, 'publish', lambda *args: published.append(args))
+    module.add_stock(warehouse, 'a', 'shelf', 3)
+    module.remove_stock(warehouse, 'a', 'shelf', 2)
+    assert module.count_stock(warehouse, 'a') == 5
+
+    for args in published:
+        invalidation_bus.deliver(*args)
+    assert module.count_stock(warehouse, 'a') == 5